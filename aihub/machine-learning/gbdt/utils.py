@@ -2,23 +2,23 @@ import numpy as np
 
 ### 定义二叉特征分裂函数
 def feature_split(X, feature_i, threshold):
-    split_func = None
-    if isinstance(threshold, int) or isinstance(threshold, float):
-        split_func = lambda sample: sample[feature_i] >= threshold
+    # 按列一次比较得到布尔掩码，不再逐行判断
+    if isinstance(threshold, (int, float, np.number)):
+        split_mask = X[:, feature_i] >= threshold
     else:
-        split_func = lambda sample: sample[feature_i] == threshold
+        split_mask = X[:, feature_i] == threshold
 
-    X_left = np.array([sample for sample in X if split_func(sample)])
-    X_right = np.array([sample for sample in X if not split_func(sample)])
+    X_left = X[split_mask]
+    X_right = X[~split_mask]
 
-    return np.array([X_left, X_right])
+    return X_left, X_right
 
 
 ### 计算基尼指数
 def calculate_gini(y):
-    y = y.tolist()
-    probs = [y.count(i)/len(y) for i in np.unique(y)]
-    gini = sum([p*(1-p) for p in probs])
+    _, counts = np.unique(np.asarray(y).ravel(), return_counts=True)
+    probs = counts / counts.sum()
+    gini = np.sum(probs * (1 - probs))
     return gini
 
 	
@@ -6,27 +6,32 @@ class TreeNode():
     def __init__(self, feature_i=None, threshold=None,
                leaf_value=None, left_branch=None, right_branch=None):
         # 特征索引
-        self.feature_i = feature_i          
+        self.feature_i = feature_i
         # 特征划分阈值
-        self.threshold = threshold 
+        self.threshold = threshold
         # 叶子节点取值
-        self.leaf_value = leaf_value   
+        self.leaf_value = leaf_value
         # 左子树
-        self.left_branch = left_branch     
+        self.left_branch = left_branch
         # 右子树
         self.right_branch = right_branch
-		
+
+
 ### 定义二叉决策树
+# 分裂查找基于直方图：拟合前按分位数把每个特征分桶，候选阈值只取各桶的下界，
+# 结点只保存样本行索引，结点内用np.bincount累加各桶的统计量，再用累加和一次算出所有候选阈值的分裂效果
 class BinaryDecisionTree(object):
     ### 决策树初始参数
     def __init__(self, min_samples_split=2, min_gini_impurity=999,
-                 max_depth=float("inf"), loss=None):
+                 max_depth=float("inf"), loss=None, max_bins=255, min_var_reduction=0):
         # 根结点
-        self.root = None  
+        self.root = None
         # 节点最小分裂样本数
         self.min_samples_split = min_samples_split
         # 节点初始化基尼不纯度
         self.min_gini_impurity = min_gini_impurity
+        # 回归树结点分裂的最小方差减少量
+        self.min_var_reduction = min_var_reduction
         # 树最大深度
         self.max_depth = max_depth
         # 基尼不纯度计算函数
@@ -35,73 +40,137 @@ class BinaryDecisionTree(object):
         self._leaf_value_calculation = None
         # 损失函数
         self.loss = loss
+        # 每个特征的最大分桶数，特征取值数不超过分桶数时和逐个取值查找完全一致
+        self.max_bins = max_bins
+        # 直方图分裂准则，为None时使用impurity_calculation逐个阈值计算
+        self.split_criterion = None
 
     ### 决策树拟合函数
     def fit(self, X, y, loss=None):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y)
+        if len(np.shape(y)) == 1:
+            y = np.expand_dims(y, axis=1)
+        self.X, self.y = X, y
+        # 特征分桶，整棵树只做一次
+        self.bin_thresholds, self.X_binned = self._build_bins(X)
+        self.n_bins = max(len(thresholds) for thresholds in self.bin_thresholds)
+        # 每个样本的统计量，结点直方图由它按桶累加得到
+        self.sample_stats = self._sample_stats(y) if self.split_criterion else None
         # 递归构建决策树
-        self.root = self._build_tree(X, y)
+        self.root = self._build_tree(np.arange(X.shape[0]))
+        self.X, self.y, self.X_binned, self.sample_stats = None, None, None, None
         self.loss=None
 
-    ### 决策树构建函数
-    def _build_tree(self, X, y, current_depth=0):
+    ### 按分位数分桶，返回每个特征的桶下界和每个样本所在的桶编号
+    def _build_bins(self, X):
+        n_samples, n_features = X.shape
+        bin_thresholds = []
+        X_binned = np.zeros((n_samples, n_features), dtype=np.int32)
+        for feature_i in range(n_features):
+            feature_values = X[:, feature_i]
+            unique_values = np.unique(feature_values)
+            if len(unique_values) > self.max_bins:
+                # 分位数作为桶下界，第一个分位数即最小值，保证每个样本都落在某个桶中
+                quantiles = np.quantile(feature_values, np.linspace(0, 1, self.max_bins + 1)[:-1])
+                unique_values = np.unique(quantiles)
+            bin_thresholds.append(unique_values)
+            # 样本取值 >= 第k个桶下界 等价于 桶编号 >= k
+            X_binned[:, feature_i] = np.searchsorted(unique_values, feature_values, side='right') - 1
+        return bin_thresholds, X_binned
+
+    ### 每个样本的统计量，默认第0列为样本数
+    def _sample_stats(self, y):
+        raise NotImplementedError()
+
+    ### 由统计量得到样本数
+    def _sample_count(self, stats):
+        return stats[..., 0]
+
+    ### 由左右子树的统计量计算分裂得分，越小越好，形状为(特征数, 桶数)
+    def _split_scores(self, left, right, total):
+        raise NotImplementedError()
+
+    ### 分裂得分是否满足分裂条件
+    def _can_split(self, score):
+        return score < self.min_gini_impurity
+
+    ### 计算结点的直方图，形状为(特征数, 桶数, 统计量数)
+    def _histogram(self, sample_idx):
+        n_features, n_bins = self.X_binned.shape[1], self.n_bins
+        # 所有特征的桶编号展开到同一个数组中一次累加
+        flat_bins = (self.X_binned[sample_idx] + np.arange(n_features) * n_bins).ravel()
+        stats = self.sample_stats[sample_idx]
+        hist = np.empty((n_features * n_bins, stats.shape[1]))
+        for stat_i in range(stats.shape[1]):
+            hist[:, stat_i] = np.bincount(flat_bins, weights=np.repeat(stats[:, stat_i], n_features), minlength=n_features * n_bins)
+        return hist.reshape(n_features, n_bins, stats.shape[1])
+
+    ### 基于直方图查找最佳分裂，返回(得分, 特征索引, 桶编号)
+    def _find_split_histogram(self, hist):
+        total = hist[0].sum(axis=0)
+        # 桶编号 >= k 的样本进入左子树，从高到低累加得到每个候选阈值的左子树统计量
+        left = np.cumsum(hist[:, ::-1, :], axis=1)[:, ::-1, :]
+        right = total - left
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = self._split_scores(left, right, total)
+        # 阈值只取结点内出现过的取值，且左右子树都不能为空
+        valid = (self._sample_count(hist) > 0) & (self._sample_count(right) > 0)
+        scores = np.where(valid & np.isfinite(scores), scores, np.inf)
+        best = np.argmin(scores)
+        feature_i, bin_i = np.unravel_index(best, scores.shape)
+        return scores[feature_i, bin_i], feature_i, bin_i
+
+    ### 使用impurity_calculation逐个桶下界计算，兼容自定义分裂准则的子类
+    def _find_split_callback(self, sample_idx):
+        y = self.y[sample_idx]
+        best_score, best_feature, best_bin = 999, None, None
+        for feature_i in range(self.X_binned.shape[1]):
+            feature_bins = self.X_binned[sample_idx, feature_i]
+            for bin_i in np.unique(feature_bins)[1:]:
+                left_mask = feature_bins >= bin_i
+                impurity = self.impurity_calculation(y, y[left_mask], y[~left_mask])
+                if impurity < best_score:
+                    best_score, best_feature, best_bin = impurity, feature_i, bin_i
+        return best_score, best_feature, best_bin
+
+    ### 决策树构建函数，结点只传递样本行索引，hist为已知的结点直方图
+    def _build_tree(self, sample_idx, current_depth=0, hist=None):
         # 初始化最小基尼不纯度
         init_gini_impurity = 999
-        # 初始化最佳特征索引和阈值
-        best_criteria = None    
-        # 初始化数据子集
-        best_sets = None        
-        
-        if len(np.shape(y)) == 1:
-            y = np.expand_dims(y, axis=1)
-
-        # 合并输入和标签
-        Xy = np.concatenate((X, y), axis=1)
-        # 获取样本数和特征数
-        n_samples, n_features = X.shape
+        feature_i, bin_i = None, None
+        # 获取样本数
+        n_samples = len(sample_idx)
         # 设定决策树构建条件
         # 训练样本数量大于节点最小分裂样本数且当前树深度小于最大深度
         if n_samples >= self.min_samples_split and current_depth <= self.max_depth:
-            # 遍历计算每个特征的基尼不纯度
-            for feature_i in range(n_features):
-                # 获取第i特征的所有取值
-                feature_values = np.expand_dims(X[:, feature_i], axis=1)
-                # 获取第i个特征的唯一取值
-                unique_values = np.unique(feature_values)
-
-                # 遍历取值并寻找最佳特征分裂阈值
-                for threshold in unique_values:
-                    # 特征节点二叉分裂
-                    Xy1, Xy2 = feature_split(Xy, feature_i, threshold)
-                    # 如果分裂后的子集大小都不为0
-                    if len(Xy1) > 0 and len(Xy2) > 0:
-                        # 获取两个子集的标签值
-                        y1 = Xy1[:, n_features:]
-                        y2 = Xy2[:, n_features:]
-
-                        # 计算基尼不纯度
-                        impurity = self.impurity_calculation(y, y1, y2)
-
-                        # 获取最小基尼不纯度
-                        # 最佳特征索引和分裂阈值
-                        if impurity < init_gini_impurity:
-                            init_gini_impurity = impurity
-                            best_criteria = {"feature_i": feature_i, "threshold": threshold}
-                            best_sets = {
-                                "leftX": Xy1[:, :n_features],   
-                                "lefty": Xy1[:, n_features:],   
-                                "rightX": Xy2[:, :n_features],  
-                                "righty": Xy2[:, n_features:]   
-                                }
-        
+            if self.split_criterion:
+                if hist is None:
+                    hist = self._histogram(sample_idx)
+                init_gini_impurity, feature_i, bin_i = self._find_split_histogram(hist)
+            else:
+                init_gini_impurity, feature_i, bin_i = self._find_split_callback(sample_idx)
+
         # 如果计算的最小不纯度小于设定的最小不纯度
-        if init_gini_impurity < self.min_gini_impurity:
+        if feature_i is not None and self._can_split(init_gini_impurity):
+            left_mask = self.X_binned[sample_idx, feature_i] >= bin_i
+            left_idx, right_idx = sample_idx[left_mask], sample_idx[~left_mask]
+            left_hist, right_hist = None, None
+            if self.split_criterion:
+                # 只统计样本较少的子结点，另一个子结点的直方图由父结点相减得到
+                if len(left_idx) <= len(right_idx):
+                    left_hist = self._histogram(left_idx)
+                    right_hist = hist - left_hist
+                else:
+                    right_hist = self._histogram(right_idx)
+                    left_hist = hist - right_hist
             # 分别构建左右子树
-            left_branch = self._build_tree(best_sets["leftX"], best_sets["lefty"], current_depth + 1)
-            right_branch = self._build_tree(best_sets["rightX"], best_sets["righty"], current_depth + 1)
-            return TreeNode(feature_i=best_criteria["feature_i"], threshold=best_criteria["threshold"], left_branch=left_branch, right_branch=right_branch)
+            left_branch = self._build_tree(left_idx, current_depth + 1, left_hist)
+            right_branch = self._build_tree(right_idx, current_depth + 1, right_hist)
+            return TreeNode(feature_i=int(feature_i), threshold=self.bin_thresholds[feature_i][bin_i], left_branch=left_branch, right_branch=right_branch)
 
         # 计算叶子计算取值
-        leaf_value = self._leaf_value_calculation(y)
+        leaf_value = self._leaf_value_calculation(self.y[sample_idx])
         return TreeNode(leaf_value=leaf_value)
 
     ### 定义二叉树值预测函数
@@ -115,7 +184,7 @@ class BinaryDecisionTree(object):
         feature_value = x[tree.feature_i]
         # 判断落入左子树还是右子树
         branch = tree.right_branch
-        if isinstance(feature_value, int) or isinstance(feature_value, float):
+        if isinstance(feature_value, (int, float, np.number)):
             if feature_value >= tree.threshold:
                 branch = tree.left_branch
         elif feature_value == tree.threshold:
@@ -123,21 +192,52 @@ class BinaryDecisionTree(object):
         # 测试子集
         return self.predict_value(x, branch)
 
-    ### 数据集预测函数
+    ### 数据集预测函数，按结点批量划分样本索引
     def predict(self, X):
-        y_pred = [self.predict_value(sample) for sample in X]
+        X = np.asarray(X, dtype=np.float64)
+        y_pred = [None] * X.shape[0]
+        stack = [(self.root, np.arange(X.shape[0]))]
+        while stack:
+            tree, sample_idx = stack.pop()
+            if not len(sample_idx):
+                continue
+            if tree.leaf_value is not None:
+                for i in sample_idx:
+                    y_pred[i] = tree.leaf_value
+                continue
+            left_mask = X[sample_idx, tree.feature_i] >= tree.threshold
+            stack.append((tree.left_branch, sample_idx[left_mask]))
+            stack.append((tree.right_branch, sample_idx[~left_mask]))
         return y_pred
 
-		
-		
+# CART分类树
 class ClassificationTree(BinaryDecisionTree):
     ### 定义基尼不纯度计算过程
     def _calculate_gini_impurity(self, y, y1, y2):
         p = len(y1) / len(y)
         gini = calculate_gini(y)
+	# 基尼不纯度
         gini_impurity = p * calculate_gini(y1) + (1-p) * calculate_gini(y2)
         return gini_impurity
-    
+
+    ### 每个样本按类别one-hot，累加后即各类别的样本数
+    def _sample_stats(self, y):
+        self.classes, class_idx = np.unique(y[:, 0], return_inverse=True)
+        stats = np.zeros((len(y), len(self.classes)))
+        stats[np.arange(len(y)), class_idx] = 1
+        return stats
+
+    def _sample_count(self, stats):
+        return stats.sum(axis=-1)
+
+    ### 基尼不纯度的直方图计算
+    def _split_scores(self, left, right, total):
+        n_left = left.sum(axis=2)
+        n_right = right.sum(axis=2)
+        gini_left = 1 - np.sum((left / n_left[:, :, None]) ** 2, axis=2)
+        gini_right = 1 - np.sum((right / n_right[:, :, None]) ** 2, axis=2)
+        return (n_left * gini_left + n_right * gini_right) / total.sum()
+
     ### 多数投票
     def _majority_vote(self, y):
         most_common = None
@@ -149,14 +249,15 @@ class ClassificationTree(BinaryDecisionTree):
                 most_common = label
                 max_count = count
         return most_common
-    
+
     # 分类树拟合
     def fit(self, X, y):
         self.impurity_calculation = self._calculate_gini_impurity
         self._leaf_value_calculation = self._majority_vote
+        self.split_criterion = 'gini'
         super(ClassificationTree, self).fit(X, y)
-	
-		
+
+
 ### CART回归树
 class RegressionTree(BinaryDecisionTree):
 	# 计算方差减少量
@@ -170,13 +271,82 @@ class RegressionTree(BinaryDecisionTree):
         variance_reduction = var_tot - (frac_1 * var_y1 + frac_2 * var_y2)
         return sum(variance_reduction)
 
+    ### 每个样本的统计量为 [1, y, y^2]，累加后可直接算出方差
+    def _sample_stats(self, y):
+        y = y.astype(np.float64)
+        return np.concatenate((np.ones((len(y), 1)), y, y ** 2), axis=1)
+
+    ### 方差减少量的直方图计算，方差减少量越大越好，取负数作为得分
+    def _split_scores(self, left, right, total):
+        n_outputs = (total.shape[0] - 1) // 2
+
+        def variance(stats):
+            n = stats[..., :1]
+            mean = stats[..., 1:1 + n_outputs] / n
+            return stats[..., 1 + n_outputs:] / n - mean ** 2
+
+        frac_1 = left[:, :, 0] / total[0]
+        frac_2 = right[:, :, 0] / total[0]
+        variance_reduction = variance(total) - (frac_1[:, :, None] * variance(left) + frac_2[:, :, None] * variance(right))
+        return -variance_reduction.sum(axis=2)
+
+    ### 得分为方差减少量的负数，方差减少量大于min_var_reduction才分裂
+    def _can_split(self, score):
+        return -score > self.min_var_reduction
+
     # 节点值取平均
     def _mean_of_y(self, y):
         value = np.mean(y, axis=0)
         return value if len(value) > 1 else value[0]
 
-	# 回归树拟合
+    # 回归树拟合
     def fit(self, X, y):
         self.impurity_calculation = self._calculate_variance_reduction
         self._leaf_value_calculation = self._mean_of_y
+        self.split_criterion = 'variance'
         super(RegressionTree, self).fit(X, y)
+
+
+### XGBoost单棵树，y为真实值和当前预测值按列拼接
+class XGBoostTree(BinaryDecisionTree):
+    # 结点分裂方法
+    def node_split(self, y):
+        # 中间特征所在列
+        feature = int(np.shape(y)[1]/2)
+        # 左边为真实值，右边为预测值
+        y_true, y_pred = y[:, :feature], y[:, feature:]
+        return y_true, y_pred
+
+    ### 每个样本的统计量为 [1, 梯度, 二阶导]，累加后即结点的梯度和与hessian和
+    def _sample_stats(self, y):
+        y_true, y_pred = self.node_split(y.astype(np.float64))
+        gradient = np.sum(y_true * self.loss.gradient(y_true, y_pred), axis=1)
+        hessian = np.sum(self.loss.hess(y_true, y_pred), axis=1)
+        return np.stack((np.ones(len(y)), gradient, hessian), axis=1)
+
+    ### 树分裂增益，式(12.28)，增益越大越好，取负数作为得分
+    def _split_scores(self, left, right, total):
+        def gain(stats):
+            return 0.5 * stats[..., 1] ** 2 / stats[..., 2]
+
+        return -(gain(left) + gain(right) - gain(total))
+
+    ### 得分为增益的负数，增益大于min_var_reduction才分裂
+    def _can_split(self, score):
+        return -score > self.min_var_reduction
+
+    # 计算叶子结点最优权重
+    def leaf_weight(self, y):
+        y_true, y_pred = self.node_split(y)
+        # 梯度计算
+        gradient = np.sum(y_true * self.loss.gradient(y_true, y_pred), axis=0)
+        # hessian矩阵计算
+        hessian = np.sum(self.loss.hess(y_true, y_pred), axis=0)
+        # 叶子结点得分
+        return gradient / hessian
+
+    # 树拟合方法
+    def fit(self, X, y):
+        self._leaf_value_calculation = self.leaf_weight
+        self.split_criterion = 'gain'
+        super(XGBoostTree, self).fit(X, y)
@@ -0,0 +1,165 @@
+### cart.py 直方图分裂查找的基准和正确性校验
+# 1. 特征取值数不超过max_bins时，直方图分裂和逐个取值的精确分裂(原来的实现)生成的树一致，得分相同的分裂视为一致
+# 2. 100k x 50 的合成数据上直方图分裂的拟合耗时，精确分裂只在小样本上计时做对比
+# gbdt和random_forest目录下的cart.py与这里的BinaryDecisionTree相同
+# 用法: python cart_benchmark.py --samples 100000 --features 50 --max-depth 6
+import argparse
+import time
+import numpy as np
+from cart import ClassificationTree, RegressionTree, XGBoostTree, TreeNode
+from utils import feature_split
+
+
+### 平方损失，XGBoostTree使用
+class SquareLoss:
+    def gradient(self, y, y_pred):
+        return -(y - y_pred)
+
+    def hess(self, y, y_pred):
+        return np.ones_like(y)
+
+
+### 精确分裂的得分，越小越好，和直方图的_split_scores一致
+def classification_score(tree, y, y1, y2):
+    return tree._calculate_gini_impurity(y, y1, y2)
+
+
+def regression_score(tree, y, y1, y2):
+    return -tree._calculate_variance_reduction(y, y1, y2)
+
+
+def xgboost_score(tree, y, y1, y2):
+    def gain(y):
+        y_true, y_pred = tree.node_split(y)
+        gradient = np.sum(y_true * tree.loss.gradient(y_true, y_pred))
+        hessian = np.sum(tree.loss.hess(y_true, y_pred))
+        return 0.5 * gradient ** 2 / hessian
+
+    return -(gain(y1) + gain(y2) - gain(y))
+
+
+### 原来的精确分裂：遍历每个特征的每个取值，用feature_split划分后计算得分
+def build_exact_tree(tree, score, X, y, current_depth=0):
+    # fit结束时会清空loss，XGBoostTree计算增益和叶子权重需要
+    if isinstance(tree, XGBoostTree) and tree.loss is None:
+        tree.loss = SquareLoss()
+    best_score, best_feature, best_threshold = 999, None, None
+    Xy = np.concatenate((X, y), axis=1)
+    n_samples, n_features = X.shape
+    if n_samples >= tree.min_samples_split and current_depth <= tree.max_depth:
+        for feature_i in range(n_features):
+            for threshold in np.unique(X[:, feature_i]):
+                Xy1, Xy2 = feature_split(Xy, feature_i, threshold)
+                if len(Xy1) > 0 and len(Xy2) > 0:
+                    impurity = score(tree, y, Xy1[:, n_features:], Xy2[:, n_features:])
+                    if impurity < best_score:
+                        best_score, best_feature, best_threshold = impurity, feature_i, threshold
+
+    if best_feature is not None and tree._can_split(best_score):
+        left_mask = X[:, best_feature] >= best_threshold
+        left_branch = build_exact_tree(tree, score, X[left_mask], y[left_mask], current_depth + 1)
+        right_branch = build_exact_tree(tree, score, X[~left_mask], y[~left_mask], current_depth + 1)
+        return TreeNode(feature_i=best_feature, threshold=best_threshold, left_branch=left_branch, right_branch=right_branch)
+    return TreeNode(leaf_value=tree._leaf_value_calculation(y))
+
+
+### 两棵树的结构，阈值和叶子取值是否一致，返回不一致的结点路径和得分相同只是选择不同的结点数
+# 多个分裂得分完全相同时，累加和的浮点误差可能让直方图选中另一个，这时比较两个分裂在结点样本上的精确得分
+def compare_tree(tree, score, hist_node, exact_node, X, y, path='root'):
+    if hist_node.leaf_value is not None or exact_node.leaf_value is not None:
+        if hist_node.leaf_value is None or exact_node.leaf_value is None or not np.allclose(hist_node.leaf_value, exact_node.leaf_value):
+            return path, 0
+        return None, 0
+    if hist_node.feature_i != exact_node.feature_i or hist_node.threshold != exact_node.threshold:
+        scores = []
+        for node in [hist_node, exact_node]:
+            left_mask = X[:, node.feature_i] >= node.threshold
+            scores.append(score(tree, y, y[left_mask], y[~left_mask]))
+        if np.isclose(scores[0], scores[1], rtol=1e-9, atol=1e-12):
+            return None, 1
+        return '%s: feature %s >= %s (score %s), exact feature %s >= %s (score %s)' % (
+            path, hist_node.feature_i, hist_node.threshold, scores[0], exact_node.feature_i, exact_node.threshold, scores[1]), 0
+    left_mask = X[:, hist_node.feature_i] >= hist_node.threshold
+    left_diff, left_ties = compare_tree(tree, score, hist_node.left_branch, exact_node.left_branch, X[left_mask], y[left_mask], path + '.left')
+    right_diff, right_ties = compare_tree(tree, score, hist_node.right_branch, exact_node.right_branch, X[~left_mask], y[~left_mask], path + '.right')
+    return left_diff or right_diff, left_ties + right_ties
+
+
+def count_nodes(tree):
+    if tree.leaf_value is not None:
+        return 1
+    return 1 + count_nodes(tree.left_branch) + count_nodes(tree.right_branch)
+
+
+### 合成数据，n_values不为空时每个特征只有n_values个不同取值
+def make_data(n_samples, n_features, n_values=None, seed=0):
+    random_state = np.random.RandomState(seed)
+    if n_values:
+        X = random_state.randint(0, n_values, size=(n_samples, n_features)).astype(np.float64)
+    else:
+        X = random_state.normal(size=(n_samples, n_features))
+    weights = random_state.normal(size=n_features)
+    y_value = X @ weights / np.sqrt(n_features) + np.sin(X[:, 0]) + 0.1 * random_state.normal(size=n_samples)
+    y_class = np.digitize(y_value, np.quantile(y_value, [1 / 3, 2 / 3]))
+    y_pred = 0.1 * random_state.normal(size=n_samples)
+    return X, {
+        'classification': y_class.reshape(-1, 1),
+        'regression': y_value.reshape(-1, 1),
+        'xgboost': np.stack((y_value, y_pred), axis=1),
+    }
+
+
+TREES = {
+    'classification': (lambda max_depth, max_bins: ClassificationTree(max_depth=max_depth, max_bins=max_bins), classification_score),
+    'regression': (lambda max_depth, max_bins: RegressionTree(max_depth=max_depth, max_bins=max_bins), regression_score),
+    'xgboost': (lambda max_depth, max_bins: XGBoostTree(max_depth=max_depth, max_bins=max_bins, loss=SquareLoss()), xgboost_score),
+}
+
+
+### 取值数不超过max_bins时，直方图分裂和精确分裂的结果一致
+def check_equivalence(max_bins=255, max_depth=4):
+    for n_values in [2, 16, max_bins]:
+        X, ys = make_data(n_samples=400, n_features=6, n_values=n_values, seed=n_values)
+        for name, (create_tree, score) in TREES.items():
+            tree = create_tree(max_depth, max_bins)
+            tree.fit(X, ys[name])
+            y = ys[name].astype(np.float64) if name != 'classification' else ys[name]
+            exact_root = build_exact_tree(tree, score, X, y)
+            diff, ties = compare_tree(tree, score, tree.root, exact_root, X, y)
+            assert diff is None, '%s tree with %s distinct values differs from exact split at %s' % (name, n_values, diff)
+            print('%-15s %3s distinct values: same tree as exact split (%s nodes, %s tied splits)' % (name, n_values, count_nodes(tree.root), ties))
+
+
+### 直方图分裂在大数据上的拟合耗时，精确分裂只在exact_samples个样本上计时
+def benchmark(n_samples, n_features, max_depth, max_bins, exact_samples):
+    X, ys = make_data(n_samples, n_features, seed=1)
+    for name, (create_tree, score) in TREES.items():
+        tree = create_tree(max_depth, max_bins)
+        begin = time.time()
+        tree.fit(X, ys[name])
+        cost = time.time() - begin
+        print('%-15s histogram fit %s x %s, depth %s: %.2fs (%s nodes)' % (name, n_samples, n_features, max_depth, cost, count_nodes(tree.root)))
+
+        if exact_samples:
+            X_small, y_small = X[:exact_samples], ys[name][:exact_samples]
+            tree = create_tree(max_depth, max_bins)
+            begin = time.time()
+            tree.fit(X_small, y_small)
+            hist_cost = time.time() - begin
+            begin = time.time()
+            build_exact_tree(tree, score, X_small, y_small.astype(np.float64) if name != 'classification' else y_small)
+            exact_cost = time.time() - begin
+            print('%-15s %s x %s: histogram %.2fs, exact %.2fs' % (name, exact_samples, n_features, hist_cost, exact_cost))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='cart histogram split benchmark')
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--features', type=int, default=50)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--max-bins', type=int, default=255)
+    parser.add_argument('--exact-samples', type=int, default=500, help='精确分裂计时用的样本数，0表示不计时')
+    args = parser.parse_args()
+
+    check_equivalence(max_bins=args.max_bins)
+    benchmark(args.samples, args.features, args.max_depth, args.max_bins, args.exact_samples)
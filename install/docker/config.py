@@ -159,6 +159,20 @@ GET_FEATURE_FLAGS_FUNC = None
 UPLOAD_FOLDER = BASE_DIR + "/static/file/uploads/"
 DOWNLOAD_FOLDER = BASE_DIR + "/static/file/download/"
 DOWNLOAD_URL = "/static/file/download/"
+CSV_UPLOAD_FOLDER = '/data/k8s/kubeflow/global/csv_upload/'   # csv导入时上传文件的目录，web和worker需要共享
+CSV_UPLOAD_BATCH_SIZE = 1000   # csv导入时每批写入的行数
+CSV_UPLOAD_ASYNC_SIZE = 10 * 1024 * 1024   # 超过该大小(字节)的csv在celery中异步导入
+CSV_UPLOAD_MAX_ERRORS = 1000   # 异步导入时记录的错误行数上限
+CSV_UPLOAD_PROGRESS_TIMEOUT = 3600   # 异步导入进度的保留时长(秒)
+EXPORT_BATCH_SIZE = 5000   # 下载数据时每批从数据库读取和输出的行数
+SQLLAB_FETCH_SIZE = 10000   # sqllab查询时每批从远程数据库读取并写入结果文件的行数
+SQLLAB_ENGINE_POOL_SIZE = 5   # sqllab每个数据库连接串的连接池大小
+SQLLAB_MAX_ENGINES = 50   # sqllab每个进程最多缓存的数据库连接串数目
+LOG_READ_MAX_LINES = 10000   # 分页读取pod和任务日志时每页最多返回的行数
+LOG_READ_MAX_BYTES = 10 * 1024 * 1024   # 分页读取pod和任务日志时每页最多返回的字节数
+LOG_FANOUT_BUFFER_LINES = 1000   # 实时日志每个容器在内存中保留的最近行数，后打开的页面先看到这些日志
+LOG_FANOUT_IDLE_TIMEOUT = 60   # 实时日志没有人查看超过该时长(秒)后断开和kubelet的连接
+LOG_STREAM_MAX_SECONDS = 240   # 实时日志单个连接的最长时长(秒)，需要小于gunicorn的timeout，到时后浏览器自动重连并续传
 # The image upload folder, when using models with images
 IMG_UPLOAD_FOLDER = BASE_DIR + "/static/file/uploads/"
 
@@ -297,6 +311,7 @@ ENABLE_FLASK_COMPRESS = True
 
 # 任务的最小执行间隔min
 PIPELINE_TASK_CRON_RESOLUTION = 10
+PIPELINE_TEMPLATE_CACHE_SIZE = 1000   # workflow渲染时编译模板的缓存个数
 
 # Send bcc of all reports to this address. Set to None to disable.
 # This is useful for maintaining an audit trail of all email deliveries.
@@ -384,6 +399,8 @@ ENVIRONMENT=get_env_variable('ENVIRONMENT','DEV').lower()
 
 SQLALCHEMY_POOL_SIZE = 300
 SQLALCHEMY_POOL_RECYCLE = 300  # 超时重连， 必须小于数据库的超时终端时间
+SESSION_SCOPE_POOL_SIZE = 2   # celery worker和watch进程中session_scope每个进程的连接池大小
+SESSION_SCOPE_MAX_OVERFLOW = 10   # 连接池满时(例如多线程并发查询)最多额外创建的连接数，空闲后关闭
 SQLALCHEMY_MAX_OVERFLOW = 800
 SQLALCHEMY_TRACK_MODIFICATIONS=False
 
@@ -409,6 +426,19 @@ CACHE_CONFIG = {
     'CACHE_REDIS_URL':'redis://:%s@%s:%s/0'%(REDIS_PASSWORD,REDIS_HOST,str(REDIS_PORT)) if REDIS_PASSWORD else 'redis://%s:%s/1'%(REDIS_HOST,str(REDIS_PORT))   # 0，1为数据库编号（redis有0-16个数据库）
 }
 
+# memoized_func页面缓存，memory为进程内LRU缓存，redis为复用celery broker的redis在多个进程间共享
+MEMOIZE_BACKEND = 'memory'
+MEMOIZE_REDIS_URL = ''   # 为空时使用CELERY_CONFIG.broker_url
+MEMOIZE_MAX_SIZE = 1000   # 进程内缓存的最大条数
+MEMOIZE_DEFAULT_TIMEOUT = 600   # 默认缓存时长(秒)
+API_INFO_CACHE_TIMEOUT = 300   # 各页面_info接口按视图和角色缓存的时长(秒)，关联表变化时会提前失效
+LIST_COUNT_CACHE_TIMEOUT = 60   # 列表页list_count_mode=cached时总数的缓存时长(秒)
+PERMISSION_CACHE_TIMEOUT = 3600   # 用户权限集合的缓存时长(秒)，角色或权限变化时会提前失效
+USER_TOKEN_CACHE_TIMEOUT = 60   # 请求头中token对应用户的进程内缓存时长(秒)，0表示不缓存
+MENU_CACHE_TIMEOUT = 300   # 首页菜单的缓存时长(秒)
+SERVICE_LOAD_CACHE_TIMEOUT = 600   # 推理服务负载曲线的缓存时长(秒)，定时任务每5分钟刷新一次
+RESOURCE_OVERVIEW_CACHE_TIMEOUT = 30   # 整体资源页面图表的缓存时长(秒)
+
 class CeleryConfig(object):
     # 任务队列
     broker_url = 'redis://:%s@%s:%s/0'%(REDIS_PASSWORD,REDIS_HOST,str(REDIS_PORT)) if REDIS_PASSWORD else 'redis://%s:%s/0'%(REDIS_HOST,str(REDIS_PORT))
@@ -511,6 +541,14 @@ class CeleryConfig(object):
             "expires": 600,
             'max_retries': 0,
             "reject_on_worker_lost": False
+        },
+        # 采集机器资源快照，积压的任务直接过期，只需要最新的快照
+        'task.collect_node_resource': {
+            'rate_limit': '1/s',
+            'soft_time_limit': 60,
+            "expires": 10,
+            'max_retries': 0,
+            "reject_on_worker_lost": False
         }
     }
 
@@ -559,9 +597,17 @@ class CeleryConfig(object):
             'task': 'task.watch_pod_utilization',   # 定时推送低负载利用率的pod
             'schedule': crontab(minute='10',hour='11'),
         },
+        'task_update_service_load': {
+            'task': 'task.update_service_load',   # 定时刷新推理服务的负载曲线
+            'schedule': crontab(minute='*/5'),
+        },
         "task_check_pod_terminating": {
             "task": "task.check_pod_terminating",
             'schedule': crontab(minute='*/10'),
+        },
+        'task_collect_node_resource': {
+            'task': 'task.collect_node_resource',   # 定时采集机器资源快照，供整体资源页面读取
+            'schedule': 10.0,
         }
     }
 
@@ -914,6 +960,27 @@ SERVICE_DOMAIN='service.svc.cluster.local'
 CHATGPT_TOKEN = [""]
 CHATGPT_CHAT_URL = ['']
 
+# k8s client连接池配置，同一个kubeconfig在进程内复用同一个ApiClient
+K8S_CLIENT_POOL_MAXSIZE = 20   # 每个集群apiserver的最大复用连接数
+K8S_CLIENT_POOL_THREADS = 1   # 异步请求(async_req)使用的线程数
+
+# 多集群并发查询配置，单个集群超时只丢弃该集群的结果
+K8S_FANOUT_MAX_WORKERS = 16   # 并发查询的最大线程数
+K8S_FANOUT_TIMEOUT = 30   # 单个集群查询的超时时长(秒)
+K8S_LIST_PAGE_SIZE = 500   # 分页查询crd时每页的数量
+
+# k8s informer缓存，开启后pod/node/event/crd的查询从进程内watch维护的内存缓存中读取
+K8S_INFORMER_ENABLE = False
+K8S_INFORMER_MAX_STALENESS = 120   # 缓存超过多少秒未与apiserver同步，就回退为直接查询apiserver
+K8S_INFORMER_WATCH_TIMEOUT = 60   # 每次watch的超时时长，超时后基于resourceVersion继续watch
+K8S_INFORMER_CRDS = ['workflows', 'tfjobs', 'pytorchjobs']   # 使用缓存的crd
+
+# watch_workflow 事件批量处理配置，同一个workflow的多个事件只处理最新的一个
+WATCH_WORKFLOW_BATCH_SIZE = 100   # 每批最多处理的workflow数
+WATCH_WORKFLOW_BATCH_INTERVAL = 1   # 没有事件时的等待时长(秒)
+WATCH_TIMEOUT = 300   # watch_workflow/watch_service单次watch的时长，到期后从记录的resourceVersion继续watch
+
+NODE_RESOURCE_SNAPSHOT_MAX_AGE = 60   # 机器资源快照超过多少秒未更新(采集任务未运行)，就由web进程实时采集一次
 
 # 所有训练集群的信息
 CLUSTERS={
@@ -40,7 +40,7 @@ elif [ "$STAGE" = "dev" ]; then
 elif [ "$STAGE" = "prod" ]; then
   export FLASK_APP=myapp:app
   python myapp/check_tables.py
-  gunicorn --bind  0.0.0.0:80 --workers 20 --timeout 300 --limit-request-line 0 --limit-request-field_size 0 --log-level=info myapp:app
+  gunicorn --bind  0.0.0.0:80 --workers 20 --worker-class gthread --threads 8 --timeout 300 --limit-request-line 0 --limit-request-field_size 0 --log-level=info myapp:app
 else
     myapp --help
 fi
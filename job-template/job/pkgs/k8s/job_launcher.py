@@ -0,0 +1,175 @@
+# pytorch/tf/volcano等分布式任务launcher的公共逻辑：删除旧任务并等待真正删除完成，创建任务，watch任务状态直到结束，统计各阶段耗时
+# 全部基于watch事件，不再固定sleep和轮询
+import time
+import datetime
+import threading
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from job.pkgs.k8s.log_fanout import follow_job_logs
+
+
+def parse_time(value):
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class JobLauncher():
+
+    def __init__(self, k8s_client, crd_info, namespace, success_phases, failed_phases):
+        self.k8s_client = k8s_client
+        self.crd_info = crd_info
+        self.namespace = namespace
+        # 状态比较不区分大小写，volcano的状态有 Completed/completed 等不同写法
+        self.success_phases = [phase.lower() for phase in success_phases]
+        self.failed_phases = [phase.lower() for phase in failed_phases]
+        self.finished = threading.Event()
+        self.timings = {}
+
+    def list_func(self):
+        return self.k8s_client.CustomObjectsApi.list_namespaced_custom_object
+
+    def list_kwargs(self, name):
+        return {
+            "group": self.crd_info['group'],
+            "version": self.crd_info['version'],
+            "namespace": self.namespace,
+            "plural": self.crd_info['plural'],
+            "field_selector": 'metadata.name=%s' % name
+        }
+
+    def get_status(self, crd_object):
+        return self.k8s_client.get_crd_status(crd_object, self.crd_info['group'], self.crd_info['plural'])
+
+    # 删除任务并等待删除完成，name和labels二选一
+    def delete(self, name='', labels=None, timeout=300):
+        begin = time.time()
+        names = self.k8s_client.delete_crd(group=self.crd_info['group'], version=self.crd_info['version'], plural=self.crd_info['plural'], namespace=self.namespace, name=name, labels=labels)
+        for crd_name in names:
+            self.wait_deleted(crd_name, timeout=max(timeout - (time.time() - begin), 1))
+        print('delete %s cost %.1fs' % (names, time.time() - begin), flush=True)
+        return names
+
+    def wait_deleted(self, name, timeout=300):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            result = self.list_func()(**self.list_kwargs(name))
+            if not result.get('items'):
+                return True
+            w = watch.Watch()
+            for event in w.stream(self.list_func(), resource_version=result['metadata']['resourceVersion'], timeout_seconds=int(max(deadline - time.time(), 1)), **self.list_kwargs(name)):
+                if event['type'] == 'DELETED':
+                    w.stop()
+                    return True
+        print('wait %s deleted timeout' % name, flush=True)
+        return False
+
+    def create(self, body):
+        self.timings['create_time'] = time.time()
+        return self.k8s_client.create_crd(group=self.crd_info['group'], version=self.crd_info['version'], plural=self.crd_info['plural'], namespace=self.namespace, body=body)
+
+    # watch任务状态，出现结束状态立即返回最终状态。任务被删除时返回空字符串
+    def wait(self, name, timeout=None):
+        timeout = timeout or self.crd_info.get('timeout', 60 * 60 * 24 * 2)
+        deadline = time.time() + timeout
+        status = ''
+        try:
+            while time.time() < deadline:
+                result = self.list_func()(**self.list_kwargs(name))
+                if not result.get('items'):
+                    print('%s not exist' % name, flush=True)
+                    return ''
+                events = [{"type": "ADDED", "object": result['items'][0]}]
+                resource_version = result['metadata']['resourceVersion']
+                w = watch.Watch()
+                try:
+                    stream = w.stream(self.list_func(), resource_version=resource_version, timeout_seconds=int(min(max(deadline - time.time(), 1), 600)), **self.list_kwargs(name))
+                    for event in self.chain(events, stream):
+                        if event['type'] == 'DELETED':
+                            print('%s deleted' % name, flush=True)
+                            return ''
+                        if event['type'] == 'ERROR':
+                            break
+                        new_status = self.get_status(event['object'])
+                        if new_status != status:
+                            status = new_status
+                            print('%s status %s %s' % (name, status, datetime.datetime.now()), flush=True)
+                        if status.lower() in self.success_phases + self.failed_phases:
+                            w.stop()
+                            return status
+                except ApiException as e:
+                    # resourceVersion过期，重新list后继续watch
+                    if e.status != 410:
+                        raise e
+            print('wait %s timeout' % name, flush=True)
+            return status
+        finally:
+            self.timings['finish_time'] = time.time()
+            self.finished.set()
+
+    @staticmethod
+    def chain(events, stream):
+        for event in events:
+            yield event
+        for event in stream:
+            yield event
+
+    def is_success(self, status):
+        return status.lower() in self.success_phases
+
+    # 各pod的调度、拉取镜像、运行耗时。调度：创建到PodScheduled，拉镜像：调度到第一个容器启动(包含init容器)，运行：容器启动到结束
+    def pod_timings(self, name):
+        timings = {}
+        for pod in self.k8s_client.v1.list_namespaced_pod(self.namespace).items:
+            if not pod.metadata.name.startswith(name):
+                continue
+            created = parse_time(pod.metadata.creation_timestamp)
+            scheduled = None
+            for condition in pod.status.conditions or []:
+                if condition.type == 'PodScheduled' and condition.status == 'True':
+                    scheduled = parse_time(condition.last_transition_time)
+            started, finished = None, None
+            for container_status in pod.status.container_statuses or []:
+                state = container_status.state
+                if state.running:
+                    started = min(started or time.time(), parse_time(state.running.started_at))
+                elif state.terminated:
+                    started = min(started or time.time(), parse_time(state.terminated.started_at))
+                    finished = max(finished or 0, parse_time(state.terminated.finished_at))
+            timings[pod.metadata.name] = {
+                "scheduling": round(scheduled - created, 1) if scheduled and created else None,
+                "image_pull": round(started - scheduled, 1) if started and scheduled else None,
+                "run": round((finished or time.time()) - started, 1) if started else None
+            }
+        return timings
+
+    def report(self, name):
+        try:
+            for pod_name, timing in self.pod_timings(name).items():
+                print('pod %s scheduling %ss, image pull %ss, run %ss' % (pod_name, timing['scheduling'], timing['image_pull'], timing['run']), flush=True)
+        except Exception as e:
+            print('get pod timings error: %s' % e, flush=True)
+        if 'create_time' in self.timings and 'finish_time' in self.timings:
+            print('job %s total cost %.1fs' % (name, self.timings['finish_time'] - self.timings['create_time']), flush=True)
+
+    # 删除旧任务，创建新任务，跟踪日志直到任务结束，返回最终状态
+    def launch(self, name, body, run_id='', exclude_containers=()):
+        if run_id:
+            print('delete old %s, run-id %s' % (self.crd_info['plural'], run_id), flush=True)
+            self.delete(labels={"run-id": run_id})
+        self.delete(name=name)
+        print('create new %s %s' % (self.crd_info['plural'], name), flush=True)
+        self.create(body)
+
+        # 后台实时打印日志，任务结束后读完剩余日志再退出
+        line = '>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
+        print('begin follow log\n%s' % line, flush=True)
+        log_thread = threading.Thread(target=follow_job_logs, args=(self.k8s_client, self.namespace, name, self.finished), kwargs={"exclude_containers": exclude_containers}, daemon=True)
+        log_thread.start()
+        status = self.wait(name)
+        log_thread.join()
+        print('%s\nend follow log' % line, flush=True)
+        self.report(name)
+        return status
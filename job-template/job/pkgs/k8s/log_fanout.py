@@ -0,0 +1,289 @@
+# 任务日志分发：每个(pod, container)只保持一个follow连接，分发给launcher打印、归档等多个订阅者，替代stern进程
+# 和 myapp/utils/py/py_log.py 保持一致，job镜像中不包含myapp，所以单独一份
+import re
+import time
+import uuid
+import codecs
+import datetime
+import logging
+import threading
+from collections import deque
+from urllib3.exceptions import ReadTimeoutError
+
+# ANSI 转义序列
+ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
+
+# 换行符，\r单独出现时(例如进度条)也作为一行结束
+line_break = re.compile(r'\r\n|\r|\n')
+
+
+# 把字节块拆成去除了ANSI转义序列的行，统一以\n结尾。跨块的多字节字符和半行由缓冲区拼接，
+# 只扫描新到的块，超过max_line_size仍没有换行的内容直接作为一行输出，缓冲区大小有上限
+def iter_log_lines(chunks, encoding='utf-8', max_line_size=64 * 1024):
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = []
+    pending_size = 0
+    last_cr = False
+    for chunk in chunks:
+        if not chunk:
+            continue
+        text = decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        # \r\n 被拆到了两个块中
+        if last_cr and text.startswith('\n'):
+            text = text[1:]
+        if not text:
+            last_cr = False
+            continue
+        last_cr = text.endswith('\r')
+        parts = line_break.split(text)
+        for part in parts[:-1]:
+            pending.append(part)
+            yield ansi_escape.sub('', ''.join(pending)) + '\n'
+            pending, pending_size = [], 0
+        if parts[-1]:
+            pending.append(parts[-1])
+            pending_size += len(parts[-1])
+            if pending_size >= max_line_size:
+                yield ansi_escape.sub('', ''.join(pending)) + '\n'
+                pending, pending_size = [], 0
+    rest = ''.join(pending) + decoder.decode(b'', final=True)
+    if rest:
+        yield ansi_escape.sub('', rest)
+
+
+class LogStream():
+    """一个(pod, container)的实时日志，只保持一个follow连接，分发给多个订阅者
+
+    follow_func(since_seconds=None, tail_lines=None, request_timeout=None) 返回带时间戳(timestamps=True)的follow响应，
+    request_timeout作为读取超时，容器长时间没有输出时连接也会定期返回，以便检查是否还有订阅者，
+    alive_func() 返回容器是否还在运行。连接断开但容器还在运行时从最后一行的时间继续读取并跳过重复行，
+    最近的日志保存在有界的环形缓冲区中，后加入的订阅者先补读缓冲区，读得太慢的订阅者会跳过被覆盖的行。
+    没有订阅者超过idle_timeout秒后停止follow。
+    每一行有事件id "token:seq:日志时间"，订阅者断线重连时带上最后收到的事件id，从该位置继续，不会重复推送缓冲区。
+    日志流只在当前进程内共享，重连到其他进程(或者日志流已经重建)时token不同，按日志时间跳过已经收到的行。
+    """
+
+    def __init__(self, key, follow_func, alive_func=None, buffer_lines=1000, tail_lines=None, idle_timeout=60, read_timeout=30):
+        self.key = key
+        self.follow_func = follow_func
+        self.alive_func = alive_func
+        self.tail_lines = tail_lines
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.token = uuid.uuid4().hex[:8]
+        self.buffer = deque(maxlen=buffer_lines)   # (seq, 日志时间, line)
+        self.seq = 0
+        self.subscribers = 0
+        self.idle_since = time.time()
+        self.finished = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='log-stream-%s' % '/'.join(key), daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def publish(self, line, log_time=''):
+        with self.cond:
+            self.seq += 1
+            self.buffer.append((self.seq, log_time, line))
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def idle(self):
+        with self.cond:
+            return not self.subscribers and time.time() - self.idle_since > self.idle_timeout
+
+    def is_alive(self):
+        if not self.alive_func:
+            return False
+        try:
+            return self.alive_func()
+        except Exception as e:
+            logging.error('check log stream %s alive error: %s', self.key, e)
+            return True
+
+    def run(self):
+        last_time = ''
+        try:
+            while not self.idle():
+                response = None
+                try:
+                    if last_time:
+                        since = datetime.datetime.strptime(last_time[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+                        since_seconds = int((datetime.datetime.now(datetime.timezone.utc) - since).total_seconds()) + 1
+                        response = self.follow_func(since_seconds=max(since_seconds, 1), request_timeout=(10, self.read_timeout))
+                    else:
+                        response = self.follow_func(tail_lines=self.tail_lines, request_timeout=(10, self.read_timeout))
+                    for line in iter_log_lines(response.stream(64 * 1024)):
+                        log_time, message = split_log_time(line)
+                        # 重连时跳过已经读取过的行
+                        if log_time and last_time and log_time <= last_time:
+                            continue
+                        last_time = log_time or last_time
+                        self.publish(message, log_time)
+                        if self.idle():
+                            break
+                except ReadTimeoutError:
+                    # 一段时间没有新日志，回到循环开头检查是否还有订阅者，还有订阅者就从最后一行的时间继续读取
+                    pass
+                except Exception as e:
+                    logging.error('follow log %s error: %s', self.key, e)
+                    time.sleep(5)
+                finally:
+                    if response is not None:
+                        response.close()
+                        response.release_conn()
+                if not self.is_alive():
+                    break
+        finally:
+            self.finish()
+
+    def event_id(self, item):
+        return '%s:%s:%s' % (self.token, item[0], item[1])
+
+    # 订阅的起始位置：按事件id续传，否则replay为True时从缓冲区开头开始
+    def start_seq(self, replay, last_event_id):
+        if last_event_id:
+            token, _, rest = last_event_id.partition(':')
+            seq, _, log_time = rest.partition(':')
+            if token == self.token and seq.isdigit():
+                return min(int(seq), self.seq)
+            if log_time:
+                for item in self.buffer:
+                    if item[1] and item[1] > log_time:
+                        return item[0] - 1
+                return self.seq
+        if replay and self.buffer:
+            return self.buffer[0][0] - 1
+        return self.seq
+
+    # 订阅日志，replay为True时先补读缓冲区中的日志，last_event_id为断线前最后收到的事件id。
+    # 等待超过heartbeat秒没有新日志时返回空字符串，调用方可以借此检查连接。with_id为True时返回(事件id, 行)，心跳和跳过提示的事件id为None
+    def subscribe(self, replay=True, heartbeat=15, last_event_id=None, with_id=False):
+        with self.cond:
+            self.subscribers += 1
+            seq = self.start_seq(replay, last_event_id)
+        try:
+            while True:
+                with self.cond:
+                    if self.seq <= seq and not self.finished:
+                        self.cond.wait(heartbeat)
+                    lines = [item for item in self.buffer if item[0] > seq]
+                    finished = self.finished
+                if lines:
+                    if lines[0][0] > seq + 1:
+                        skip = '...... skip %s lines ......\n' % (lines[0][0] - seq - 1)
+                        yield (None, skip) if with_id else skip
+                    seq = lines[-1][0]
+                    for item in lines:
+                        yield (self.event_id(item), item[2]) if with_id else item[2]
+                elif finished:
+                    return
+                else:
+                    yield (None, '') if with_id else ''
+        finally:
+            with self.cond:
+                self.subscribers -= 1
+                if not self.subscribers:
+                    self.idle_since = time.time()
+
+
+class LogFanout():
+    """进程内的日志分发中心，同一个(namespace, pod, container)只读取一次kubelet日志
+
+    只在当前进程内共享，多进程部署(例如gunicorn的多个worker)时每个进程各自维护一份
+    """
+
+    def __init__(self, buffer_lines=1000, tail_lines=None, idle_timeout=60, read_timeout=30):
+        self.buffer_lines = buffer_lines
+        self.tail_lines = tail_lines
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def get_stream(self, key, follow_func, alive_func=None):
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream is None or stream.finished:
+                stream = LogStream(key, follow_func, alive_func, buffer_lines=self.buffer_lines, tail_lines=self.tail_lines, idle_timeout=self.idle_timeout, read_timeout=self.read_timeout)
+                self.streams[key] = stream
+                stream.start()
+            # 清理已经结束的日志流
+            for old_key in [old_key for old_key, old_stream in self.streams.items() if old_stream.finished and old_key != key]:
+                del self.streams[old_key]
+            return stream
+
+    def subscribe(self, key, follow_func, alive_func=None, replay=True, heartbeat=15, last_event_id=None, with_id=False):
+        return self.get_stream(key, follow_func, alive_func).subscribe(replay=replay, heartbeat=heartbeat, last_event_id=last_event_id, with_id=with_id)
+
+
+# 跟踪任务所有pod的日志并按stern的格式打印 "pod名 日志"，直到stop_event被设置且所有容器的日志读完
+# pod按名称前缀匹配，新创建的pod每interval秒发现一次
+def follow_job_logs(k8s_client, namespace, name, stop_event, exclude_containers=(), interval=10, fanout=None, output=None):
+    fanout = fanout or LogFanout(buffer_lines=1000)
+    output = output or (lambda pod_name, line: print('%s %s' % (pod_name, line), end='', flush=True))
+    threads = {}
+
+    def follow(pod_name, container_name):
+        def follow_func(since_seconds=None, tail_lines=None, request_timeout=None):
+            return k8s_client.v1.read_namespaced_pod_log(
+                name=pod_name,
+                namespace=namespace,
+                container=container_name,
+                follow=True,
+                timestamps=True,
+                _preload_content=False,
+                since_seconds=since_seconds,
+                tail_lines=tail_lines,
+                _request_timeout=request_timeout
+            )
+
+        def alive_func():
+            try:
+                pod = k8s_client.v1.read_namespaced_pod(name=pod_name, namespace=namespace)
+            except Exception as e:
+                if getattr(e, 'status', None) == 404:
+                    return False
+                raise e
+            if pod.status.phase in ['Succeeded', 'Failed']:
+                return False
+            for container_status in (pod.status.init_container_statuses or []) + (pod.status.container_statuses or []):
+                if container_status.name == container_name and container_status.state and container_status.state.terminated:
+                    return False
+            return True
+
+        for line in fanout.subscribe((namespace, pod_name, container_name), follow_func, alive_func):
+            if line:
+                output(pod_name, line)
+
+    while True:
+        finished = stop_event.is_set()
+        try:
+            pods = k8s_client.v1.list_namespaced_pod(namespace).items
+        except Exception as e:
+            logging.error('list pods of %s error: %s', name, e)
+            pods = []
+        for pod in pods:
+            if not pod.metadata.name.startswith(name):
+                continue
+            for container in (pod.spec.init_containers or []) + (pod.spec.containers or []):
+                key = (pod.metadata.name, container.name)
+                if container.name in exclude_containers or key in threads:
+                    continue
+                thread = threading.Thread(target=follow, args=key, daemon=True)
+                thread.start()
+                threads[key] = thread
+        if finished:
+            break
+        stop_event.wait(interval)
+
+    # 任务结束后等待剩余日志读完，所有线程共用60秒，不是每个线程各等60秒
+    deadline = time.time() + 60
+    for thread in threads.values():
+        thread.join(max(deadline - time.time(), 0))
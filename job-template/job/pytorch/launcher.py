@@ -13,13 +13,13 @@ import pysnooper
 import os,sys
 import re
 import threading
-import psutil
 import copy
 
 from kubernetes import client
 
 # print(os.environ)
 from job.pkgs.k8s.py_k8s import K8s
+from job.pkgs.k8s.job_launcher import JobLauncher
 k8s_client = K8s()
 
 KFJ_NAMESPACE = os.getenv('KFJ_NAMESPACE', '')
@@ -108,61 +108,6 @@ def run_shell(shell):
 
 
 
-# 监控指定名称的pytorchjob
-def monitoring(crd_k8s,name,namespace):
-    time.sleep(10)
-    # 杀掉stern 进程
-    def get_pid(name):
-        '''
-         作用：根据进程名获取进程pid
-        '''
-        pids = psutil.process_iter()
-        print("[" + name + "]'s pid is:", flush=True)
-        back=[]
-        for pid in pids:
-            if name in pid.name():
-                print(pid.pid, flush=True)
-                back.append(pid.pid)
-        return back
-    check_time = datetime.datetime.now()
-    while(True):
-        pytorchjob = crd_k8s.get_one_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=namespace,name=name)
-        if pytorchjob:
-            print('pytorchjob status %s'%pytorchjob['status'], flush=True)
-        else:
-            print('pytorchjob not exist', flush=True)
-
-        # 如果结束就kill stern，主进程继续
-        if pytorchjob and (pytorchjob['status']=="Succeeded" or pytorchjob['status']=="Failed"):    # Created, Running, Restarting, Succeeded, or Failed
-            pids = get_pid("stern")
-            if pids:
-                for pid in pids:
-                    pro = psutil.Process(int(pid))
-                    pro.terminate()
-                    print('kill process %s'%pid, flush=True)
-            break
-        else:
-
-            labels={
-                "pipeline-id": KFJ_PIPELINE_ID,
-                "task-id": KFJ_TASK_ID,
-                "run-id": KFJ_RUN_ID,
-            }
-            # pods = crd_k8s.get_pods(namespace=namespace,labels=labels)
-
-        # 因为stern 过几个小时就会崩溃，日志不再跟踪，但不报错，所以这里主动kill
-        if (datetime.datetime.now()-check_time).total_seconds()>3600:
-            pids = get_pid("stern")
-            if pids:
-                for pid in pids:
-                    pro = psutil.Process(int(pid))
-                    pro.terminate()
-                    print('kill process %s'%pid, flush=True)
-            check_time=datetime.datetime.now()
-        time.sleep(60)
-
-
-
 # @pysnooper.snoop()
 def make_pytorchjob(name,num_workers,image,working_dir,command):
     # if type(command)==str:
@@ -334,42 +279,13 @@ def get_pytorchjob_pod():
 
 # @pysnooper.snoop()
 def launch_pytorchjob(name, num_workers, image,working_dir, worker_command):
-    if KFJ_RUN_ID:
-        print('delete old pytorch, run-id %s'%KFJ_RUN_ID, flush=True)
-        k8s_client.delete_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=KFJ_NAMESPACE,labels={"run-id":KFJ_RUN_ID})
-        time.sleep(10)
-    # 删除旧的pytorch
-    k8s_client.delete_crd(group=crd_info['group'], version=crd_info['version'], plural=crd_info['plural'],namespace=KFJ_NAMESPACE, name=name)
-    time.sleep(10)
-    # 创建新的pytorch
+    # 删除旧任务并等待删除完成，创建新任务，watch任务状态并实时打印日志，直到任务结束
     pytorchjob_json = make_pytorchjob(name=name,num_workers= num_workers,image = image,working_dir=working_dir,command=worker_command)
-    print('create new pytorch %s' % name, flush=True)
-    k8s_client.create_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=KFJ_NAMESPACE,body=pytorchjob_json)
-    time.sleep(10)
-
-    print('begin start monitoring thread', flush=True)
-    # # 后台启动监控脚本
-    monitoring_thread = threading.Thread(target=monitoring,args=(k8s_client,name,KFJ_NAMESPACE))
-    monitoring_thread.start()
-    while True:
-        # 实时打印日志
-        line='>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-        print('begin follow log\n%s'%line, flush=True)
-        command = '''stern %s --namespace %s --exclude-container init-pytorch --since 10s --template '{{.PodName}} {{.Message}} {{"\\n"}}' '''%(name,KFJ_NAMESPACE)
-
-        print(command, flush=True)
-        run_shell(command)
-        print('%s\nend follow log'%line, flush=True)
-        time.sleep(10)
-
-        pytorchjob = k8s_client.get_one_crd(group=crd_info['group'], version=crd_info['version'],plural=crd_info['plural'], namespace=KFJ_NAMESPACE, name=name)
-        if pytorchjob and (pytorchjob['status'] == "Succeeded" or pytorchjob['status'] == "Failed"):
-            break
-
-    pytorchjob = k8s_client.get_one_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=KFJ_NAMESPACE,name=name)
-    print("pytorchJob %s finished, status %s"%(name, pytorchjob['status']))
+    launcher = JobLauncher(k8s_client, crd_info, KFJ_NAMESPACE, success_phases=['Succeeded'], failed_phases=['Failed'])
+    status = launcher.launch(name, pytorchjob_json, run_id=KFJ_RUN_ID, exclude_containers=['init-pytorch'])
+    print("pytorchJob %s finished, status %s"%(name, status))
 
-    if pytorchjob['status']!='Succeeded':
+    if not launcher.is_success(status):
         exit(1)
 
 
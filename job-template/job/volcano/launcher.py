@@ -13,13 +13,13 @@ import pysnooper
 import os,sys
 import re
 import threading
-import psutil
 import copy
 
 from kubernetes import client
 
 # print(os.environ)
 from job.pkgs.k8s.py_k8s import K8s
+from job.pkgs.k8s.job_launcher import JobLauncher
 k8s_client = K8s()
 
 KFJ_NAMESPACE = os.getenv('KFJ_NAMESPACE', '')
@@ -106,51 +106,6 @@ def run_shell(shell):
 
 
 
-# 监控指定名称的volcanojob
-def monitoring(crd_k8s,name,namespace):
-    time.sleep(10)
-    # 杀掉stern 进程
-    def get_pid(name):
-        '''
-         作用：根据进程名获取进程pid
-        '''
-        pids = psutil.process_iter()
-        print("[" + name + "]'s pid is:", flush=True)
-        back=[]
-        for pid in pids:
-            if name in pid.name():
-                print(pid.pid, flush=True)
-                back.append(pid.pid)
-        return back
-    check_time = datetime.datetime.now()
-    while(True):
-        volcanojob = crd_k8s.get_one_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=namespace,name=name)
-        status = volcanojob['status'].lower()
-        if volcanojob:
-            print('volcanojob status %s'%volcanojob['status'], flush=True)
-        else:
-            print('volcanojob not exist', flush=True)
-
-        if volcanojob and (status=="completed" or status=="failed" or status=='aborted' or status=='terminated'):    # Created, Running, Restarting, Completed, or Failed
-            pids = get_pid("stern")
-            if pids:
-                for pid in pids:
-                    pro = psutil.Process(int(pid))
-                    pro.terminate()
-                    print('kill process %s'%pid, flush=True)
-            break
-        if (datetime.datetime.now()-check_time).total_seconds()>3600:
-            pids = get_pid("stern")
-            if pids:
-                for pid in pids:
-                    pro = psutil.Process(int(pid))
-                    pro.terminate()
-                    print('kill process %s'%pid, flush=True)
-            check_time=datetime.datetime.now()
-        time.sleep(60)
-
-
-
 # @pysnooper.snoop()
 def make_volcanojob(name,num_workers,image,working_dir,command):
     # if type(command)==str:
@@ -303,42 +258,14 @@ def make_volcanojob(name,num_workers,image,working_dir,command):
 
 # @pysnooper.snoop()
 def launch_volcanojob(name, num_workers, image,working_dir, worker_command):
-    if KFJ_RUN_ID:
-        print('delete old volcanojob, run-id %s'%KFJ_RUN_ID, flush=True)
-        k8s_client.delete_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=KFJ_NAMESPACE,labels={"run-id":KFJ_RUN_ID})
-        time.sleep(10)
-    # 删除旧的volcanojob
-    k8s_client.delete_crd(group=crd_info['group'], version=crd_info['version'], plural=crd_info['plural'],namespace=KFJ_NAMESPACE, name=name)
-    time.sleep(10)
-    # 创建新的volcanojob
+    # 删除旧任务并等待删除完成，创建新任务，watch任务状态并实时打印日志，直到任务结束
     volcanojob_json = make_volcanojob(name=name,num_workers= num_workers,image = image,working_dir=working_dir,command=worker_command)
     print(volcanojob_json)
-    print('create new volcanojob %s' % name, flush=True)
-    k8s_client.create_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=KFJ_NAMESPACE,body=volcanojob_json)
-    time.sleep(10)
-
-    print('begin start monitoring thread', flush=True)
-    # # 后台启动监控脚本
-    monitoring_thread = threading.Thread(target=monitoring,args=(k8s_client,name,KFJ_NAMESPACE))
-    monitoring_thread.start()
-    while True:
-        # 实时打印日志,由于stern跟踪时长有限制，所以会每个小时重启一次ster进程
-        line='>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>'
-        print('begin follow log\n%s %s'%(line,datetime.datetime.now()), flush=True)
-        command = '''stern %s --namespace %s --since 10s --template '{{.PodName}} {{.Message}} {{"\\n"}}' '''%(name,KFJ_NAMESPACE)
-        print(command, flush=True)
-        run_shell(command)
-        print('%s %s\nend follow log'%(line,datetime.datetime.now()), flush=True)
-        time.sleep(10)
-
-        volcanojob = k8s_client.get_one_crd(group=crd_info['group'], version=crd_info['version'],plural=crd_info['plural'], namespace=KFJ_NAMESPACE, name=name)
-        if volcanojob and (volcanojob['status'] == "Completed" or volcanojob['status'] == "Failed"):
-            break
-
-    volcanojob = k8s_client.get_one_crd(group=crd_info['group'],version=crd_info['version'],plural=crd_info['plural'],namespace=KFJ_NAMESPACE,name=name)
-    print("volcanojob %s finished, status %s"%(name, volcanojob['status']))
+    launcher = JobLauncher(k8s_client, crd_info, KFJ_NAMESPACE, success_phases=['Completed'], failed_phases=['Failed', 'Aborted', 'Terminated'])
+    status = launcher.launch(name, volcanojob_json, run_id=KFJ_RUN_ID)
+    print("volcanojob %s finished, status %s"%(name, status))
 
-    if volcanojob['status']!='Completed':
+    if not launcher.is_success(status):
         exit(1)
 
 
@@ -31,6 +31,10 @@ class NullValueException(MyappException):
     status = 400
 
 
+class InvalidCursorException(MyappException):
+    status = 400
+
+
 class MyappTemplateException(MyappException):
     pass
 
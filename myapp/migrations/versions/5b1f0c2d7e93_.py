@@ -0,0 +1,79 @@
+"""workflow label columns
+
+Revision ID: 5b1f0c2d7e93
+Revises: c347941bd412
+Create Date: 2024-04-20 10:12:41.532108
+
+"""
+import json
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5b1f0c2d7e93'
+down_revision = 'c347941bd412'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('workflow', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('pipeline_id', sa.Integer(), nullable=True, comment='任务流id'))
+        batch_op.add_column(sa.Column('run_id', sa.String(length=100), nullable=True, comment='run id'))
+        batch_op.add_column(sa.Column('schedule_type', sa.String(length=100), nullable=True, comment='调度类型，crontab或once'))
+        batch_op.create_index('ix_workflow_pipeline_id', ['pipeline_id'], unique=False)
+        batch_op.create_index('ix_workflow_run_id', ['run_id'], unique=False)
+        batch_op.create_index('ix_workflow_schedule_type', ['schedule_type'], unique=False)
+
+    with op.batch_alter_table('run', schema=None) as batch_op:
+        batch_op.create_index('ix_run_run_id', ['run_id'], unique=False)
+
+    # 从labels中回填历史数据，分批读取避免一次加载整张表
+    connection = op.get_bind()
+    workflow = sa.table(
+        'workflow',
+        sa.column('id', sa.Integer),
+        sa.column('labels', sa.Text),
+        sa.column('pipeline_id', sa.Integer),
+        sa.column('run_id', sa.String),
+        sa.column('schedule_type', sa.String)
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([workflow.c.id, workflow.c.labels]).where(workflow.c.id > last_id).order_by(workflow.c.id).limit(1000)
+        ).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            try:
+                labels = json.loads(row.labels) if row.labels else {}
+            except Exception:
+                labels = {}
+            pipeline_id = str(labels.get('pipeline-id', '')).strip()
+            connection.execute(
+                workflow.update().where(workflow.c.id == row.id).values(
+                    pipeline_id=int(pipeline_id) if pipeline_id.isdigit() else None,
+                    run_id=labels.get('run-id', ''),
+                    schedule_type='crontab' if labels.get('schedule_type', 'once') in ['crontab', 'contab'] else 'once'
+                )
+            )
+        last_id = rows[-1].id
+
+    # 没有schedule_type标签的历史数据，有调度记录的即为定时调度
+    connection.execute(sa.text(
+        "UPDATE workflow SET schedule_type='crontab' WHERE run_id != '' AND run_id IN (SELECT run_id FROM run WHERE run_id IS NOT NULL)"
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('run', schema=None) as batch_op:
+        batch_op.drop_index('ix_run_run_id')
+
+    with op.batch_alter_table('workflow', schema=None) as batch_op:
+        batch_op.drop_index('ix_workflow_schedule_type')
+        batch_op.drop_index('ix_workflow_run_id')
+        batch_op.drop_index('ix_workflow_pipeline_id')
+        batch_op.drop_column('schedule_type')
+        batch_op.drop_column('run_id')
+        batch_op.drop_column('pipeline_id')
@@ -19,7 +19,7 @@ from myapp import app,db
 from myapp.models.helpers import ImportMixin
 from myapp.models.model_team import Project
 import pysnooper
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, event
 from flask_appbuilder.models.decorators import renders
 from flask import Markup,request
 from myapp.models.base import MyappModelBase
@@ -578,7 +578,7 @@ class RunHistory(Model,MyappModelBase):
     pipeline_argo_id = Column(String(100),comment='任务流 argo id')   # 上传的pipeline id
     version_id = Column(String(100),comment='上传的版本号')        #
     experiment_id = Column(String(100),comment='实验id')
-    run_id = Column(String(100),comment='run id')
+    run_id = Column(String(100), index=True, comment='run id')
     message = Column(Text, default='',comment='消息')
     created_on = Column(DateTime, default=datetime.datetime.now, nullable=False,comment='创建时间')
     execution_date=Column(String(200), nullable=False,comment='执行时间')
@@ -677,6 +677,19 @@ class Crd:
 
 class Workflow(Model,Crd,MyappModelBase):
     __tablename__ = 'workflow'
+    # 从labels中提取的字段，保存时自动填充，用于按任务流和运行id建索引查询
+    pipeline_id = Column(Integer, index=True, comment='任务流id')
+    run_id = Column(String(100), index=True, default='', comment='run id')
+    schedule_type = Column(String(100), index=True, default='once', comment='调度类型，crontab或once')
+
+    # 根据labels填充提取字段
+    def set_label_columns(self):
+        labels = json.loads(self.labels) if self.labels else {}
+        pipeline_id = str(labels.get('pipeline-id', '')).strip()
+        self.pipeline_id = int(pipeline_id) if pipeline_id.isdigit() else None
+        self.run_id = labels.get('run-id', '')
+        # 定时调度的label值历史上写作contab
+        self.schedule_type = 'crontab' if labels.get('schedule_type', 'once') in ['crontab', 'contab'] else 'once'
 
     @property
     def namespace_url(self):
@@ -689,22 +702,12 @@ class Workflow(Model,Crd,MyappModelBase):
 
     @property
     def run_history(self):
-        label = json.loads(self.labels) if self.labels else {}
-        runid = label.get('run-id','')
+        runid = self.run_id
         if runid:
-            return db.session.query(RunHistory).filter(RunHistory.pipeline_file.contains(runid)).first()
-            # return db.session.query(RunHistory).filter_by(run_id=runid).first()
+            return db.session.query(RunHistory).filter_by(run_id=runid).first()
         else:
             return None
 
-    @property
-    def schedule_type(self):
-        run_history = self.run_history
-        if run_history:
-            return 'crontab'
-        else:
-            return 'once'
-
 
     @property
     def execution_date(self):
@@ -821,6 +824,16 @@ class Workflow(Model,Crd,MyappModelBase):
         return Markup(f'<a href="/workflow_modelview/stop/{self.id}">{__("停止")}</a>')
 
 
+# 新增或修改workflow时，从labels中提取pipeline_id，run_id，schedule_type
+@event.listens_for(Workflow, 'before_insert')
+@event.listens_for(Workflow, 'before_update')
+def workflow_set_label_columns(mapper, connection, target):
+    try:
+        target.set_label_columns()
+    except Exception as e:
+        print(e)
+
+
 class Tfjob(Model,Crd,MyappModelBase):
     __tablename__ = 'tfjob'
 
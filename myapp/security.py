@@ -1,5 +1,8 @@
 from flask_login import current_user
 import logging
+import hashlib
+import re
+import time
 import jwt
 
 from flask_babel import lazy_gettext
@@ -27,7 +30,9 @@ from flask_appbuilder.security.views import expose
 from flask import g, flash, request
 
 from flask_appbuilder.security.sqla.models import assoc_permissionview_role
-from sqlalchemy import select
+from sqlalchemy import select, event, inspect
+from sqlalchemy.orm import Session
+from myapp.utils.cache import LRUCache, get_memoize_backend
 from flask_appbuilder.const import (
     AUTH_DB,
     AUTH_LDAP,
@@ -312,6 +317,42 @@ class UserInfoEditView(SimpleFormView):
 
 from myapp.project import MyCustomRemoteUserView
 from myapp.project import Myauthdbview
+# 认证头到用户id的进程内短时缓存，避免每次请求都解析jwt和按用户名查询
+header_user_cache = LRUCache(max_size=10000, timeout=60)
+PERMISSION_VERSION_KEY = 'security/permission_version'
+
+
+# 角色，权限，或者用户的角色有变化时，更新权限版本号，所有用户的权限缓存失效
+# flush时只记录到session.info，事务提交后才更新版本号，避免其他请求在提交前用旧数据重建缓存，回滚时丢弃
+def mark_permission_changed(session):
+    session.info['permission_changed'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def mark_permission_changed_on_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (ab_models.Role, ab_models.PermissionView, ab_models.ViewMenu, ab_models.Permission)):
+            mark_permission_changed(session)
+            return
+        if isinstance(obj, User):
+            if obj in session.new or obj in session.deleted or inspect(obj).attrs.roles.history.has_changes():
+                mark_permission_changed(session)
+                return
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_permission_version_on_commit(session):
+    if session.info.pop('permission_changed', False):
+        MyappSecurityManager.bump_permission_version()
+
+
+@event.listens_for(Session, 'after_rollback')
+def clear_permission_changed_on_rollback(session):
+    # savepoint回滚时外层事务的修改还在，不清理
+    if not session.in_nested_transaction():
+        session.info.pop('permission_changed', None)
+
+
 # myapp自带的角色和角色权限，自定义了各种权限
 # 基础类fab-Security-Manager中 def load_user(self, pk):  是用来认证用户的
 # before_request是user赋值给g.user
@@ -349,11 +390,23 @@ class MyappSecurityManager(SecurityManager):
         # if 'token' in request.headers:
         #     token = request.headers['token']
         if authorization_value:
+            # 短时间内同一个认证头，直接使用缓存的用户id
+            cache_key = hashlib.md5(authorization_value.encode('utf-8')).hexdigest()
+            hit, user_id = header_user_cache.get(cache_key)
+            if hit:
+                user = self.get_user_by_id(user_id)
+                if user:
+                    g.user = user
+                    return user
+            timeout = current_app.config.get('USER_TOKEN_CACHE_TIMEOUT', 60)
+
             # rtx 免认证
             if len(authorization_value) < 20:
                 username = authorization_value
                 if username:
                     user = self.find_user(username)
+                    if user and timeout:
+                        header_user_cache.set(cache_key, user.id, timeout=timeout)
                     g.user = user
                     return user
             else:  # token 认证
@@ -365,6 +418,11 @@ class MyappSecurityManager(SecurityManager):
                 #     return
                 # else:
                 user = self.find_user(payload['iss'])
+                # 缓存时间不能超过token的过期时间
+                if payload.get('exp'):
+                    timeout = min(timeout, int(payload['exp'] - time.time()))
+                if user and timeout > 0:
+                    header_user_cache.set(cache_key, user.id, timeout=timeout)
                 g.user = user
                 return user
 
@@ -629,6 +687,62 @@ class MyappSecurityManager(SecurityManager):
     # 所有人都可以有的基本权限
     ACCESSIBLE_PERMS = {"can_userinfo","can_request_access","can_approve"}
 
+    @staticmethod
+    def get_permission_version():
+        from myapp import cache
+        try:
+            return cache.get(PERMISSION_VERSION_KEY) or 0
+        except Exception as e:
+            logging.error('get permission version error: %s', e)
+            return 0
+
+    @staticmethod
+    def bump_permission_version():
+        from myapp import cache
+        try:
+            # flask_caching的Cache没有inc，用后端(redis)的原子自增
+            cache.cache.inc(PERMISSION_VERSION_KEY)
+        except Exception as e:
+            logging.error('bump permission version error: %s', e)
+
+    # 用户所有角色的(权限名,视图名)集合，按用户id和权限版本号缓存，同一个请求内只计算一次
+    def get_user_permissions(self, user):
+        if getattr(g, 'user_permissions_id', None) == user.id:
+            return g.user_permissions
+
+        from myapp import db
+        cache_key = 'user_permissions/%s/%s' % (user.id, self.get_permission_version())
+        hit, value = False, None
+        try:
+            hit, value = get_memoize_backend().get(cache_key)
+        except Exception as e:
+            logging.error('get user permissions cache error: %s', e)
+        if not hit:
+            roles = list(user.roles)
+            rows = (
+                db.session.query(self.permission_model.name, self.viewmenu_model.name)
+                    .join(self.permissionview_model, self.permissionview_model.permission_id == self.permission_model.id)
+                    .join(self.viewmenu_model, self.permissionview_model.view_menu_id == self.viewmenu_model.id)
+                    .join(assoc_permissionview_role, assoc_permissionview_role.c.permission_view_id == self.permissionview_model.id)
+                    .filter(assoc_permissionview_role.c.role_id.in_([role.id for role in roles]))
+            ).all()
+            value = {
+                "builtin_roles": [role.name for role in roles if role.name in self.builtin_roles],
+                "permissions": [(row[0], row[1]) for row in rows]
+            }
+            try:
+                get_memoize_backend().set(cache_key, value, timeout=current_app.config.get('PERMISSION_CACHE_TIMEOUT', 3600))
+            except Exception as e:
+                logging.error('set user permissions cache error: %s', e)
+
+        permissions = {
+            "builtin_roles": value['builtin_roles'],
+            "permissions": set(value['permissions'])
+        }
+        g.user_permissions_id = user.id
+        g.user_permissions = permissions
+        return permissions
+
     # 获取用户是否有在指定视图上的指定权限名
     # @pysnooper.snoop()
     def can_access(self, permission_name, view_name):
@@ -636,13 +750,24 @@ class MyappSecurityManager(SecurityManager):
         user = g.user
         if user.is_anonymous:
             return self.is_item_public(permission_name, view_name)
-        return self._has_view_access(user, permission_name, view_name)
+        permissions = self.get_user_permissions(user)
+        # 先检查配置中的内置角色，不需要查询数据库
+        for role_name in permissions['builtin_roles']:
+            for _view_name, _permission_name in self.builtin_roles.get(role_name, []):
+                if re.match(_view_name, view_name) and re.match(_permission_name, permission_name):
+                    return True
+        return (permission_name, view_name) in permissions['permissions']
 
 
 
     # 获取用户具有指定权限的视图
     def user_view_menu_names(self, permission_name: str):
         from myapp import db
+        # 非匿名用户直接从权限缓存中获取
+        if not g.user.is_anonymous:
+            permissions = self.get_user_permissions(g.user)
+            return set([view_name for _permission_name, view_name in permissions['permissions'] if _permission_name == permission_name])
+
         base_query = (
             db.session.query(self.viewmenu_model.name)
                 .join(self.permissionview_model)
@@ -651,17 +776,6 @@ class MyappSecurityManager(SecurityManager):
                 .join(self.role_model)
         )
 
-        # 非匿名用户
-        if not g.user.is_anonymous:
-            # filter by user id
-            view_menu_names = (
-                base_query.join(assoc_user_role)
-                    .join(self.user_model)
-                    .filter(self.user_model.id == g.user.id)
-                    .filter(self.permission_model.name == permission_name)
-            ).all()
-            return set([s.name for s in view_menu_names])
-
         # Properly treat anonymous user 匿名用户
         public_role = self.get_public_role()
         if public_role:
@@ -859,6 +973,8 @@ class MyappSecurityManager(SecurityManager):
                                         permission_view_id=pv.id, role_id=role.id
                                         )
                                     )
+                                    # 直接写入关联表不会触发flush事件，手动记录，事务提交后更新权限版本号
+                                    mark_permission_changed(session)
             except Exception as e:
                 logging.error(e)
 
@@ -13,7 +13,7 @@ class BaseStatsLogger(object):
             return self.prefix + key
         return key
 
-    def incr(self, key):
+    def incr(self, key, count=1):
         """Increment a counter"""
         raise NotImplementedError()
 
@@ -24,14 +24,14 @@ class BaseStatsLogger(object):
     def timing(self, key, value):
         raise NotImplementedError()
 
-    def gauge(self, key):
+    def gauge(self, key, value):
         """Setup a gauge"""
         raise NotImplementedError()
 
 
 class DummyStatsLogger(BaseStatsLogger):
-    def incr(self, key):
-        logging.debug(Fore.CYAN + "[stats_logger] (incr) " + key + Style.RESET_ALL)
+    def incr(self, key, count=1):
+        logging.debug(Fore.CYAN + f"[stats_logger] (incr) {key} | {count}" + Style.RESET_ALL)
 
     def decr(self, key):
         logging.debug((Fore.CYAN + "[stats_logger] (decr) " + key + Style.RESET_ALL))
@@ -70,8 +70,8 @@ try:
             else:
                 self.client = StatsClient(host=host, port=port, prefix=prefix)
 
-        def incr(self, key):
-            self.client.incr(key)
+        def incr(self, key, count=1):
+            self.client.incr(key, count)
 
         def decr(self, key):
             self.client.decr(key)
@@ -79,9 +79,8 @@ try:
         def timing(self, key, value):
             self.client.timing(key, value)
 
-        def gauge(self, key):
-            # pylint: disable=no-value-for-parameter
-            self.client.gauge(key)
+        def gauge(self, key, value):
+            self.client.gauge(key, value)
 
 
 except Exception:
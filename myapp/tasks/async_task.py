@@ -321,5 +321,39 @@ def update_dataset(task,dataset_id):
             push_admin(f'数据集备份失败，id:{dataset_id}')
 
 
+# 大文件的csv异步导入，进度和每一行的错误写入共享缓存
+@celery_app.task(name="task.import_csv", bind=True)
+def import_csv(task, view_name, file_path, user_id, job_id):
+    logging.info(f'============= begin run import_csv task, {view_name}, {file_path}')
+    from flask import g
+    from myapp import appbuilder, security_manager
+    from myapp.views.baseApi import set_upload_progress
+    max_errors = conf.get('CSV_UPLOAD_MAX_ERRORS', 1000)
+
+    def report(result, status='running', message=''):
+        errors = [x for x in result if x != 'success']
+        set_upload_progress(job_id, status=status, success=len(result) - len(errors), fail=len(errors), errors=errors[:max_errors], message=message)
+
+    try:
+        views = [view for view in appbuilder.baseviews if view.__class__.__name__ == view_name]
+        if not views:
+            raise Exception('view %s not exist' % view_name)
+        # 钩子函数中会使用当前用户
+        with app.test_request_context():
+            g.user = security_manager.get_user_by_id(user_id)
+            set_upload_progress(job_id, status='running', success=0, fail=0, errors=[])
+            result, message = views[0].import_csv(file_path, progress=report)
+        if result is None:
+            report([], status='fail', message=message)
+        else:
+            report(result, status='success')
+    except Exception as e:
+        logging.error(e)
+        report([], status='fail', message=str(e))
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
 if __name__ =='__main__':
     upgrade_service(task=None,service_id=21,namespace='service',name='serving-nginx-202303141')
@@ -2,8 +2,10 @@
 """Utility functions used across Myapp"""
 
 # Myapp framework imports
+from celery.signals import worker_process_shutdown
 from myapp import app
 from myapp.utils.core import get_celery_app
+from myapp.utils.celery import dispose_engine
 
 # 全局配置，全部celery app。所有任务都挂在这个app下面
 conf = app.config
@@ -13,5 +15,7 @@ conf = app.config
 celery_app = get_celery_app(conf)
 
 
-
-
+# worker子进程退出时关闭本进程的数据库连接池
+@worker_process_shutdown.connect
+def close_db_engine(**kwargs):
+    dispose_engine()
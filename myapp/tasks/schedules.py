@@ -16,6 +16,7 @@ import time
 import datetime
 from myapp.utils.py.py_k8s import K8s
 from myapp.utils.celery import session_scope
+from myapp.utils import core
 from myapp.project import push_message,push_admin
 from myapp.tasks.celery_app import celery_app
 # Myapp framework imports
@@ -32,7 +33,7 @@ from myapp.models.model_job import (
 from myapp.models.model_notebook import Notebook
 from myapp.models.model_serving import InferenceService
 from myapp.views.view_pipeline import run_pipeline,dag_to_pipeline
-from sqlalchemy import or_
+from sqlalchemy import or_, func
 
 class Pusherror(Exception):
     pass
@@ -72,7 +73,7 @@ def delete_old_crd(object_info):
                 if run_id:
                     try:
                         # 如果workflow被删除了，则下面的也一并被删除
-                        workflows = dbsession.query(Workflow).filter(Workflow.labels.contains(run_id)).all()
+                        workflows = dbsession.query(Workflow).filter(Workflow.run_id == run_id).all()
                         # logging.info(workflows)
                         for workflow in workflows:
                             if workflow.status=='Deleted':
@@ -164,7 +165,7 @@ def delete_workflow(task):
                     # 只处理workflow命名空间，有runid的dp
                     if namespace and namespace in namespaces and name and run_id:
                         try:
-                            workflows = dbsession.query(Workflow).filter(Workflow.labels.contains(run_id)).all()
+                            workflows = dbsession.query(Workflow).filter(Workflow.run_id == run_id).all()
                             for workflow in workflows:
                                 if workflow.status == 'Succeeded' or workflow.status == 'Deleted' or workflow.status == 'Failed':
                                     logging.info(f'delete deployment:{namespace},{name}')
@@ -372,11 +373,48 @@ def next_schedules(cron_time, start_at, stop_at, resolution=0):
 #         logger.info(line.rstrip())
 # sys.stdout.write = write
 
+# 记录定时任务各个阶段的耗时，结束时输出报告并上报到STATS_LOGGER
+class PhaseTimer():
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self.begin = time.time()
+        self.last = self.begin
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def report(self, **counts):
+        total = time.time() - self.begin
+        stats_logger = conf.get('STATS_LOGGER')
+        # statsd的timing单位为毫秒
+        if stats_logger:
+            for phase in self.phases:
+                stats_logger.timing('%s.%s' % (self.name, phase), self.phases[phase] * 1000)
+            stats_logger.timing('%s.total' % self.name, total * 1000)
+        message = ', '.join(['%s=%.3fs' % (phase, self.phases[phase]) for phase in self.phases] + ['total=%.3fs' % total] + ['%s=%s' % (key, counts[key]) for key in counts])
+        logging.info('%s timing report: %s' % (self.name, message))
+
+
+# 分批，避免in查询的参数过多
+def chunks(items, size=1000):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 # 产生定时任务各个时间点的任务配置
 @celery_app.task(name="task.make_timerun_config", bind=True)
 # @pysnooper.snoop()
 def make_timerun_config(task):
     logging.info('============= begin run make_timerun_config task')
+    timer = PhaseTimer('make_timerun_config')
+    counts = {"pipelines": 0, "new_timeruns": 0, "duplicate_timeruns": 0}
+    pipeline_ids = []
+    stop_at = datetime.datetime.now() + datetime.timedelta(seconds=300)  # 下一个调度时间点，强制5分钟调度一次。这之前的 任务，该调度的都发起或者延迟发起
 
     # 先产生所有要产生的任务。可能也会产生直接的任务。
     with session_scope(nullpool=True) as dbsession:
@@ -384,75 +422,117 @@ def make_timerun_config(task):
             resolution = conf.get("PIPELINE_TASK_CRON_RESOLUTION", 0) * 60  # 设置最小发送时间间隔，15分钟
 
             pipelines = dbsession.query(Pipeline).filter(Pipeline.schedule_type=='crontab').all()  # 获取model记录
-            for pipeline in pipelines:  # 循环发起每一个调度
-                # 无效定时时间，退出
-                if not pipeline.cron_time:
-                    continue
-                if not re.match("^[0-9/*]+ [0-9/*]+ [0-9/*]+ [0-9/*]+ [0-9/*]+",pipeline.cron_time.strip().replace('  ', ' ')):
-                    continue
-                if pipeline.cronjob_start_time:
-                    start_at = datetime.datetime.strptime(pipeline.cronjob_start_time,'%Y-%m-%d %H:%M:%S')
-                else:
-                    start_at=datetime.datetime.now()
-
-                # 缩小指定范围，认为最后一个任务记录之前是调度记录都是已经产生的
-                last_run = dbsession.query(RunHistory).filter(RunHistory.pipeline_id==pipeline.id).order_by(RunHistory.id.desc()).first()
-                if last_run:
-                    last_execution_date = datetime.datetime.strptime(last_run.execution_date,'%Y-%m-%d %H:%M:%S')
-                    if last_execution_date>start_at:
-                        start_at=last_execution_date
-
-                stop_at = datetime.datetime.now() + datetime.timedelta(seconds=300)   # 下一个调度时间点，强制5分钟调度一次。这之前的 任务，该调度的都发起或者延迟发起
-
-                # logging.info('begin make timerun config %s'%pipeline.name)
-                # 计算start_at和stop_at之间，每一个任务的调度时间，并保障最小周期不超过设定的resolution。
+            # 无效定时时间的直接跳过
+            pipelines = [
+                pipeline for pipeline in pipelines
+                if pipeline.cron_time and re.match("^[0-9/*]+ [0-9/*]+ [0-9/*]+ [0-9/*]+ [0-9/*]+", pipeline.cron_time.strip().replace('  ', ' '))
+            ]
+            pipeline_ids = [pipeline.id for pipeline in pipelines]
+            counts['pipelines'] = len(pipelines)
+            timer.mark('load_pipelines')
+
+            # 一次查询所有pipeline的最后一个调度记录，认为最后一个任务记录之前是调度记录都是已经产生的
+            last_execution_dates = {}
+            for ids in chunks(pipeline_ids):
+                last_run_ids = dbsession.query(func.max(RunHistory.id)).filter(RunHistory.pipeline_id.in_(ids)).group_by(RunHistory.pipeline_id)
+                last_runs = dbsession.query(RunHistory.pipeline_id, RunHistory.execution_date).filter(RunHistory.id.in_(last_run_ids.subquery())).all()
+                for pipeline_id, execution_date in last_runs:
+                    last_execution_dates[pipeline_id] = execution_date
+            timer.mark('query_last_run')
+
+            # 计算start_at和stop_at之间，每一个任务的调度时间，并保障最小周期不超过设定的resolution。
+            candidates = {}   # pipeline_id -> [execution_date]
+            for pipeline in pipelines:
                 try:
-                    for eta in next_schedules(pipeline.cron_time, start_at, stop_at, resolution=resolution):  #
-                        # logging.info(f'执行时间点{eta}')
+                    if pipeline.cronjob_start_time:
+                        start_at = datetime.datetime.strptime(pipeline.cronjob_start_time,'%Y-%m-%d %H:%M:%S')
+                    else:
+                        start_at=datetime.datetime.now()
+
+                    if last_execution_dates.get(pipeline.id):
+                        last_execution_date = datetime.datetime.strptime(last_execution_dates[pipeline.id],'%Y-%m-%d %H:%M:%S')
+                        if last_execution_date>start_at:
+                            start_at=last_execution_date
+
+                    cronjob_start_time = pipeline.cronjob_start_time if pipeline.cronjob_start_time else json.loads(pipeline.expand).get("cronjob_start_time",'')
+                    if not cronjob_start_time:
+                        continue
+                    execution_dates = []
+                    for eta in next_schedules(pipeline.cron_time, start_at, stop_at, resolution=resolution):
                         execution_date = eta.strftime('%Y-%m-%d %H:%M:%S')
-                        cronjob_start_time = pipeline.cronjob_start_time if pipeline.cronjob_start_time else json.loads(pipeline.expand).get("cronjob_start_time",'')
-                        if cronjob_start_time and execution_date>cronjob_start_time:
-                            # 要检查是否重复添加记录了
-                            exist_timeruns=dbsession.query(RunHistory).filter(RunHistory.pipeline_id==pipeline.id).filter(RunHistory.execution_date==execution_date).all()
-                            if not exist_timeruns:
-                                pipeline_file,run_id = dag_to_pipeline(pipeline=pipeline, dbsession=dbsession,workflow_label={"schedule_type":"contab"},execution_date=execution_date)  # 合成workflow
-                                # logging.info('make pipeline file %s' % pipeline_file)
-                                if pipeline_file:
-                                    schedule_history = RunHistory(
-                                        created_on=datetime.datetime.now(),
-                                        pipeline_id=pipeline.id,
-                                        pipeline_argo_id='',
-                                        pipeline_file=pipeline_file,
-                                        version_id='',
-                                        run_id=run_id,
-                                        message='',
-                                        status='comed',
-                                        execution_date=execution_date
-                                    )
-                                    dbsession.add(schedule_history)
-                                    dbsession.commit()
-                                else:
-                                    push_message(conf.get('ADMIN_USER').split(','),'pipeline %s make config fail'%pipeline.name)
-                            if len(exist_timeruns)>1:
-                                for i in range(1,len(exist_timeruns)):
-                                    exist_timerun = exist_timeruns[i]
-                                    dbsession.delete(exist_timerun)
-                                    dbsession.commit()
-                                push_message(conf.get('ADMIN_USER').split(','),__('发现%s 任务流在 %s 时刻存在多个定时记录') % (pipeline.name,execution_date))
-
-
-                    # 无论产生任务怎么样，上传都是要执行的，可能会上传之前没有上传的任务
-                    # 直接触发一次，在5分钟以内的都延迟提交。
-                    # upload_timerun(pipeline,stop_at)
+                        if execution_date>cronjob_start_time:
+                            execution_dates.append(execution_date)
+                    if execution_dates:
+                        candidates[pipeline.id] = execution_dates
                 except Exception as e1:
                     logging.error(e1)
                     logging.error('Traceback: %s', traceback.format_exc())
+            timer.mark('compute_schedules')
+
+            # 一次查询所有候选时间点已经存在的调度记录，要检查是否重复添加记录了
+            exist_timeruns = {}   # (pipeline_id, execution_date) -> [timerun_id]
+            if candidates:
+                min_execution_date = min(min(execution_dates) for execution_dates in candidates.values())
+                max_execution_date = max(max(execution_dates) for execution_dates in candidates.values())
+                for ids in chunks(candidates.keys()):
+                    exists = dbsession.query(RunHistory.id, RunHistory.pipeline_id, RunHistory.execution_date)\
+                        .filter(RunHistory.pipeline_id.in_(ids))\
+                        .filter(RunHistory.execution_date >= min_execution_date)\
+                        .filter(RunHistory.execution_date <= max_execution_date)\
+                        .order_by(RunHistory.id).all()
+                    for timerun_id, pipeline_id, execution_date in exists:
+                        exist_timeruns.setdefault((pipeline_id, execution_date), []).append(timerun_id)
+            timer.mark('query_exist_runs')
+
+            # 批量写入新的调度记录，workflow的yaml在真正上传时才渲染
+            pipeline_names = dict((pipeline.id, pipeline.name) for pipeline in pipelines)
+            new_timeruns = []
+            for pipeline_id in candidates:
+                for execution_date in candidates[pipeline_id]:
+                    if (pipeline_id, execution_date) not in exist_timeruns:
+                        new_timeruns.append(RunHistory(
+                            created_on=datetime.datetime.now(),
+                            pipeline_id=pipeline_id,
+                            pipeline_argo_id='',
+                            pipeline_file='',
+                            version_id='',
+                            run_id='',
+                            message='',
+                            status='comed',
+                            execution_date=execution_date
+                        ))
+            for batch in chunks(new_timeruns, 500):
+                dbsession.add_all(batch)
+                dbsession.commit()
+            counts['new_timeruns'] = len(new_timeruns)
+            timer.mark('insert_runs')
+
+            # 同一时刻存在多个定时记录的，只保留最早的一个
+            duplicate_ids = []
+            for (pipeline_id, execution_date), timerun_ids in exist_timeruns.items():
+                if execution_date in candidates.get(pipeline_id, []) and len(timerun_ids) > 1:
+                    duplicate_ids.extend(timerun_ids[1:])
+                    push_message(conf.get('ADMIN_USER').split(','),__('发现%s 任务流在 %s 时刻存在多个定时记录') % (pipeline_names.get(pipeline_id, pipeline_id),execution_date))
+            for ids in chunks(duplicate_ids):
+                dbsession.query(RunHistory).filter(RunHistory.id.in_(ids)).delete(synchronize_session=False)
+                dbsession.commit()
+            counts['duplicate_timeruns'] = len(duplicate_ids)
+            timer.mark('delete_duplicate_runs')
 
-                upload_timerun(pipeline_id=pipeline.id,stop_time=stop_at.strftime('%Y-%m-%d %H:%M:%S'))
+        except Exception as e:
+            logging.error(e)
+            logging.error('Traceback: %s', traceback.format_exc())
 
+    # 无论产生任务怎么样，上传都是要执行的，可能会上传之前没有上传的任务
+    # 直接触发一次，在5分钟以内的都延迟提交。
+    for pipeline_id in pipeline_ids:
+        try:
+            upload_timerun(pipeline_id=pipeline_id,stop_time=stop_at.strftime('%Y-%m-%d %H:%M:%S'))
         except Exception as e:
             logging.error(e)
             logging.error('Traceback: %s', traceback.format_exc())
+    timer.mark('upload_runs')
+    timer.report(**counts)
 
 
 
@@ -490,7 +570,7 @@ def upload_timerun(pipeline_id,stop_time):
                         upload_workflow.apply_async(kwargs=kwargs,expires=120,retry=False)
                     elif pass_run.status=='created':
                         # 这里要注意处理一下 watch组件坏了，或者argo controller组件坏了的情况。以及误操作在workflow界面把记录删除了的情况
-                        workflow = dbsession.query(Workflow).filter(Workflow.labels.contains(pass_run.run_id)).first()
+                        workflow = dbsession.query(Workflow).filter(Workflow.run_id == pass_run.run_id).first()
                         if workflow:
                             if workflow.status == 'Deleted' or workflow.status == 'Succeeded':
                                 logging.info('pass workflow success finish')
@@ -539,7 +619,7 @@ def upload_timerun(pipeline_id,stop_time):
                             if pass_run and run_id not in latest_run_ids:
                                 k8s_client = K8s(pipeline.project.cluster.get('KUBECONFIG',''))
                                 k8s_client.delete_workflow(all_crd_info=conf.get("CRD_INFO", {}), namespace='pipeline',run_id=run_id)
-                                workflow = dbsession.query(Workflow).filter(Workflow.labels.contains(run_id)).first()
+                                workflow = dbsession.query(Workflow).filter(Workflow.run_id == run_id).first()
                                 workflow.status = 'Deleted'
                                 dbsession.commit()
                                 # 也更新timeruns的状态
@@ -604,10 +684,14 @@ def upload_workflow(task,timerun_id,pipeline_id):
             try:
                 json.loads(timerun.pipeline_file)
             except Exception as e:
-                # 不是json要重新生成
-                timerun.pipeline_file, timerun.run_id = dag_to_pipeline(pipeline=pipeline, dbsession=dbsession,
+                # 不是json要重新生成，定时产生的记录在这里才真正渲染workflow
+                pipeline_file, run_id = dag_to_pipeline(pipeline=pipeline, dbsession=dbsession,
                                                         workflow_label={"schedule_type": "contab"},
                                                         execution_date=timerun.execution_date)  # 合成workflow
+                if not pipeline_file:
+                    push_message(conf.get('ADMIN_USER').split(','),'pipeline %s make config fail'%pipeline.name)
+                    return
+                timerun.pipeline_file, timerun.run_id = pipeline_file, run_id
                 dbsession.commit()
                 # logging.error(e)
             crd_name = run_pipeline(pipeline=pipeline,workflow_json=json.loads(timerun.pipeline_file))
@@ -715,7 +799,7 @@ def check_pipeline_time():
                         "user": today_workflow.username,
                         "pipeline": pipeline.describe if pipeline else 'unknown'
                     }
-                    old_workflows = dbsession.query(Workflow).filter(Workflow.labels.contains('"pipeline-id": "%s"' % pipeline_id)).order_by(Workflow.id.desc()).limit(10).all()  # 获取model记录
+                    old_workflows = dbsession.query(Workflow).filter(Workflow.pipeline_id == int(pipeline_id)).order_by(Workflow.id.desc()).limit(10).all()  # 获取model记录
                     for old_workflow in old_workflows:
                         run_time = get_run_time(old_workflow)
                         # logging.info(old_workflow.name)
@@ -888,16 +972,28 @@ def push_workspace_size(task):
                     logging.error('Traceback: %s', traceback.format_exc())
 
 
+# 定时采集各集群的机器资源快照写入缓存，web进程只读取快照
+@celery_app.task(name="task.collect_node_resource", bind=True)
+def collect_node_resource(task):
+    snapshot = core.collect_node_resource()
+    core.save_node_resource_snapshot(snapshot)
+
+
 @celery_app.task(name="task.watch_gpu", bind=True)
 def watch_gpu(task):
     logging.info(f'============= begin run watch_gpu task')
     clusters = conf.get('CLUSTERS', {})
+
+    def get_used_gpu(kubeconfig):
+        return K8s(kubeconfig).get_uesd_gpu(namespaces=['pipeline','automl','jupyter','service'])
+
+    # 各集群并发查询
+    all_cluster_gpu_pods, errors = core.fan_out(get_used_gpu, dict((cluster_name, clusters[cluster_name].get('KUBECONFIG','')) for cluster_name in clusters))
     for cluster_name in clusters:
+        if cluster_name not in all_cluster_gpu_pods:
+            continue
         try:
-            cluster = clusters[cluster_name]
-            k8s_client = K8s(cluster.get('KUBECONFIG',''))
-
-            all_gpu_pods = k8s_client.get_uesd_gpu(namespaces=['pipeline','automl','jupyter','service'])
+            all_gpu_pods = all_cluster_gpu_pods[cluster_name]
 
             logging.info('all_gpu_pods:%s',all_gpu_pods)
             message = ''
@@ -913,21 +1009,39 @@ def watch_gpu(task):
             logging.error(e1)
             logging.error('Traceback: %s', traceback.format_exc())
 
+# 定时刷新推理服务的负载曲线，写入共享缓存，页面直接读取
+@celery_app.task(name="task.update_service_load", bind=True)
+def update_service_load(task=None):
+    from myapp import cache
+    from myapp.views.view_inferenceserving import build_service_load_option, SERVICE_LOAD_CACHE_KEY
+    with session_scope(nullpool=True) as dbsession:
+        try:
+            option = build_service_load_option(dbsession)
+            cache.set(SERVICE_LOAD_CACHE_KEY, option, timeout=conf.get('SERVICE_LOAD_CACHE_TIMEOUT', 600))
+        except Exception as e:
+            logging.error('update service load error: %s', e)
+
+
 @celery_app.task(name="task.watch_pod_utilization", bind=True)
 def watch_pod_utilization(task=None):
     logging.info(f'============= begin run watch_pod_utilization task')
     clusters = conf.get('CLUSTERS', {})
-    for cluster_name in clusters:
-        try:
-            cluster = clusters[cluster_name]
-            k8s_client = K8s(cluster.get('KUBECONFIG', ''))
 
-            # 获取连续2天的低利用率pod要报警
-            from myapp.utils.py.py_prometheus import Prometheus
-            prometheus = Prometheus(conf.get('PROMETHEUS', 'prometheus-k8s.monitoring:9090'))
+    # 获取连续2天的低利用率pod要报警
+    from myapp.utils.py.py_prometheus import Prometheus
+    prometheus = Prometheus(conf.get('PROMETHEUS', 'prometheus-k8s.monitoring:9090'))
 
-            service_pods = k8s_client.get_pods(namespace='service')
-            service_pods_metrics = prometheus.get_namespace_resource_metric(namespace="service")
+    def get_service_pods(kubeconfig):
+        return K8s(kubeconfig).get_pods(namespace='service') or []
+
+    # 各集群并发查询
+    all_service_pods, errors = core.fan_out(get_service_pods, dict((cluster_name, clusters[cluster_name].get('KUBECONFIG', '')) for cluster_name in clusters))
+    service_pods_metrics = prometheus.get_namespace_resource_metric(namespace="service")
+    for cluster_name in clusters:
+        if cluster_name not in all_service_pods:
+            continue
+        try:
+            service_pods = all_service_pods[cluster_name]
             for pod in service_pods:
                 if pod['start_time'] > (datetime.datetime.now() - datetime.timedelta(days=2)) and pod['name'] in service_pods_metrics and pod['username']:
                     try:
@@ -950,175 +1064,178 @@ def watch_pod_utilization(task=None):
 
 
 # 各项目组之间相互均衡的方案，一台机器上可能并不能被一个项目组占完，所以可能会跑多个项目组的任务
-@celery_app.task(name="task.adjust_node_resource", bind=True)
-def adjust_node_resource(task):
-    logging.info(f'============= begin run adjust_node_resource task')
-    clusters = conf.get('CLUSTERS', {})
-    for cluster_name in clusters:
-        cluster = clusters[cluster_name]
-        k8s_client = K8s(cluster.get('KUBECONFIG',''))
-        all_node = k8s_client.get_node()
-        all_node_json = {}
-        pending_pods={}
-        # 获取每台机器的资源容纳量
-        for node in all_node:  # list 转dict
-            ip = node['hostip']
-            if node['labels'].get('share','true')=='true' and node['labels'].get('train','false')=='true':  # 前提要求机器允许被其他项目组共享
-                if node['labels'].get('cpu','false')=='true' or node['labels'].get('gpu','false')=='true':
-                    all_node_json[ip] = node
-                    all_node_json[ip]['used_memory'] = []
-                    all_node_json[ip]['used_cpu'] = []
-                    all_node_json[ip]['used_gpu'] = []
-
-        # logging.info(all_node_json)
-        for namespace in ['jupyter', 'pipeline', 'automl', 'service']:
-            all_pods = k8s_client.get_pods(namespace=namespace)
-            for pod in all_pods:
-                if pod['host_ip'] not in all_node_json:
-                    continue
-                if pod['status'] == 'Running':
-                    # logging.info('%s, %s',namespace,pod)
-                    all_node_json[pod['host_ip']]['used_memory'].append(pod['memory'])
-                    all_node_json[pod['host_ip']]['used_cpu'].append(pod['cpu'])
-                    all_node_json[pod['host_ip']]['used_gpu'].append(pod['gpu'])
-                    # logging.info(all_node_json[pod['host_ip']])
-                # 有挂起等待超过5分钟的情况，立刻划资源过去，并推送通知，因为挂起不一定是因为资源。
-                if pod['status']=='Pending' and (datetime.datetime.now()-pod['start_time']).total_seconds()>300:
-                    # 如果因为资源不足就通过资源调度解决
-                    containers = pod['status_more'].get('conditions', [])
-                    messages = ','.join([container['message'] if container['message'] else '' for container in containers])
-
-                    if 'insufficient' in messages.lower():
-                        pending_pods[pod['name']]={
-                            "namespace":namespace,
-                            "cluster":cluster_name,
-                            "node_selector":pod['node_selector']
-                        }
-                        push_message(conf.get('ADMIN_USER','').split(','),'cluster %s, namespace %s pod %s 因资源问题 pending'%(cluster_name,namespace,pod['name']))
-                    else:
-                        push_message(conf.get('ADMIN_USER', '').split(','),'cluster %s, namespace %s pod %s 因其他问题 pending' % (cluster_name,namespace, pod['name']))
-
+# 单个集群内每次最多调整一台机器
+def adjust_cluster_node_resource(cluster_name, kubeconfig):
+    k8s_client = K8s(kubeconfig)
+    all_node = k8s_client.get_node()
+    all_node_json = {}
+    pending_pods={}
+    # 获取每台机器的资源容纳量
+    for node in all_node:  # list 转dict
+        ip = node['hostip']
+        if node['labels'].get('share','true')=='true' and node['labels'].get('train','false')=='true':  # 前提要求机器允许被其他项目组共享
+            if node['labels'].get('cpu','false')=='true' or node['labels'].get('gpu','false')=='true':
+                all_node_json[ip] = node
+                all_node_json[ip]['used_memory'] = []
+                all_node_json[ip]['used_cpu'] = []
+                all_node_json[ip]['used_gpu'] = []
+
+    # logging.info(all_node_json)
+    for namespace in ['jupyter', 'pipeline', 'automl', 'service']:
+        all_pods = k8s_client.get_pods(namespace=namespace)
+        for pod in all_pods:
+            if pod['host_ip'] not in all_node_json:
+                continue
+            if pod['status'] == 'Running':
+                # logging.info('%s, %s',namespace,pod)
+                all_node_json[pod['host_ip']]['used_memory'].append(pod['memory'])
+                all_node_json[pod['host_ip']]['used_cpu'].append(pod['cpu'])
+                all_node_json[pod['host_ip']]['used_gpu'].append(pod['gpu'])
+                # logging.info(all_node_json[pod['host_ip']])
+            # 有挂起等待超过5分钟的情况，立刻划资源过去，并推送通知，因为挂起不一定是因为资源。
+            if pod['status']=='Pending' and (datetime.datetime.now()-pod['start_time']).total_seconds()>300:
+                # 如果因为资源不足就通过资源调度解决
+                containers = pod['status_more'].get('conditions', [])
+                messages = ','.join([container['message'] if container['message'] else '' for container in containers])
+
+                if 'insufficient' in messages.lower():
+                    pending_pods[pod['name']]={
+                        "namespace":namespace,
+                        "cluster":cluster_name,
+                        "node_selector":pod['node_selector']
+                    }
+                    push_message(conf.get('ADMIN_USER','').split(','),'cluster %s, namespace %s pod %s 因资源问题 pending'%(cluster_name,namespace,pod['name']))
+                else:
+                    push_message(conf.get('ADMIN_USER', '').split(','),'cluster %s, namespace %s pod %s 因其他问题 pending' % (cluster_name,namespace, pod['name']))
+
+    for ip in all_node_json:
+        all_node_json[ip]['used_memory'] = int(sum(all_node_json[ip]['used_memory']))
+        all_node_json[ip]['used_cpu'] = int(sum(all_node_json[ip]['used_cpu']))
+        all_node_json[ip]['used_gpu'] = int(sum(all_node_json[ip]['used_gpu']))
+
+
+    # 获取每个资源组的资源申请量，cpu机器和gpu单独看。
+    all_org_resource={}
+    for ip in all_node_json:
+        org=all_node_json[ip]['labels'].get('org','public')
+        if org not in all_org_resource:
+            all_org_resource[org]={
+                "cpu_node_num":0,
+                "gpu_node_num":0,
+                "cpu_req_total":0,
+                "gpu_req_total": 0,
+                "cpu_allocatable_total":0,
+                "gpu_allocatable_total":0
+            }
+        if all_node_json[ip]['labels'].get('cpu','false')=='true':
+            all_org_resource[org]['cpu_node_num']+=1
+            all_org_resource[org]['cpu_req_total'] += all_node_json[ip]['used_cpu']
+            all_org_resource[org]['cpu_allocatable_total'] += all_node_json[ip]['cpu']
+
+        if all_node_json[ip]['labels'].get('gpu','false')=='true':
+            all_org_resource[org]['gpu_node_num']+=1
+            all_org_resource[org]['gpu_req_total'] += all_node_json[ip]['used_gpu']
+            all_org_resource[org]['gpu_allocatable_total'] += all_node_json[ip]['gpu']
+
+    # 计算申请率最大最小集群
+    max_cpu_org=max_gpu_org=min_cpu_org=min_gpu_org='public'
+    max_cpu_per = max_gpu_per = 0
+    min_cpu_per = min_gpu_per = 1
+    for org in all_org_resource:
+        org_resource=all_org_resource[org]
+        if org_resource['cpu_node_num']>2:   # 至少3台机器，才参与调度融合
+            if org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']>max_cpu_per:
+                max_cpu_per=org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']
+                max_cpu_org=org
+            if org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']<min_cpu_per:
+                min_cpu_per=org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']
+                min_cpu_org=org
+
+        if org_resource['gpu_node_num']>2:   # 至少3台机器，才参与调度融合
+            if org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']>max_gpu_per:
+                max_gpu_per=org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']
+                max_gpu_org=org
+            if org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']<min_gpu_per:
+                min_gpu_per=org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']
+                min_gpu_org=org
+
+    # 获取项目组下面，每台机器的cpu申请量
+    def get_cpu_per_node(org):
+        org_node_cpu_per = {}
         for ip in all_node_json:
-            all_node_json[ip]['used_memory'] = int(sum(all_node_json[ip]['used_memory']))
-            all_node_json[ip]['used_cpu'] = int(sum(all_node_json[ip]['used_cpu']))
-            all_node_json[ip]['used_gpu'] = int(sum(all_node_json[ip]['used_gpu']))
+            if all_node_json[ip]['labels'].get('org', '') == org and all_node_json[ip]['labels'].get('cpu','false') == 'true':
+                org_node_cpu_per[ip] = all_node_json[ip]['used_cpu'] / all_node_json[ip]['cpu']
 
+        org_node_cpu_per = sorted(org_node_cpu_per.items(), key=lambda x: x[1], reverse=False)  # 从小到大排序
+        return org_node_cpu_per
 
-        # 获取每个资源组的资源申请量，cpu机器和gpu单独看。
-        all_org_resource={}
+    # 获取项目组下面，每台机器的gpu申请量
+    def get_gpu_per_node(org):
+        org_node_gpu_per={}
         for ip in all_node_json:
-            org=all_node_json[ip]['labels'].get('org','public')
-            if org not in all_org_resource:
-                all_org_resource[org]={
-                    "cpu_node_num":0,
-                    "gpu_node_num":0,
-                    "cpu_req_total":0,
-                    "gpu_req_total": 0,
-                    "cpu_allocatable_total":0,
-                    "gpu_allocatable_total":0
-                }
-            if all_node_json[ip]['labels'].get('cpu','false')=='true':
-                all_org_resource[org]['cpu_node_num']+=1
-                all_org_resource[org]['cpu_req_total'] += all_node_json[ip]['used_cpu']
-                all_org_resource[org]['cpu_allocatable_total'] += all_node_json[ip]['cpu']
-
-            if all_node_json[ip]['labels'].get('gpu','false')=='true':
-                all_org_resource[org]['gpu_node_num']+=1
-                all_org_resource[org]['gpu_req_total'] += all_node_json[ip]['used_gpu']
-                all_org_resource[org]['gpu_allocatable_total'] += all_node_json[ip]['gpu']
-
-        # 计算申请率最大最小集群
-        max_cpu_org=max_gpu_org=min_cpu_org=min_gpu_org='public'
-        max_cpu_per = max_gpu_per = 0
-        min_cpu_per = min_gpu_per = 1
-        for org in all_org_resource:
-            org_resource=all_org_resource[org]
-            if org_resource['cpu_node_num']>2:   # 至少3台机器，才参与调度融合
-                if org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']>max_cpu_per:
-                    max_cpu_per=org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']
-                    max_cpu_org=org
-                if org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']<min_cpu_per:
-                    min_cpu_per=org_resource['cpu_req_total']/org_resource['cpu_allocatable_total']
-                    min_cpu_org=org
-
-            if org_resource['gpu_node_num']>2:   # 至少3台机器，才参与调度融合
-                if org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']>max_gpu_per:
-                    max_gpu_per=org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']
-                    max_gpu_org=org
-                if org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']<min_gpu_per:
-                    min_gpu_per=org_resource['gpu_req_total']/org_resource['gpu_allocatable_total']
-                    min_gpu_org=org
-
-        # 获取项目组下面，每台机器的cpu申请量
-        def get_cpu_per_node(org):
-            org_node_cpu_per = {}
-            for ip in all_node_json:
-                if all_node_json[ip]['labels'].get('org', '') == org and all_node_json[ip]['labels'].get('cpu','false') == 'true':
-                    org_node_cpu_per[ip] = all_node_json[ip]['used_cpu'] / all_node_json[ip]['cpu']
-
-            org_node_cpu_per = sorted(org_node_cpu_per.items(), key=lambda x: x[1], reverse=False)  # 从小到大排序
-            return org_node_cpu_per
-
-        # 获取项目组下面，每台机器的gpu申请量
-        def get_gpu_per_node(org):
-            org_node_gpu_per={}
-            for ip in all_node_json:
-                if all_node_json[ip]['labels'].get('org','')==org and all_node_json[ip]['labels'].get('gpu','false')=='true':
-                    org_node_gpu_per[ip]=all_node_json[ip]['used_gpu']/all_node_json[ip]['gpu']
-            org_node_gpu_per = sorted(org_node_gpu_per.items(), key=lambda x: x[1], reverse=False)   # 从小到大排序
-            return org_node_gpu_per
-
-
-        # 如果存在资源问题pending，直接调整
-        if pending_pods:
-            for pod_name in pending_pods:
-                des_org = pending_pods[pod_name]['node_selector'].get('org','public')
-                # 如果缺少cpu
-                if pending_pods[pod_name]['node_selector'].get('cpu','false')=='true' and des_org!=min_cpu_org:
-                    # 直接将申请量最小的集群中申请量最小的cpu机器迁移过去
-                    org_node_cpu_per = get_cpu_per_node(min_cpu_org)
-                    logging.info(org_node_cpu_per)
-                    adjust_node = [node[0] for node in org_node_cpu_per[:1]]  # 每次调整一台机器
-                    push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 cpu机器 %s 到项目组%s') % (cluster_name, min_cpu_org, ','.join(adjust_node), des_org))
-                    k8s_client.label_node(adjust_node, labels={"org": des_org})
-                    return
+            if all_node_json[ip]['labels'].get('org','')==org and all_node_json[ip]['labels'].get('gpu','false')=='true':
+                org_node_gpu_per[ip]=all_node_json[ip]['used_gpu']/all_node_json[ip]['gpu']
+        org_node_gpu_per = sorted(org_node_gpu_per.items(), key=lambda x: x[1], reverse=False)   # 从小到大排序
+        return org_node_gpu_per
+
+
+    # 如果存在资源问题pending，直接调整
+    if pending_pods:
+        for pod_name in pending_pods:
+            des_org = pending_pods[pod_name]['node_selector'].get('org','public')
+            # 如果缺少cpu
+            if pending_pods[pod_name]['node_selector'].get('cpu','false')=='true' and des_org!=min_cpu_org:
+                # 直接将申请量最小的集群中申请量最小的cpu机器迁移过去
+                org_node_cpu_per = get_cpu_per_node(min_cpu_org)
+                logging.info(org_node_cpu_per)
+                adjust_node = [node[0] for node in org_node_cpu_per[:1]]  # 每次调整一台机器
+                push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 cpu机器 %s 到项目组%s') % (cluster_name, min_cpu_org, ','.join(adjust_node), des_org))
+                k8s_client.label_node(adjust_node, labels={"org": des_org})
+                return
 
-                if pending_pods[pod_name]['node_selector'].get('gpu','false')=='true' and des_org!=min_gpu_org:
-                    org_node_gpu_per = get_gpu_per_node(min_gpu_org)
-                    logging.info(org_node_gpu_per)
-                    adjust_node = [node[0] for node in org_node_gpu_per[:1]]  # 每次调整一台机器
-                    push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 gpu机器 %s 到项目组%s') % (cluster_name, min_gpu_org, ','.join(adjust_node), des_org))
-                    k8s_client.label_node(adjust_node, labels={"org": des_org})
-                    return
+            if pending_pods[pod_name]['node_selector'].get('gpu','false')=='true' and des_org!=min_gpu_org:
+                org_node_gpu_per = get_gpu_per_node(min_gpu_org)
+                logging.info(org_node_gpu_per)
+                adjust_node = [node[0] for node in org_node_gpu_per[:1]]  # 每次调整一台机器
+                push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 gpu机器 %s 到项目组%s') % (cluster_name, min_gpu_org, ','.join(adjust_node), des_org))
+                k8s_client.label_node(adjust_node, labels={"org": des_org})
+                return
+
+    # 不存在资源挂起的情况，保持最大最小集群申请量差异在20%以下
+    logging.info(all_org_resource)
+    # 如果差别最大的两个不同的资源组，cpu申请率差距在20%，则将申请率最小的资源组中的申请率最小的机器转为到另一个资源组
+    logging.info('%s,%s,%s,%s',max_cpu_org,min_cpu_org,max_gpu_org,min_gpu_org)
+    if max_cpu_org!=min_cpu_org and max_cpu_per>min_cpu_per+0.2:
+        org_node_cpu_per = get_cpu_per_node(min_cpu_org)
+        logging.info(org_node_cpu_per)
+        adjust_node = [node[0] for node in org_node_cpu_per[:1]]   # 每次调整一台机器
+        push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 cpu机器 %s 到项目组%s') % (cluster_name,min_cpu_org,','.join(adjust_node),max_cpu_org))
+        k8s_client.label_node(adjust_node,labels={"org":max_cpu_org})
+        return
 
-        # 不存在资源挂起的情况，保持最大最小集群申请量差异在20%以下
-        logging.info(all_org_resource)
-        # 如果差别最大的两个不同的资源组，cpu申请率差距在20%，则将申请率最小的资源组中的申请率最小的机器转为到另一个资源组
-        logging.info('%s,%s,%s,%s',max_cpu_org,min_cpu_org,max_gpu_org,min_gpu_org)
-        if max_cpu_org!=min_cpu_org and max_cpu_per>min_cpu_per+0.2:
-            org_node_cpu_per = get_cpu_per_node(min_cpu_org)
-            logging.info(org_node_cpu_per)
-            adjust_node = [node[0] for node in org_node_cpu_per[:1]]   # 每次调整一台机器
-            push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 cpu机器 %s 到项目组%s') % (cluster_name,min_cpu_org,','.join(adjust_node),max_cpu_org))
-            k8s_client.label_node(adjust_node,labels={"org":max_cpu_org})
-            return
-
-
-        # 将差距最大的两个gpu资源组，进行调配
-        if max_gpu_org!=min_gpu_org and max_gpu_per>min_gpu_per+0.2:
-            org_node_gpu_per = get_gpu_per_node(min_gpu_org)
-            logging.info(org_node_gpu_per)
-            adjust_node = [node[0] for node in org_node_gpu_per[:1]]  # 每次调整一台机器
-            push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 gpu机器 %s 到项目组%s') % (cluster_name, min_gpu_org, ','.join(adjust_node), max_gpu_org))
-            k8s_client.label_node(adjust_node,labels={"org":max_gpu_org})
-            return
+
+    # 将差距最大的两个gpu资源组，进行调配
+    if max_gpu_org!=min_gpu_org and max_gpu_per>min_gpu_per+0.2:
+        org_node_gpu_per = get_gpu_per_node(min_gpu_org)
+        logging.info(org_node_gpu_per)
+        adjust_node = [node[0] for node in org_node_gpu_per[:1]]  # 每次调整一台机器
+        push_message(conf.get('ADMIN_USER').split(','), __('集群 %s 调整项目组 %s 下 gpu机器 %s 到项目组%s') % (cluster_name, min_gpu_org, ','.join(adjust_node), max_gpu_org))
+        k8s_client.label_node(adjust_node,labels={"org":max_gpu_org})
+        return
+
+
+@celery_app.task(name="task.adjust_node_resource", bind=True)
+def adjust_node_resource(task):
+    logging.info(f'============= begin run adjust_node_resource task')
+    clusters = conf.get('CLUSTERS', {})
+    # 各集群相互独立，并发调整
+    core.fan_out(adjust_cluster_node_resource, dict((cluster_name, (cluster_name, clusters[cluster_name].get('KUBECONFIG', ''))) for cluster_name in clusters), timeout=conf.get('K8S_FANOUT_TIMEOUT', 30) * 10)
 
 
 # get_dir_size('/data/k8s/kubeflow/pipeline/workspace')
 # @pysnooper.snoop()
-def get_deployment_node_selector(name,namespace):
-    from kubernetes import client
-    exist_dp = client.AppsV1Api().read_namespaced_deployment(name=name, namespace=namespace)
+def get_deployment_node_selector(k8s_client, name, namespace):
+    exist_dp = k8s_client.AppsV1Api.read_namespaced_deployment(name=name, namespace=namespace)
 
     node_selector = {}
     try:
@@ -1156,7 +1273,7 @@ def adjust_service_resource(task):
     with session_scope(nullpool=True) as dbsession:
         try:
             k8s_client = K8s(cluster.get('KUBECONFIG',''))
-            hpas = client.AutoscalingV2beta1Api().list_namespaced_horizontal_pod_autoscaler(namespace=namespace).items
+            hpas = client.AutoscalingV2beta1Api(k8s_client.api_client).list_namespaced_horizontal_pod_autoscaler(namespace=namespace).items
             for hpa in hpas:
                 inferenceserving = dbsession.query(InferenceService).filter_by(name=hpa.metadata.name).filter_by(model_status='online').first()
                 if not inferenceserving:
@@ -1172,24 +1289,24 @@ def adjust_service_resource(task):
                             # 如果没有扩张，或者持续时间太久，就缩小低优先级服务
                             if not hpa.status.last_scale_time or datetime.datetime.now().timestamp() - hpa.status.last_scale_time.astimezone(datetime.timezone(datetime.timedelta(hours=8))).timestamp() > 400:
                                 push_message(conf.get('ADMIN_USER').split(','), __('寻找扩服务%s一卡') % (inferenceserving.name,))
-                                target_node_selector = get_deployment_node_selector(name=inferenceserving.name,namespace=namespace)
+                                target_node_selector = get_deployment_node_selector(k8s_client, name=inferenceserving.name,namespace=namespace)
 
                                 # 获取同项目组，低优先级的推理
                                 low_inferenceservings =dbsession.query(InferenceService).filter_by(priority=0).filter_by(project_id=inferenceserving.project_id).all()
                                 low_inferenceservings.sort(key=lambda item:item.max_replicas-item.min_replicas)  # 从大到小排序
                                 for service in low_inferenceservings:
                                     if service.resource_gpu and service.resource_gpu!='0':  #
-                                        current_replicas = client.AppsV1Api().read_namespaced_deployment(name=service.name, namespace=namespace).spec.replicas
+                                        current_replicas = k8s_client.AppsV1Api.read_namespaced_deployment(name=service.name, namespace=namespace).spec.replicas
                                         # 如果当前副本数大于最小副本数
                                         if current_replicas > service.min_replicas:
                                             # 随意缩放一个pod
                                             if not target_node_selector.get('gpu-type',''):
-                                                client.AppsV1Api().patch_namespaced_deployment_scale(service.name, namespace,[{'op': 'replace', 'path': '/spec/replicas', 'value': current_replicas-1}])
+                                                k8s_client.AppsV1Api.patch_namespaced_deployment_scale(service.name, namespace,[{'op': 'replace', 'path': '/spec/replicas', 'value': current_replicas-1}])
                                                 push_message([service.created_by.username,inferenceserving.created_by.username]+conf.get('ADMIN_USER').split(','),'缩服务%s一卡，扩服务%s一卡'%(service.name,inferenceserving.name))
                                                 return
                                             # 缩放指定pod
                                             else:
-                                                node_selector = get_deployment_node_selector(name=service.name,namespace=namespace)
+                                                node_selector = get_deployment_node_selector(k8s_client, name=service.name,namespace=namespace)
                                                 target_gpu_type = target_node_selector['gpu-type']
                                                 exist_gpu_type = node_selector.get('gpu-type','')
                                                 if exist_gpu_type and exist_gpu_type!=target_gpu_type:
@@ -1205,7 +1322,7 @@ def adjust_service_resource(task):
                                                         can_scale_pods = [pod for pod in pods if pod['host_ip']==nodeip]
                                                         if can_scale_pods:
                                                             k8s_client.v1.delete_namespaced_pod(can_scale_pods[0]['name'], namespace,grace_period_seconds=0)
-                                                            client.AppsV1Api().patch_namespaced_deployment_scale(service.name, namespace, [{'op': 'replace', 'path': '/spec/replicas','value': current_replicas - 1}])
+                                                            k8s_client.AppsV1Api.patch_namespaced_deployment_scale(service.name, namespace, [{'op': 'replace', 'path': '/spec/replicas','value': current_replicas - 1}])
                                                             push_message([service.created_by.username,inferenceserving.created_by.username] + conf.get('ADMIN_USER').split(','), __('缩服务%s一卡，扩服务%s一卡') % (service.name, inferenceserving.name))
 
                                                             return
@@ -1,11 +1,11 @@
-import time, os
+import os
 from flask_babel import gettext as __
 from flask_babel import lazy_gettext as _
 from kubernetes import client
-from kubernetes import watch
 from myapp.utils.py.py_k8s import K8s
+from myapp.utils.py.py_k8s_informer import ResumableWatch
 from myapp.project import push_message
-from myapp import app
+from myapp import app, cache
 from myapp.utils.celery import session_scope
 
 conf = app.config
@@ -18,7 +18,7 @@ else:
     clusters = conf.get('CLUSTERS', {})
     if clusters and cluster in clusters:
         kubeconfig = clusters[cluster].get('KUBECONFIG', '')
-        K8s(kubeconfig)
+        k8s_client = K8s(kubeconfig)
     else:
         print('no kubeconfig in cluster %s' % cluster)
         exit(1)
@@ -28,42 +28,42 @@ from datetime import datetime, timezone, timedelta
 
 
 # @pysnooper.snoop()
-def listen_service():
-    namespace = conf.get('SERVICE_NAMESPACE')
-    w = watch.Watch()
-    while (True):
+def deal_event(event):
+    with session_scope(nullpool=True) as dbsession:
         try:
-            print('begin listen')
-            for event in w.stream(client.CoreV1Api().list_namespaced_pod, namespace=namespace,timeout_seconds=60):  # label_selector=label,
-                with session_scope(nullpool=True) as dbsession:
-                    try:
-                        if event['object'].status and event['object'].status.container_statuses and event["type"]=='MODIFIED':  # 容器重启会触发MODIFIED
-                            # terminated 终止，waiting 等待启动，running 运行中
-                            container_statuse = event['object'].status.container_statuses[0].state
-                            terminated = container_statuse.terminated
-                            # waiting = container_statuse.waiting
-                            # running = container_statuse.running
-                            service_name=event['object'].metadata.labels.get('app','')
-                            inferenceserving = dbsession.query(InferenceService).filter_by(name=service_name).first() if service_name else None
-                            if service_name and inferenceserving:
-                                # print(event['object'].status)
-                                if terminated and terminated.finished_at:  # 任务终止
-                                    finished_at = int(terminated.finished_at.astimezone(timezone(timedelta(hours=8))).timestamp())  # 要找事件发生的时间
-                                    if (datetime.now().timestamp() - finished_at) < 5:
-                                        message = "cluster: %s, pod: %s, user: %s, status: %s" % (cluster,event['object'].metadata.name,inferenceserving.created_by.username, 'terminated')
-                                        push_message([inferenceserving.created_by.username], message)
-                                # if running and running.started_at:  # 任务重启运行
-                                #     start_time = int(running.started_at.astimezone(timezone(timedelta(hours=8))).timestamp())  # 要找事件发生的时间
-                                #     if (datetime.now().timestamp() - start_time) < 5:
-                                #         message = "pod %s %s" % (event['object'].metadata.name, 'running')
-                                #         push_message([inferenceserving.created_by.username]+conf.get('ADMIN_USER').split(','), message)
+            if event['object'].status and event['object'].status.container_statuses and event["type"]=='MODIFIED':  # 容器重启会触发MODIFIED
+                # terminated 终止，waiting 等待启动，running 运行中
+                container_statuse = event['object'].status.container_statuses[0].state
+                terminated = container_statuse.terminated
+                # waiting = container_statuse.waiting
+                # running = container_statuse.running
+                service_name=event['object'].metadata.labels.get('app','')
+                inferenceserving = dbsession.query(InferenceService).filter_by(name=service_name).first() if service_name else None
+                if service_name and inferenceserving:
+                    # print(event['object'].status)
+                    if terminated and terminated.finished_at:  # 任务终止
+                        finished_at = int(terminated.finished_at.astimezone(timezone(timedelta(hours=8))).timestamp())  # 要找事件发生的时间
+                        if (datetime.now().timestamp() - finished_at) < 5:
+                            message = "cluster: %s, pod: %s, user: %s, status: %s" % (cluster,event['object'].metadata.name,inferenceserving.created_by.username, 'terminated')
+                            push_message([inferenceserving.created_by.username], message)
+                    # if running and running.started_at:  # 任务重启运行
+                    #     start_time = int(running.started_at.astimezone(timezone(timedelta(hours=8))).timestamp())  # 要找事件发生的时间
+                    #     if (datetime.now().timestamp() - start_time) < 5:
+                    #         message = "pod %s %s" % (event['object'].metadata.name, 'running')
+                    #         push_message([inferenceserving.created_by.username]+conf.get('ADMIN_USER').split(','), message)
+
+        except Exception as e:
+            print(e)
 
-                    except Exception as e:
-                        print(e)
 
-        except Exception as ee:
-            print(ee)
-            time.sleep(5)
+# @pysnooper.snoop()
+def listen_service():
+    namespace = conf.get('SERVICE_NAMESPACE')
+    # 从上次记录的resourceVersion继续watch，重连时不会重复处理所有pod
+    print('begin listen')
+    resumable_watch = ResumableWatch(k8s_client.v1.list_namespaced_pod, name='%s/service' % cluster, store=cache,
+                                     watch_timeout=conf.get('WATCH_TIMEOUT', 300), namespace=namespace)
+    resumable_watch.run(deal_event)
 
 
 # 不能使用异步io，因为stream会阻塞
@@ -3,13 +3,15 @@ import time, datetime, os
 from flask_babel import gettext as __
 from flask_babel import lazy_gettext as _
 from kubernetes import client
-from kubernetes import watch
 import json
 import math
+import threading
+import collections
 from myapp.utils.py.py_k8s import check_status_time, K8s
+from myapp.utils.py.py_k8s_informer import ResumableWatch
 from myapp.utils.py.py_prometheus import Prometheus
 from myapp.project import push_message
-from myapp import app
+from myapp import app, cache
 from myapp.models.model_job import (
     Pipeline,
     Workflow,
@@ -22,6 +24,18 @@ from myapp.utils.celery import session_scope
 conf = app.config
 prometheus = Prometheus(conf.get('PROMETHEUS', ''))
 
+# 事务中产生的消息先暂存，事务提交成功后再发送，避免回滚的处理也发出通知
+message_outbox = threading.local()
+
+
+def send_message(*args, **kwargs):
+    messages = getattr(message_outbox, 'messages', None)
+    if messages is None:
+        push_message(*args, **kwargs)
+    else:
+        messages.append((args, kwargs))
+
+
 cluster = os.getenv('ENVIRONMENT', '').lower()
 if not cluster:
     print('no cluster %s' % cluster)
@@ -30,7 +44,7 @@ else:
     clusters = conf.get('CLUSTERS', {})
     if clusters and cluster in clusters:
         kubeconfig = clusters[cluster].get('KUBECONFIG', '')
-        K8s(kubeconfig)
+        k8s_client = K8s(kubeconfig)
         # k8s_config.kube_config.load_kube_config(config_file=kubeconfig)
     else:
         print('no kubeconfig in cluster %s' % cluster)
@@ -81,14 +95,17 @@ def deliver_message(workflow, dbsession):
             __("pod详情"):help_url
         }
         if message:
-            push_message(receivers, message, link)
+            send_message(receivers, message, link)
 
 
 # 保存workflow记录
 # @pysnooper.snoop()
-def save_workflow(crd, dbsession):
+def save_workflow(crd, dbsession, batch_cache=None):
     pipeline_id = crd['labels'].get('pipeline-id', '')
-    pipeline = dbsession.query(Pipeline).filter_by(id=int(pipeline_id)).first()
+    if batch_cache is not None:
+        pipeline = batch_cache['pipeline'].get(int(pipeline_id))
+    else:
+        pipeline = dbsession.query(Pipeline).filter_by(id=int(pipeline_id)).first()
     if not pipeline:
         return None
 
@@ -101,7 +118,10 @@ def save_workflow(crd, dbsession):
     # print("%s status %s"%(crd['name'], crd['status']))
 
     # print(crd['name'],crd['namespace'])
-    workflow = dbsession.query(Workflow).filter(Workflow.name == crd['name']).filter(Workflow.namespace == crd['namespace']).first()
+    if batch_cache is not None:
+        workflow = batch_cache['workflow'].get((crd['name'], crd['namespace']))
+    else:
+        workflow = dbsession.query(Workflow).filter(Workflow.name == crd['name']).filter(Workflow.namespace == crd['namespace']).first()
     if workflow:
         print('exist workflow')
         workflow.status = crd['status']
@@ -111,7 +131,7 @@ def save_workflow(crd, dbsession):
         workflow.spec = json.dumps(crd['spec'], indent=4, ensure_ascii=False),
         workflow.status_more = json.dumps(crd['status_more'], indent=4, ensure_ascii=False)
         workflow.cluster = cluster
-        dbsession.commit()
+        dbsession.flush()
 
     else:
         info_json = {
@@ -131,21 +151,25 @@ def save_workflow(crd, dbsession):
                             username=username,
                             info_json=json.dumps(info_json, indent=4, ensure_ascii=False))
         dbsession.add(workflow)
-        dbsession.commit()
+        dbsession.flush()
+        if batch_cache is not None:
+            batch_cache['workflow'][(crd['name'], crd['namespace'])] = workflow
 
     # 更新runhistory
     pipeline_run_id = json.loads(workflow.labels).get("run-id", '')
     if pipeline_run_id:
-        run_history = dbsession.query(RunHistory).filter_by(run_id=pipeline_run_id).first()
+        if batch_cache is not None:
+            run_history = batch_cache['run_history'].get(pipeline_run_id)
+        else:
+            run_history = dbsession.query(RunHistory).filter_by(run_id=pipeline_run_id).first()
         if run_history:
             run_history.status = crd['status']
-            dbsession.commit()
+            dbsession.flush()
     return workflow
 
 
 # @pysnooper.snoop()
-def check_has_push(crd, dbsession):
-    workflow = dbsession.query(Workflow).filter(Workflow.name == crd['name']).filter(Workflow.namespace == crd['namespace']).first()
+def check_has_push(crd, workflow):
     if workflow and workflow.info_json:
         info_json = json.loads(workflow.info_json)
         if crd['status'] in info_json['alert_status'] and crd['status'] not in info_json['has_push']:
@@ -189,14 +213,14 @@ def push_resource_rec(workflow, dbsession):
                         if rec_memory != int(task.resource_memory.replace('G', '').replace('M', '')):
                             message += __("task(%s)，原申请mem:%s，近10次最大使用mem:%s(G)，新申请值:%s\n") % (task.label, task.resource_memory, max_memory, str(rec_memory) + "G")
                             task.resource_memory = str(rec_memory) + "G"
-                    dbsession.commit()
+                    dbsession.flush()
         if message != init_message:
             alert_user = pipeline.alert_user.split(',') if pipeline.alert_user else []
             alert_user = [user.strip() for user in alert_user if user.strip()]
             receivers = alert_user + [pipeline.created_by.username]
             receivers = list(set(receivers))
 
-            push_message(receivers, message)
+            send_message(receivers, message)
 
 
 # 推送训练耗时通知
@@ -257,21 +281,21 @@ def push_task_time(workflow, dbsession):
             else:
                 info_json['push_task_time'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 workflow.info_json = json.dumps(info_json, indent=4, ensure_ascii=False)
-                dbsession.commit()
+                dbsession.flush()
                 message += "\n"
                 link = {
                     "点击查看资源的使用": "http://%s/pipeline_modelview/api/web/monitoring/%s" % (conf.get('HOST'), pipeline_id)
                 }
                 # 有单任务运行时长超过4个小时才通知
                 if max_task_run_time > 4:
-                    push_message(conf.get('ADMIN_USER').split(','), message, link)
+                    send_message(conf.get('ADMIN_USER').split(','), message, link)
 
                 alert_user = pipeline.alert_user.split(',') if pipeline.alert_user else []
                 alert_user = [user.strip() for user in alert_user if user.strip()]
                 receivers = alert_user + [workflow.username]
                 receivers = list(set(receivers))
 
-                push_message(receivers, message, link)
+                send_message(receivers, message, link)
 
 
 # @pysnooper.snoop()
@@ -320,7 +344,7 @@ def save_monitoring(workflow, dbsession):
                     print(monitoring_new)
                     if task:
                         task.monitoring = json.dumps(monitoring_new, ensure_ascii=False, indent=4)
-                        dbsession.commit()
+                        dbsession.flush()
 
             push_task_time(workflow, dbsession)
 
@@ -339,84 +363,219 @@ def save_history(workflow, dbsession):
     else:
         info_json['has_push'] = workflow.status
     workflow.info_json = json.dumps(info_json, indent=4, ensure_ascii=False)
-    dbsession.commit()
-
+    dbsession.flush()
+
+
+# 按workflow合并事件的队列，同一个workflow只保留最新的事件，由后台线程批量处理
+class WorkflowEventQueue():
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = collections.OrderedDict()   # (namespace, name) -> (crd_object, 首次入队时间, 合并的事件resourceVersion列表)
+        self.metrics = {
+            "received": 0,
+            "coalesced": 0,
+            "processed": 0,
+            "batches": 0,
+            "lag": 0,
+            "throughput": 0
+        }
 
-# @pysnooper.snoop()
-def check_crd_exist(group, version, namespace, plural, name):
-    exist_crd = client.CustomObjectsApi().get_namespaced_custom_object(group, version, namespace, plural, name)
-    return exist_crd
+    def put(self, crd_object, resource_version=None):
+        key = (crd_object['metadata'].get('namespace', ''), crd_object['metadata']['name'])
+        versions = [resource_version] if resource_version else []
+        with self.condition:
+            self.metrics['received'] += 1
+            if key in self.events:
+                self.metrics['coalesced'] += 1
+                # 保留首次入队时间，用于统计延迟。被合并的事件随新事件一起确认
+                self.events[key] = (crd_object, self.events[key][1], self.events[key][2] + versions)
+            else:
+                self.events[key] = (crd_object, time.time(), versions)
+            self.condition.notify()
+
+    # 处理失败的事件重新入队，期间已经有更新事件的workflow以新事件为准
+    def requeue(self, batch):
+        with self.condition:
+            for crd_object, enqueue_time, versions in batch:
+                key = (crd_object['metadata'].get('namespace', ''), crd_object['metadata']['name'])
+                if key in self.events:
+                    self.events[key] = (self.events[key][0], enqueue_time, versions + self.events[key][2])
+                else:
+                    self.events[key] = (crd_object, enqueue_time, versions)
+                self.events.move_to_end(key, last=False)
+            self.condition.notify()
+
+    def get_batch(self, max_size, wait_seconds):
+        with self.condition:
+            if not self.events:
+                self.condition.wait(wait_seconds)
+            batch = []
+            while self.events and len(batch) < max_size:
+                batch.append(self.events.popitem(last=False)[1])
+            return batch
+
+    def record(self, batch, begin_time):
+        now = time.time()
+        with self.condition:
+            self.metrics['processed'] += len(batch)
+            self.metrics['batches'] += 1
+            self.metrics['lag'] = round(now - min([enqueue_time for crd_object, enqueue_time, versions in batch]), 3)
+            self.metrics['throughput'] = round(len(batch) / max(now - begin_time, 0.001), 1)
+            metrics = dict(self.metrics, pending=len(self.events))
+        stats_logger = conf.get('STATS_LOGGER')
+        if stats_logger:
+            try:
+                stats_logger.timing('watch_workflow.lag', metrics['lag'] * 1000)
+                stats_logger.timing('watch_workflow.batch_time', (now - begin_time) * 1000)
+                stats_logger.incr('watch_workflow.processed', len(batch))
+                stats_logger.gauge('watch_workflow.pending', metrics['pending'])
+                stats_logger.gauge('watch_workflow.throughput', metrics['throughput'])
+            except Exception as e:
+                print(e)
+        print('deal events: %s' % json.dumps(metrics))
+
+
+event_queue = WorkflowEventQueue()
+
+
+# 将事件中的crd对象转换为需要记录的信息，直接使用事件中的对象，不再重新查询apiserver
+def make_crd_object(crd_object):
+    creat_time = crd_object['metadata']['creationTimestamp'].replace('T', ' ').replace('Z', '')
+    creat_time = (datetime.datetime.strptime(creat_time,'%Y-%m-%d %H:%M:%S')+datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
+    # 不能直接使用里面的状态
+    status = ''
+    if 'status' in crd_object and 'nodes' in crd_object['status']:
+        keys = list(crd_object['status']['nodes'].keys())
+        status = crd_object['status']['nodes'][keys[-1]]['phase']
+        if status != 'Pending':
+            status = crd_object['status']['phase']
+
+    back_object = {
+        "name": crd_object['metadata']['name'],
+        "namespace": crd_object['metadata']['namespace'] if 'namespace' in crd_object['metadata'] else '',
+        "annotations": crd_object['metadata'].get('annotations', {}),
+        "labels": crd_object['metadata'].get('labels', {}),
+        "spec": crd_object['spec'],
+        "create_time": creat_time,
+        "status": status,
+        "status_more": check_status_time(crd_object['status']) if 'status' in crd_object else {}
+    }
+
+    if 'run-rtx' in back_object['labels']:
+        back_object['username'] = back_object['labels']['run-rtx']
+    elif 'pipeline-rtx' in back_object:
+        back_object['username'] = back_object['labels']['pipeline-rtx']
+    return back_object
 
 
 # @pysnooper.snoop()
-def deal_event(event, workflow_info, namespace):
-    with session_scope(nullpool=True) as dbsession:
+def deal_event(back_object, dbsession, batch_cache=None):
+    workflow = save_workflow(back_object, dbsession, batch_cache)
+    if workflow:
+        has_push = check_has_push(back_object, workflow)
+        if not has_push:
+            try:
+                deliver_message(workflow, dbsession)
+            except Exception as e1:
+                print('push fail:', e1)
+                send_message(conf.get('ADMIN_USER').split(','), 'push fail' + str(e1))
+        save_history(workflow, dbsession)
+        save_monitoring(workflow, dbsession)
+
+
+# 一批事件在同一个事务中处理，批量查询依赖的数据，每个事件使用savepoint，单个事件失败不影响其他事件
+# 事务提交失败时整批事件重新入队，消息在提交成功后才发送。返回是否提交成功
+# @pysnooper.snoop()
+def deal_events(batch):
+    back_objects = []
+    for crd_object, enqueue_time, versions in batch:
         try:
-            crd_object = event['object']
-            exist_crd = check_crd_exist(group=workflow_info['group'], version=workflow_info["version"], namespace=namespace,plural=workflow_info["plural"], name=crd_object['metadata']['name'])
-            if not exist_crd:
-                print('not exist in k8s')
-                return
-            creat_time = crd_object['metadata']['creationTimestamp'].replace('T', ' ').replace('Z', '')
-            creat_time = (datetime.datetime.strptime(creat_time,'%Y-%m-%d %H:%M:%S')+datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
-            # 不能直接使用里面的状态
-            status = ''
-            if 'status' in crd_object and 'nodes' in crd_object['status']:
-                keys = list(crd_object['status']['nodes'].keys())
-                status = crd_object['status']['nodes'][keys[-1]]['phase']
-                if status != 'Pending':
-                    status = crd_object['status']['phase']
-
-            back_object = {
-                "name": crd_object['metadata']['name'],
-                "namespace": crd_object['metadata']['namespace'] if 'namespace' in crd_object['metadata'] else '',
-                "annotations": crd_object['metadata'].get('annotations', {}),
-                "labels": crd_object['metadata'].get('labels', {}),
-                "spec": crd_object['spec'],
-                "create_time": creat_time,
-                "status": status,
-                "status_more": check_status_time(crd_object['status']) if 'status' in crd_object else {}
+            back_objects.append(make_crd_object(crd_object))
+        except Exception as e:
+            print(e)
+    if not back_objects:
+        return True
+
+    messages = []
+    try:
+        with session_scope(nullpool=True) as dbsession:
+            pipeline_ids = list(set([int(back_object['labels'].get('pipeline-id')) for back_object in back_objects if str(back_object['labels'].get('pipeline-id', '')).isdigit()]))
+            names = list(set([back_object['name'] for back_object in back_objects]))
+            run_ids = list(set([back_object['labels'].get('run-id') for back_object in back_objects if back_object['labels'].get('run-id', '')]))
+            batch_cache = {
+                "pipeline": dict((pipeline.id, pipeline) for pipeline in dbsession.query(Pipeline).filter(Pipeline.id.in_(pipeline_ids)).all()) if pipeline_ids else {},
+                "workflow": dict(((workflow.name, workflow.namespace), workflow) for workflow in dbsession.query(Workflow).filter(Workflow.name.in_(names)).all()) if names else {},
+                "run_history": dict((run_history.run_id, run_history) for run_history in dbsession.query(RunHistory).filter(RunHistory.run_id.in_(run_ids)).all()) if run_ids else {}
             }
+            for back_object in back_objects:
+                savepoint = dbsession.begin_nested()
+                message_outbox.messages = []
+                try:
+                    deal_event(back_object, dbsession, batch_cache)
+                    savepoint.commit()
+                    messages += message_outbox.messages
+                except Exception as e:
+                    print(e)
+                    savepoint.rollback()
+                    batch_cache['workflow'].pop((back_object['name'], back_object['namespace']), None)
+                finally:
+                    message_outbox.messages = None
+    except Exception as e:
+        print('commit events fail, requeue %s events: %s' % (len(batch), e))
+        event_queue.requeue(batch)
+        return False
+
+    for args, kwargs in messages:
+        try:
+            push_message(*args, **kwargs)
+        except Exception as e:
+            print('push fail:', e)
+    return True
 
-            if 'run-rtx' in back_object['labels']:
-                back_object['username'] = back_object['labels']['run-rtx']
-            elif 'pipeline-rtx' in back_object:
-                back_object['username'] = back_object['labels']['pipeline-rtx']
-            workflow = save_workflow(back_object, dbsession)
-            if workflow:
-                has_push = check_has_push(back_object, dbsession)
-                if not has_push:
-                    try:
-                        deliver_message(workflow, dbsession)
-                    except Exception as e1:
-                        print('push fail:', e1)
-                        push_message(conf.get('ADMIN_USER').split(','), 'push fail' + str(e1))
-                save_history(workflow, dbsession)
-                save_monitoring(workflow, dbsession)
 
+# 后台批量处理事件，事务提交成功后通过commit_func确认这批事件的resourceVersion
+def consume_events(commit_func=None):
+    batch_size = conf.get('WATCH_WORKFLOW_BATCH_SIZE', 100)
+    batch_interval = conf.get('WATCH_WORKFLOW_BATCH_INTERVAL', 1)
+    while True:
+        batch = event_queue.get_batch(batch_size, batch_interval)
+        if not batch:
+            continue
+        begin_time = time.time()
+        try:
+            success = deal_events(batch)
         except Exception as e:
             print(e)
+            success = False
+        if not success:
+            # 数据库异常时稍后重试
+            time.sleep(5)
+            continue
+        if commit_func:
+            commit_func([version for crd_object, enqueue_time, versions in batch for version in versions])
+        event_queue.record(batch, begin_time)
 
 
 # @pysnooper.snoop()
 def listen_workflow():
     workflow_info = conf.get('CRD_INFO')['workflow']
     namespace = conf.get('PIPELINE_NAMESPACE')  # 不仅这一个命名空间
-    w = watch.Watch()
-    while (True):
-        try:
-            print('begin listen')
-            for event in w.stream(client.CustomObjectsApi().list_namespaced_custom_object, group=workflow_info['group'],
-                                  version=workflow_info["version"],
-                                  namespace=namespace, plural=workflow_info["plural"]):  # label_selector=label,
-                if event['type'] == 'ADDED' or event['type'] == 'MODIFIED':  # ADDED  MODIFIED DELETED
-                    deal_event(event, workflow_info, namespace)
-                elif event['type'] == 'ERROR':
-                    w = watch.Watch()
-                    time.sleep(60)
-
-        except Exception as ee:
-            print(ee)
+
+    # 从上次提交到数据库的resourceVersion继续watch，重连时不会重复处理所有workflow
+    print('begin listen')
+    resumable_watch = ResumableWatch(k8s_client.CustomObjectsApi.list_namespaced_custom_object, name='%s/workflow' % cluster, store=cache,
+                                     watch_timeout=conf.get('WATCH_TIMEOUT', 300), manual_commit=True,
+                                     group=workflow_info['group'], version=workflow_info["version"], namespace=namespace, plural=workflow_info["plural"])
+    threading.Thread(target=consume_events, args=(resumable_watch.commit,), name='consume-workflow-events', daemon=True).start()
+
+    def handle_event(event):
+        if event['type'] == 'ADDED' or event['type'] == 'MODIFIED':  # ADDED  MODIFIED DELETED
+            event_queue.put(event['object'], event['resource_version'])
+        else:
+            resumable_watch.commit([event['resource_version']])
+
+    resumable_watch.run(handle_event)
 
 
 # 不能使用异步io，因为stream会阻塞
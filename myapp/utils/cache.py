@@ -1,11 +1,153 @@
-from flask import request
+import time
+import pickle
+import hashlib
+import logging
+import threading
+import functools
+from collections import OrderedDict
+from flask import request, g, current_app
+from flask_babel import get_locale
+from werkzeug.wrappers import Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# 进程内的LRU缓存，超过容量淘汰最久未访问的，超过有效期的在读取时淘汰
+class LRUCache():
+
+    def __init__(self, max_size=1000, timeout=600):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.data = OrderedDict()   # key -> (expire_time, value)
+
+    # 返回 (是否命中, 值)，值本身可以是None
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return False, None
+            expire_time, value = item
+            if expire_time and expire_time < time.time():
+                del self.data[key]
+                return False, None
+            self.data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            self.data[key] = (time.time() + timeout if timeout else 0, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [key for key in self.data if key.startswith(prefix)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+# redis缓存，多个web进程之间共享，值使用pickle序列化
+class RedisCache():
+
+    def __init__(self, url, prefix='memoize/', timeout=600):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return False, None
+        return True, pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        value = pickle.dumps(value)
+        if timeout:
+            self.client.setex(self.prefix + key, int(timeout), value)
+        else:
+            self.client.set(self.prefix + key, value)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def delete_prefix(self, prefix):
+        for key in self.client.scan_iter(match=self.prefix + prefix + '*', count=500):
+            self.client.delete(key)
+
+    def clear(self):
+        self.delete_prefix('')
+
+
+memoize_backend = None
+memoize_backend_lock = threading.Lock()
+# 命中统计，同时上报到STATS_LOGGER
+memoize_metrics = {
+    "hit": 0,
+    "miss": 0,
+    "error": 0
+}
+
+
+# 根据配置选择缓存后端，MEMOIZE_BACKEND=redis时复用celery broker的redis，redis不可用时回退到进程内缓存
+def get_memoize_backend():
+    global memoize_backend
+    if memoize_backend is not None:
+        return memoize_backend
+    with memoize_backend_lock:
+        if memoize_backend is not None:
+            return memoize_backend
+        conf = current_app.config
+        timeout = conf.get('MEMOIZE_DEFAULT_TIMEOUT', 600)
+        if conf.get('MEMOIZE_BACKEND', 'memory') == 'redis':
+            url = conf.get('MEMOIZE_REDIS_URL', '') or getattr(conf.get('CELERY_CONFIG'), 'broker_url', '')
+            try:
+                backend = RedisCache(url, timeout=timeout)
+                backend.client.ping()
+                memoize_backend = backend
+                return memoize_backend
+            except Exception as e:
+                logging.error('memoize redis backend unavailable, use memory cache: %s', e)
+        memoize_backend = LRUCache(max_size=conf.get('MEMOIZE_MAX_SIZE', 1000), timeout=timeout)
+        return memoize_backend
+
+
+def record_metric(name):
+    memoize_metrics[name] += 1
+    stats_logger = current_app.config.get('STATS_LOGGER')
+    if stats_logger:
+        stats_logger.incr('memoize.' + name)
+
+
+# 删除某个前缀的缓存，例如数据变更后清理相关页面的缓存
+def clear_memoized(prefix=''):
+    try:
+        get_memoize_backend().delete_prefix(prefix)
+    except Exception as e:
+        logging.error('clear memoized cache error: %s', e)
+
 
 def view_cache_key(*unused_args, **unused_kwargs) -> str:
-    args_hash = hash(frozenset(request.args.items()))
-    return "view/{}/{}".format(request.path, args_hash)
+    # 请求参数排序后哈希，同时区分域名，用户和语言，避免不同用户看到彼此的页面
+    args = sorted((key, tuple(request.args.getlist(key))) for key in request.args)
+    args_hash = hashlib.md5(repr(args).encode('utf-8')).hexdigest()
+    user_id = g.user.get_id() if getattr(g, 'user', None) and g.user.get_id() else ''
+    locale = str(get_locale())
+    return "view/{}{}/{}/{}/{}".format(request.host, request.path, user_id, locale, args_hash)
 
 
-def memoized_func(key=view_cache_key, attribute_in_key=None):
+def memoized_func(key=view_cache_key, attribute_in_key=None, timeout=None):
     """Use this decorator to cache functions that have predefined first arg.
 
     enable_cache is treated as True by default,
@@ -14,18 +156,123 @@ def memoized_func(key=view_cache_key, attribute_in_key=None):
     force means whether to force refresh the cache and is treated as False by default,
     except force = True is passed to the decorated function.
 
-    timeout of cache is set to 600 seconds by default,
+    timeout of cache is set to 600 seconds by default (MEMOIZE_DEFAULT_TIMEOUT),
     except cache_timeout = {timeout in seconds} is passed to the decorated function.
 
-    memoized_func uses simple_cache and stored the data in memory.
+    memoized_func stores the data in an in-process LRU cache, or in redis
+    when MEMOIZE_BACKEND = 'redis'. Flask responses are cached by body,
+    status and headers, and only successful responses are cached.
     Key is a callable function that takes function arguments and
-    returns the caching key.
+    returns the caching key, returning None skips the cache.
     """
     def wrap(f):
-        # noop
-        def wrapped_f(self, *args, **kwargs):
-            return f(self, *args, **kwargs)
+        @functools.wraps(f)
+        def wrapped_f(*args, **kwargs):
+            enable_cache = kwargs.pop('enable_cache', True)
+            force = kwargs.pop('force', False)
+            cache_timeout = kwargs.pop('cache_timeout', timeout)
+            if not enable_cache:
+                return f(*args, **kwargs)
+
+            try:
+                cache_key = key(*args, **kwargs)
+                if cache_key is not None:
+                    cache_key = '%s.%s/%s' % (f.__module__, f.__qualname__, cache_key)
+                    if attribute_in_key and args:
+                        cache_key += '/%s' % getattr(args[0], attribute_in_key, '')
+                backend = get_memoize_backend()
+            except Exception as e:
+                logging.error('memoized key error: %s', e)
+                cache_key = None
+            if cache_key is None:
+                return f(*args, **kwargs)
+
+            if not force:
+                try:
+                    hit, value = backend.get(cache_key)
+                except Exception as e:
+                    logging.error('memoized get error: %s', e)
+                    record_metric('error')
+                    hit, value = False, None
+                if hit:
+                    record_metric('hit')
+                    if isinstance(value, dict) and value.get('__response__'):
+                        return current_app.response_class(value['data'], status=value['status'], headers=value['headers'])
+                    return value
+            record_metric('miss')
+
+            result = f(*args, **kwargs)
+            value = result
+            if isinstance(result, Response):
+                if result.status_code != 200 or result.direct_passthrough:
+                    return result
+                value = {
+                    "__response__": True,
+                    "data": result.get_data(),
+                    "status": result.status_code,
+                    "headers": [(k, v) for k, v in result.headers.items() if k.lower() not in ('set-cookie', 'content-length')]
+                }
+            try:
+                backend.set(cache_key, value, timeout=cache_timeout)
+            except Exception as e:
+                logging.error('memoized set error: %s', e)
+                record_metric('error')
+            return result
 
         return wrapped_f
 
     return wrap
+
+
+# 数据表的版本号，表中数据有变化时版本号加1。缓存的key中带上依赖表的版本号，依赖表变化后缓存自动失效
+# 版本号保存在共享的flask_caching中，多个web进程和worker之间一致。只有被依赖的表才会记录版本号
+watched_tables = set()
+
+
+def watch_tables(tables):
+    watched_tables.update(tables)
+
+
+def get_table_versions(tables):
+    from myapp import cache
+    tables = sorted(tables)
+    if not tables:
+        return {}
+    try:
+        versions = cache.get_many(*['table_version/' + table for table in tables])
+    except Exception as e:
+        logging.error('get table versions error: %s', e)
+        versions = [None] * len(tables)
+    return dict((table, int(version or 0)) for table, version in zip(tables, versions))
+
+
+# flush时只记录有修改的表，事务提交后才更新版本号，避免其他请求在提交前用旧数据重建缓存，回滚时丢弃
+@event.listens_for(Session, 'after_flush')
+def record_changed_tables(session, flush_context):
+    if not watched_tables:
+        return
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table_name = getattr(obj, '__tablename__', None)
+        if table_name in watched_tables:
+            session.info.setdefault('changed_tables', set()).add(table_name)
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_table_versions(session):
+    tables = session.info.pop('changed_tables', None)
+    if not tables:
+        return
+    try:
+        from myapp import cache
+        for table_name in tables:
+            # flask_caching的Cache没有inc，用后端(redis)的原子自增
+            cache.cache.inc('table_version/' + table_name)
+    except Exception as e:
+        logging.error('bump table versions error: %s', e)
+
+
+@event.listens_for(Session, 'after_rollback')
+def clear_changed_tables(session):
+    # savepoint回滚时外层事务的修改还在，不清理
+    if not session.in_nested_transaction():
+        session.info.pop('changed_tables', None)
@@ -5,21 +5,65 @@ from contextlib2 import contextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy.pool import NullPool
+import os
+import atexit
+import threading
 import logging
 from myapp import app, db
 
+# 每个进程一个engine和sessionmaker，key为进程号。
+# 连接不能跨fork使用，所以fork后的子进程丢弃继承来的engine，在第一次使用时重新创建
+process_engines = {}
+process_engines_lock = threading.Lock()
 
-# Null pool is used for the celery workers due process forking side effects.
+
+def get_session_class():
+    pid = os.getpid()
+    session_class = process_engines.get(pid, (None, None))[1]
+    if session_class:
+        return session_class
+    with process_engines_lock:
+        if pid not in process_engines:
+            # 其他进程号的engine都是从父进程继承的，不能关闭父进程的连接，直接丢弃
+            process_engines.clear()
+            engine = create_engine(
+                app.config["SQLALCHEMY_DATABASE_URI"],
+                pool_size=app.config.get('SESSION_SCOPE_POOL_SIZE', 2),
+                max_overflow=app.config.get('SESSION_SCOPE_MAX_OVERFLOW', 10),
+                pool_recycle=app.config.get('SQLALCHEMY_POOL_RECYCLE', 300),
+                pool_pre_ping=True
+            )
+            process_engines[pid] = (engine, sessionmaker(bind=engine))
+        return process_engines[pid][1]
+
+
+# 关闭当前进程的连接池，在celery worker进程退出或者watch进程退出时调用
+def dispose_engine():
+    with process_engines_lock:
+        engine = process_engines.pop(os.getpid(), (None, None))[0]
+    if engine:
+        engine.dispose()
+
+
+# fork后的子进程直接丢弃继承来的engine，锁也可能在fork时被其他线程持有，一并重建
+def reset_engines():
+    global process_engines_lock
+    process_engines_lock = threading.Lock()
+    process_engines.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_engines)
+# 非celery的常驻进程(watch_workflow等)退出时关闭连接
+atexit.register(dispose_engine)
+
+
+# celery workers and watchers use a per-process engine with a small pool, created after fork.
 @contextmanager
 def session_scope(nullpool: bool) -> Iterator[Session]:
     """Provide a transactional scope around a series of operations."""
-    database_uri = app.config["SQLALCHEMY_DATABASE_URI"]
     if nullpool:
-        engine = create_engine(database_uri, poolclass=NullPool)
-        session_class = sessionmaker()
-        session_class.configure(bind=engine)
-        session = session_class()
+        session = get_session_class()()
     else:
         session = db.session()
         session.commit()  # HACK
@@ -8,13 +8,16 @@ from email.mime.text import MIMEText
 from email.utils import formatdate
 import errno
 import functools
+import concurrent.futures
+import threading
+from collections import OrderedDict
 import json
 import logging
 import os
 import signal
 import copy
 import sys
-from time import struct_time
+from time import struct_time, monotonic
 import traceback
 from typing import List, Optional, Tuple
 from urllib.parse import unquote_plus
@@ -104,9 +107,10 @@ class _memoized:  # noqa
     should account for instance variable changes.
     """
 
-    def __init__(self, func, watch=()):
+    def __init__(self, func, watch=(), max_size=1000):
         self.func = func
-        self.cache = {}
+        self.cache = OrderedDict()
+        self.max_size = max_size
         self.is_method = False
         self.watch = watch
 
@@ -115,11 +119,18 @@ class _memoized:  # noqa
         if self.is_method:
             key.append(tuple([getattr(args[0], v, None) for v in self.watch]))
         key = tuple(key)
-        if key in self.cache:
-            return self.cache[key]
+        try:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        except TypeError:
+            return self.func(*args, **kwargs)
         try:
             value = self.func(*args, **kwargs)
             self.cache[key] = value
+            # 超过容量淘汰最久未访问的结果
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
             return value
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
@@ -1977,6 +1988,74 @@ def split_url(url):
         return host,port,''
 
 
+# 每层fan_out使用单独的线程池，嵌套的fan_out(例如并发查询集群时再按命名空间并发)不会等待被外层任务占满的线程池
+fan_out_executors = {}
+fan_out_executor_lock = threading.Lock()
+fan_out_local = threading.local()
+
+
+def get_fan_out_executor(depth):
+    from myapp import conf
+    with fan_out_executor_lock:
+        if depth not in fan_out_executors:
+            fan_out_executors[depth] = concurrent.futures.ThreadPoolExecutor(max_workers=conf.get('K8S_FANOUT_MAX_WORKERS', 16), thread_name_prefix='fan-out-%s' % depth)
+        return fan_out_executors[depth]
+
+
+# 当前fan_out任务剩余的时间，线程内的k8s请求以此作为请求超时，超时的任务不会一直占用线程。不在fan_out中时返回None
+def get_fan_out_timeout():
+    deadline = getattr(fan_out_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return max(deadline - monotonic(), 1)
+
+
+# 并发执行多个集群(或集群+命名空间)上的查询，整体耗时取决于最慢的集群而不是所有集群之和
+# 超时或者异常的任务不影响其他任务的结果，返回 (成功的结果, 失败的原因)
+def fan_out(func, args_dict, timeout=None):
+    from myapp import app, conf
+    if timeout is None:
+        timeout = conf.get('K8S_FANOUT_TIMEOUT', 30)
+    depth = getattr(fan_out_local, 'depth', 0)
+    deadline = monotonic() + timeout
+    # 嵌套时不超过外层任务的剩余时间
+    if getattr(fan_out_local, 'deadline', None) is not None:
+        deadline = min(deadline, fan_out_local.deadline)
+    executor = get_fan_out_executor(depth)
+
+    # 线程中没有flask上下文，推送消息和翻译等操作需要app上下文
+    def run_in_app_context(*args):
+        fan_out_local.depth = depth + 1
+        fan_out_local.deadline = deadline
+        try:
+            with app.app_context():
+                return func(*args)
+        finally:
+            fan_out_local.depth = 0
+            fan_out_local.deadline = None
+
+    futures = {}
+    for key in args_dict:
+        args = args_dict[key]
+        futures[executor.submit(run_in_app_context, *(args if type(args) == tuple else (args,)))] = key
+
+    results = {}
+    errors = {}
+    done, not_done = concurrent.futures.wait(futures, timeout=max(deadline - monotonic(), 0))
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            logging.error('fan out %s error: %s', futures[future], e)
+            errors[futures[future]] = str(e)
+    for future in not_done:
+        # 还没开始的任务直接取消，已经在运行的任务k8s请求有超时，会很快结束
+        future.cancel()
+        logging.error('fan out %s timeout after %s seconds', futures[future], timeout)
+        errors[futures[future]] = 'timeout'
+    return results, errors
+
+
 # @pysnooper.snoop()
 def get_all_resource(cluster='all',namespace='all',exclude_pod=[]):
     import pandas
@@ -1993,12 +2072,16 @@ def get_all_resource(cluster='all',namespace='all',exclude_pod=[]):
     else:
         namespaces=[namespace]
 
+    def get_namespace_pods(kubeconfig, namespace):
+        return K8s(kubeconfig).get_pods(namespace=namespace) or []
+
+    # 并发查询所有集群所有命名空间的pod，超时的集群只丢弃该集群的数据
+    all_pods, errors = fan_out(get_namespace_pods, dict(((cluser_name, namespace), (clusters[cluser_name].get('KUBECONFIG', ''), namespace)) for cluser_name in clusters for namespace in namespaces))
+
     all_resource = []
     for cluser_name in clusters:
-        cluster = clusters[cluser_name]
-        k8s_client = K8s(cluster.get('KUBECONFIG', ''))
         for namespace in namespaces:
-            pods = k8s_client.get_pods(namespace=namespace)
+            pods = all_pods.get((cluser_name, namespace), [])
             for pod in pods:
                 # 集群，资源组，空间，项目组，用户，resource，值
                 user = pod['labels'].get('user', pod['labels'].get('username', pod['labels'].get('run-rtx',pod['labels'].get('rtx-user','admin'))))
@@ -2043,8 +2126,170 @@ def get_not_black_port(port):
         port+=1
     return meet_port
 
+# 机器资源快照在缓存中的key，快照由定时任务统一采集，各web进程只读取快照，不再各自查询集群
+NODE_RESOURCE_SNAPSHOT_KEY = 'node_resource_snapshot'
+node_resource_snapshot_lock = threading.Lock()
+local_node_resource_snapshot = {}   # 没有配置缓存时，在进程内保存快照
+
+
+# 采集所有集群的机器容量和已分配资源，每个集群按列存储，只保留页面需要的字段
+def collect_node_resource():
+    from myapp.utils.py.py_k8s import K8s
+    from myapp import conf
+    gpu_resource = list(conf.get('GPU_RESOURCE', {}).keys())
+    columns = ['name', 'hostip', 'status', 'labels', 'cpu', 'memory', 'used_cpu', 'used_memory', 'used_gpu'] + gpu_resource + ['used_' + gpu_mfrs for gpu_mfrs in gpu_resource]
+
+    def get_cluster_node(kubeconfig):
+        k8s_client = K8s(kubeconfig)
+        all_node = k8s_client.get_node()
+        all_node_resource = k8s_client.get_all_node_allocated_resources()
+        cluster_nodes = dict((column, []) for column in columns)
+        for node in all_node:
+            node.update(all_node_resource.get(node['name'], {
+                "used_cpu": 0,
+                "used_memory": 0,
+                "used_gpu": 0
+            }))
+            for column in columns:
+                default = {} if column == 'labels' else ('' if column in ['name', 'hostip', 'status'] else 0)
+                cluster_nodes[column].append(node.get(column, default) or default)
+        return cluster_nodes
+
+    # 各集群并发查询，查询失败的集群沿用上一次快照的数据
+    clusters = conf.get('CLUSTERS', {})
+    all_cluster_nodes, errors = fan_out(get_cluster_node, dict((cluster_name, clusters[cluster_name].get('KUBECONFIG', '')) for cluster_name in clusters))
+    if errors:
+        last_snapshot = read_node_resource_snapshot() or {}
+        for cluster_name in errors:
+            if cluster_name in last_snapshot.get('clusters', {}):
+                all_cluster_nodes[cluster_name] = last_snapshot['clusters'][cluster_name]
+
+    snapshot = {
+        "check_time": datetime.now().timestamp(),
+        "gpu_resource": gpu_resource,
+        "clusters": {},
+        "load": {}
+    }
+    for cluster_name in clusters:
+        if cluster_name not in all_cluster_nodes:
+            continue
+        cluster_nodes = all_cluster_nodes[cluster_name]
+        snapshot['clusters'][cluster_name] = cluster_nodes
+        # 集群整体的资源总量和申请量，供整体资源页面的图表使用
+        snapshot['load'][cluster_name] = {
+            "cpu_req": sum([int(x) for x in cluster_nodes['used_cpu']]),
+            "cpu_all": sum([int(x) for x in cluster_nodes['cpu']]),
+            "mem_req": sum([int(x) for x in cluster_nodes['used_memory']]),
+            "mem_all": sum([int(x) for x in cluster_nodes['memory']]),
+            "gpu_req": round(sum([round(x, 2) for gpu_mfrs in gpu_resource for x in cluster_nodes['used_' + gpu_mfrs]]), 2),
+            "gpu_all": sum([int(float(x)) for gpu_mfrs in gpu_resource for x in cluster_nodes[gpu_mfrs]])
+        }
+    return snapshot
+
+
+# 把列存储的快照还原为 ip -> 机器信息
+def get_snapshot_nodes(cluster_nodes):
+    columns = list(cluster_nodes.keys())
+    nodes = {}
+    for values in zip(*[cluster_nodes[column] for column in columns]):
+        node = dict(zip(columns, values))
+        nodes[node['hostip']] = node
+    return nodes
+
+
+def read_node_resource_snapshot():
+    from myapp import cache
+    if cache:
+        try:
+            return cache.get(NODE_RESOURCE_SNAPSHOT_KEY)
+        except Exception as e:
+            logging.error('read node resource snapshot error: %s', e)
+    return local_node_resource_snapshot.get('data')
+
+
+def save_node_resource_snapshot(snapshot):
+    from myapp import cache, conf
+    local_node_resource_snapshot['data'] = snapshot
+    if cache:
+        try:
+            cache.set(NODE_RESOURCE_SNAPSHOT_KEY, snapshot, timeout=conf.get('NODE_RESOURCE_SNAPSHOT_MAX_AGE', 60) * 10)
+        except Exception as e:
+            logging.error('save node resource snapshot error: %s', e)
+
+
+# 读取机器资源快照，快照不存在或者过期(采集任务未运行)时，由一个进程实时采集一次并写回缓存
+def get_node_resource_snapshot():
+    from myapp import cache, conf
+    max_age = conf.get('NODE_RESOURCE_SNAPSHOT_MAX_AGE', 60)
+    snapshot = read_node_resource_snapshot()
+    if snapshot and datetime.now().timestamp() - snapshot.get('check_time', 0) < max_age:
+        return snapshot
+    with node_resource_snapshot_lock:
+        # 等锁期间可能已经被其他线程更新
+        new_snapshot = read_node_resource_snapshot()
+        if new_snapshot and datetime.now().timestamp() - new_snapshot.get('check_time', 0) < max_age:
+            return new_snapshot
+        # 多个进程同时发现过期时，只有拿到锁的进程采集，其他进程先返回旧快照
+        if snapshot and cache:
+            try:
+                if not cache.add(NODE_RESOURCE_SNAPSHOT_KEY + '_lock', 1, timeout=conf.get('K8S_FANOUT_TIMEOUT', 30)):
+                    return snapshot
+            except Exception as e:
+                logging.error('lock node resource snapshot error: %s', e)
+        snapshot = collect_node_resource()
+        save_node_resource_snapshot(snapshot)
+        return snapshot
+
+
+# 获取各集群由pod informer增量维护的资源占用索引，任意集群不可用时返回None
+def get_resource_indexes():
+    from myapp.utils.py.py_k8s import K8s
+    from myapp import conf
+    resource_indexes = {}
+    for cluster_name in conf.get('CLUSTERS', {}):
+        cluster = conf.get('CLUSTERS')[cluster_name]
+        resource_index = K8s(cluster.get('KUBECONFIG', '')).get_resource_index(cluster_name)
+        if not resource_index:
+            return None
+        resource_indexes[cluster_name] = resource_index
+    return resource_indexes
+
+
+# 已占用资源的查询，优先使用资源索引直接按维度查询，索引不可用时实时查询所有pod后过滤
+class ExistResource():
+
+    def __init__(self, exclude_pod=[]):
+        self.exclude_pod = exclude_pod
+        self.resource_indexes = get_resource_indexes()
+        self.all_resources = get_all_resource(exclude_pod=exclude_pod) if self.resource_indexes is None else []
+
+    def get_indexes(self, cluster):
+        if cluster == 'all':
+            return list(self.resource_indexes.values())
+        return [self.resource_indexes[cluster]] if cluster in self.resource_indexes else []
+
+    def filter_pods(self, resource, filters):
+        return [pod for pod in self.all_resources if pod['resource'] == resource and all(filters[key] == 'all' or pod[key] == filters[key] for key in filters)]
+
+    # filters 可以为 cluster，org，namespace，project，user，值为all表示不限制
+    def get_value(self, resource, **filters):
+        if self.resource_indexes is not None:
+            cluster = filters.pop('cluster', 'all')
+            return sum([resource_index.get_resource(resource, exclude_pod=self.exclude_pod, **filters) for resource_index in self.get_indexes(cluster)])
+        return sum([float(str(pod.get('value', '0')).replace('G', '')) for pod in self.filter_pods(resource, filters)])
+
+    def get_pods(self, resource, **filters):
+        if self.resource_indexes is not None:
+            cluster = filters.pop('cluster', 'all')
+            pods = []
+            for resource_index in self.get_indexes(cluster):
+                pods += resource_index.get_pods(resource, exclude_pod=self.exclude_pod, **filters)
+            return pods
+        return self.filter_pods(resource, filters)
+
+
 # 验证用户资源额度限制
-@pysnooper.snoop()
+# @pysnooper.snoop()
 def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclude_pod=[],req_resource={},replicas=1):
     # 管理员不受限制
     if req_user.is_admin():
@@ -2062,13 +2307,13 @@ def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclu
     if '(' in req_resource['gpu']:
         req_resource['gpu'] = req_resource['gpu'][:req_resource['gpu'].index('(')]
 
-    all_resources = None
+    exist = None
     # req_total_resource={key:float(str(req_resource[key]).replace('G',''))*replicas for key in req_resource}
     # 验证用户username在集群cluster_name的namespace空闲下运行value大的resource(cpu,memory,gpu)资源是否允许
     # 先来验证是否有个人用户额度限制，单集群限制，单空闲限制
     if req_user.quota:
-        if not all_resources:
-            all_resources = get_all_resource(exclude_pod=exclude_pod)
+        if not exist:
+            exist = ExistResource(exclude_pod=exclude_pod)
 
         quota_confg = req_user.quota
         quotas_array = re.split(';|\n',quota_confg.strip())
@@ -2099,25 +2344,17 @@ def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclu
                 if req_cluster_name == quota['cluser'] or quota['cluser'] == 'all':
                     if req_org == quota['org'] or quota['org'] == 'all':
                         if req_namespace==quota['namespace'] or quota['namespace']=='all':
-                            exist_pod = all_resources
-                            # 过滤个人名下的pod
-                            exist_pod = [pod for pod in exist_pod if pod['user'] == req_user.username]
-
-                            if quota['cluser']!='all':
-                                exist_pod = [pod for pod in exist_pod if pod['cluster']==quota['cluser']]
-                            if quota['namespace']!='all':
-                                exist_pod = [pod for pod in exist_pod if pod['namespace'] == quota['namespace']]
-                            if quota['org']!='all':
-                                exist_pod = [pod for pod in exist_pod if pod['org'] == quota['org']]
-
-                            exist_resource = sum([float(str(pod.get('value','0')).replace('G','')) for pod in exist_pod])
+                            # 个人名下的pod
+                            filters = dict(user=req_user.username, cluster=quota['cluser'], namespace=quota['namespace'], org=quota['org'])
+                            exist_resource = exist.get_value(quota['resource'], **filters)
                             limit_resource = float(quota['value'])
                             request_resource = float(str(req_resource.get(quota['resource'], '0')).replace('G', ''))
                             message = f'user {quota["type"]} quota: \nrequest {quota["resource"]} {request_resource} * {replicas}, user limit {limit_resource}, exist {exist_resource}'
-                            message += "\nexist pod:\n" + '\n'.join([pod['labels'].get('pod-type', 'task') + ":" + pod['name'] for pod in exist_pod])
 
                             print(message)
                             if request_resource*replicas>(limit_resource-exist_resource):
+                                exist_pod = exist.get_pods(quota['resource'], **filters)
+                                message += "\nexist pod:\n" + '\n'.join([pod['labels'].get('pod-type', 'task') + ":" + pod['name'] for pod in exist_pod])
                                 return False,Markup("<br>"+message.replace('\n','<br>'))
 
             if quota['type']=='total':
@@ -2125,8 +2362,8 @@ def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclu
 
     # 或者这个项目下的限制，比如对每个人的限制和对项目组的总和设置，已经确保了申请项目组，与额度配置项目组相同
     if req_project.quota():
-        if not all_resources:
-            all_resources = get_all_resource(exclude_pod=exclude_pod)
+        if not exist:
+            exist = ExistResource(exclude_pod=exclude_pod)
 
         quota_confg = req_project.quota()
         quotas_array = re.split(';|\n', quota_confg.strip())
@@ -2153,25 +2390,17 @@ def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclu
             # 查看正在运行的整体资源是否满足资源限制
             if quota['type'] == 'concurrent':
                 if req_namespace == quota['namespace'] or quota['namespace'] == 'all':
-                    exist_pod = all_resources
-                    # 过滤该项目组下的pod
-                    exist_pod = [pod for pod in exist_pod if pod['project'] == req_project.name]
-
-                    # print(exist_pod)
-                    if quota['namespace'] != 'all':
-                        exist_pod = [pod for pod in exist_pod if pod['namespace'] == quota['namespace']]
-
-                    exist_pod = [pod for pod in exist_pod if pod['resource'] == quota['resource']]
-                    # print(exist_pod)
-                    # print(quota['resource'])
-                    exist_resource = sum([float(str(pod.get('value', '0')).replace('G', '')) for pod in exist_pod])
+                    # 该项目组下的pod
+                    filters = dict(project=req_project.name, namespace=quota['namespace'])
+                    exist_resource = exist.get_value(quota['resource'], **filters)
                     limit_resource = float(quota['value'])
                     request_resource = float(str(req_resource.get(quota['resource'], '0')).replace('G', ''))
                     message = f'project {quota["type"]} quota: \nrequest {quota["resource"]} {request_resource} * {replicas}, project limit {limit_resource}, exist {exist_resource}'
-                    message +="\nexist pod:\n"+'\n'.join([pod['labels'].get('pod-type','task')+":"+pod['name'] for pod in exist_pod])
                     print(message)
                     # message += '\n<a target="_blank" href="https://www.w3schools.com">申请资源</a>'
                     if request_resource*replicas > (limit_resource - exist_resource):
+                        exist_pod = exist.get_pods(quota['resource'], **filters)
+                        message +="\nexist pod:\n"+'\n'.join([pod['labels'].get('pod-type','task')+":"+pod['name'] for pod in exist_pod])
                         return False,Markup("<br>"+message.replace('\n','<br>'))
 
             if quota['type'] == 'total':
@@ -2180,8 +2409,8 @@ def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclu
     # 获取项目组下对个人的额度限制，已经确保了申请项目组，与额度配置项目组相同
     if req_project.quota(userid=req_user.id):
 
-        if not all_resources:
-            all_resources = get_all_resource(exclude_pod=exclude_pod)
+        if not exist:
+            exist = ExistResource(exclude_pod=exclude_pod)
 
         quota_confg = req_project.quota(userid=req_user.id)
         quotas_array = re.split(';|\n', quota_confg.strip())
@@ -2208,24 +2437,17 @@ def meet_quota(req_user,req_project,req_cluster_name,req_org,req_namespace,exclu
             # 查看正在运行的整体资源是否满足资源限制，
             if quota['type'] == 'concurrent':
                 if req_namespace == quota['namespace'] or quota['namespace'] == 'all':
-                    exist_pod = all_resources
-                    # 过滤该项目组下的pod
-                    exist_pod = [pod for pod in exist_pod if pod['project'] == req_project.name and pod['user']==req_user.username]
-                    if quota['namespace'] != 'all':
-                        exist_pod = [pod for pod in exist_pod if pod['namespace'] == quota['namespace']]
-
-                    exist_pod = [pod for pod in exist_pod if pod['resource'] == quota['resource']]
-
-                    # print(exist_pod)
-                    # print(quota['resource'])
-                    exist_resource = sum([float(str(pod.get('value', '0')).replace('G', '')) for pod in exist_pod])
+                    # 该项目组下该用户的pod
+                    filters = dict(project=req_project.name, user=req_user.username, namespace=quota['namespace'])
+                    exist_resource = exist.get_value(quota['resource'], **filters)
                     limit_resource = float(quota['value'])
                     request_resource = float(str(req_resource.get(quota['resource'], '0')).replace('G', ''))
                     message = f'project user {quota["type"]} quota: \nrequest {quota["resource"]} {request_resource} * {replicas}, project limit {limit_resource}, exist {exist_resource}'
-                    message +="\nexist pod:\n"+'\n'.join([pod['labels'].get('pod-type','task')+":"+pod['name'] for pod in exist_pod])
 
                     print(message)
                     if request_resource*replicas > (limit_resource - exist_resource):
+                        exist_pod = exist.get_pods(quota['resource'], **filters)
+                        message +="\nexist pod:\n"+'\n'.join([pod['labels'].get('pod-type','task')+":"+pod['name'] for pod in exist_pod])
                         return False,Markup("<br>"+message.replace('\n','<br>'))
 
             if quota['type'] == 'total':
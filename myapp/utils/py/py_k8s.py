@@ -4,7 +4,7 @@ from kubernetes import client
 from kubernetes.client.models import v1_pod, v1_object_meta, v1_pod_spec, v1_deployment, v1_deployment_spec
 import yaml
 import json
-import multiprocessing
+import itertools
 import base64
 from kubernetes import config
 from kubernetes.client.rest import ApiException
@@ -15,6 +15,40 @@ import threading
 import logging
 from myapp import conf
 from myapp.utils import core
+from myapp.utils.py.py_k8s_informer import get_informer, parse_label_selector
+from myapp.utils.py.py_log import iter_log_lines
+
+k8s_api_clients = {}
+k8s_api_clients_lock = threading.Lock()
+
+
+# 在fan_out中没有指定超时的请求，使用fan_out任务剩余的时间作为请求超时
+class FanOutApiClient(client.ApiClient):
+
+    def call_api(self, *args, **kwargs):
+        if kwargs.get('_request_timeout') is None:
+            kwargs['_request_timeout'] = core.get_fan_out_timeout()
+        return super(FanOutApiClient, self).call_api(*args, **kwargs)
+
+
+# 按kubeconfig复用带连接池的ApiClient，只有kubeconfig文件修改后才重新加载，避免每次实例化都重新解析kubeconfig和重新tls握手
+def get_api_client(file_path=''):
+    key = os.path.abspath(file_path) if file_path else ''
+    mtime = os.path.getmtime(file_path) if file_path else 0
+    with k8s_api_clients_lock:
+        if key in k8s_api_clients and k8s_api_clients[key][0] == mtime:
+            return k8s_api_clients[key][1]
+        configuration = client.Configuration()
+        if file_path:
+            config.kube_config.load_kube_config(config_file=file_path, client_configuration=configuration)
+        else:
+            config.load_incluster_config(client_configuration=configuration)
+        configuration.verify_ssl = False
+        configuration.connection_pool_maxsize = conf.get('K8S_CLIENT_POOL_MAXSIZE', 20)
+        api_client = FanOutApiClient(configuration=configuration, pool_threads=conf.get('K8S_CLIENT_POOL_THREADS', 1))
+        k8s_api_clients[key] = (mtime, api_client)
+        return api_client
+
 
 class K8s():
 
@@ -22,24 +56,50 @@ class K8s():
         if not file_path:
             file_path = conf.get('CLUSTERS',{}).get(conf.get('ENVIRONMENT'),{}).get('KUBECONFIG','')
         kubeconfig = os.getenv('KUBECONFIG', '')
-        if file_path and os.path.exists(file_path) and ''.join(open(file_path).readlines()).strip():
-            config.kube_config.load_kube_config(config_file=file_path)
+        if file_path and os.path.exists(file_path) and os.path.getsize(file_path):
+            self.file_path = file_path
         elif kubeconfig:
-            config.kube_config.load_kube_config(config_file=kubeconfig)
+            self.file_path = kubeconfig
         else:
-            config.load_incluster_config()
-        self.v1 = client.CoreV1Api()
-        self.v1beta1 = client.ExtensionsV1beta1Api()
-        self.AppsV1Api = client.AppsV1Api()
-        self.NetworkingV1Api = client.NetworkingV1Api()
-        self.CustomObjectsApi = client.CustomObjectsApi()
-        self.v1.api_client.configuration.verify_ssl = False  # 只能设置 /usr/local/lib/python3.9/dist-packages/kubernetes/client/configuration.py:   self.verify_ssl= True ---> False
+            self.file_path = ''
+        self.api_client = get_api_client(self.file_path)
+        self.v1 = client.CoreV1Api(self.api_client)
+        self.v1beta1 = client.ExtensionsV1beta1Api(self.api_client)
+        self.AppsV1Api = client.AppsV1Api(self.api_client)
+        self.NetworkingV1Api = client.NetworkingV1Api(self.api_client)
+        self.CustomObjectsApi = client.CustomObjectsApi(self.api_client)
         self.gpu_resource=conf.get('GPU_RESOURCE',{})
         self.vgpu_resource = conf.get('VGPU_RESOURCE', {})
         self.vgpu_drive_type = conf.get("VGPU_DRIVE_TYPE", "mgpu")
 
         self.get_gpu = core.get_gpu
 
+    # 获取进程内共享的informer缓存，只有缓存同步完成且没有超过过期时间时才返回，否则调用方直接查询apiserver
+    def get_informer(self, kind, group=None, version=None, plural=None):
+        if not conf.get('K8S_INFORMER_ENABLE', False):
+            return None
+        if kind == 'crd' and plural not in conf.get('K8S_INFORMER_CRDS', []):
+            return None
+        try:
+            informer = get_informer(self.api_client, self.file_path, kind, group=group, version=version, plural=plural, watch_timeout=conf.get('K8S_INFORMER_WATCH_TIMEOUT', 60))
+            if informer.is_fresh(conf.get('K8S_INFORMER_MAX_STALENESS', 120)):
+                return informer
+        except Exception as e:
+            print(e)
+        return None
+
+    # 获取集群的资源占用索引，由pod informer增量维护，informer不可用时返回None
+    def get_resource_index(self, cluster_name):
+        informer = self.get_informer('pod')
+        if not informer:
+            return None
+        with all_resource_indexes_lock:
+            if cluster_name not in all_resource_indexes:
+                all_resource_indexes[cluster_name] = PodResourceIndex(self, cluster_name, conf.get('HUBSECRET_NAMESPACE', []))
+            resource_index = all_resource_indexes[cluster_name]
+        informer.add_handler(resource_index)
+        return resource_index
+
     # 获取指定范围的pod
     # @pysnooper.snoop()
     def get_running_pods(self, namespace=None):
@@ -58,12 +118,15 @@ class K8s():
         back_pods = []
         try:
             all_pods = []
+            informer = self.get_informer('pod')
             # 如果只有命名空间
             if (namespace and not service_name and not pod_name and not labels):
-                all_pods = self.v1.list_namespaced_pod(namespace).items
+                all_pods = informer.list(namespace=namespace) if informer else self.v1.list_namespaced_pod(namespace).items
             # 如果有命名空间和pod名，就直接查询pod
             elif (namespace and pod_name):
-                pod = self.v1.read_namespaced_pod(name=pod_name, namespace=namespace)
+                pod = informer.get(namespace, pod_name) if informer else None
+                if not pod:
+                    pod = self.v1.read_namespaced_pod(name=pod_name, namespace=namespace)
                 all_pods.append(pod)
             # 如果只有命名空间和服务名，就查服务下绑定的pod
             elif (namespace and service_name):  # 如果有命名空间和服务名
@@ -83,6 +146,8 @@ class K8s():
                     pod = self.v1.read_namespaced_pod(name=pod_name_temp, namespace=namespace)
                     all_pods.append(pod)
 
+            elif (namespace and labels and informer):
+                all_pods = informer.list(namespace=namespace, labels=labels)
             elif (namespace and labels):
                 src_pods = self.v1.list_namespaced_pod(namespace).items
                 for pod in src_pods:
@@ -96,76 +161,7 @@ class K8s():
                         all_pods.append(pod)
 
             for pod in all_pods:
-                # print(pod)
-                metadata = pod.metadata
-                status = pod.status.phase if pod and hasattr(pod, 'status') and hasattr(pod.status, 'phase') else ''
-                # 如果是running 也分为重启运行中
-                if status.lower()=='running':
-                    status = 'Running' if [x.status for x in pod.status.conditions if x.type == 'Ready' and x.status == 'True'] else 'CrashLoopBackOff'
-
-                containers = pod.spec.containers
-                # mem = [container.resources.requests for container in containers]
-                memory = [self.to_memory_GB(container.resources.requests.get('memory','0G')) for container in containers if container.resources and container.resources.requests]
-                cpu = [self.to_cpu(container.resources.requests.get('cpu', '0')) for container in containers if container.resources  and container.resources.requests]
-
-                # gpu = [int(container.resources.requests.get('nvidia.com/gpu', '0')) for container in containers if container.resources and container.resources.requests]
-                vgpu = [float(container.resources.requests.get('tencent.com/vcuda-core', '0'))/100 for container in containers if container.resources and container.resources.requests]
-                vgpu += [float(container.resources.requests.get('tke.cloud.tencent.com/qgpu-core', '0'))/100 for container in containers if container.resources and container.resources.requests]
-                # 获取gpu异构资源占用
-                ai_resource={}
-                for name in self.gpu_resource:
-                    resource = self.gpu_resource[name]
-                    gpu = [int(container.resources.requests.get(resource, '0')) for container in containers if container.resources and container.resources.requests]
-                    ai_resource[name]=sum(gpu)
-                ai_resource['gpu']=ai_resource.get('gpu',0)+sum(vgpu)
-
-                node_selector = {}
-                try:
-                    # aa=client.V1NodeSelector
-                    match_expressions = pod.spec.affinity.node_affinity.required_during_scheduling_ignored_during_execution.node_selector_terms
-                    match_expressions = [ex.match_expressions for ex in match_expressions]
-                    match_expressions = match_expressions[0]
-                    for match_expression in match_expressions:
-                        if match_expression.operator == 'In':
-                            node_selector[match_expression.key] = match_expression.values[0]
-                        if match_expression.operator == 'Equal':
-                            node_selector[match_expression.key] = match_expression.values
-
-                except Exception:
-                    pass
-                    # print(e)
-                if pod.spec.node_selector:
-                    node_selector.update(pod.spec.node_selector)
-
-                username = ''
-                if pod.metadata.labels:
-                    username = pod.metadata.labels.get('run-rtx', '')
-                    if not username:
-                        username = pod.metadata.labels.get('user', '')
-                    if not username:
-                        username = pod.metadata.labels.get('rtx-user', '')
-
-                temp = {
-                    'name': metadata.name,
-                    "username": username,
-                    'host_ip': pod.status.host_ip,
-                    'pod_ip': pod.status.pod_ip,
-                    'status': status,  # 每个容器都正常才算正常
-                    'status_more': pod.status.to_dict(),  # 无法json序列化
-                    'node_name': pod.spec.node_name,
-                    "labels": metadata.labels if metadata.labels else {},
-                    "annotations": metadata.annotations if metadata.annotations else {},
-                    "memory": sum(memory),
-                    "cpu": sum(cpu),
-                    # "gpu": sum(gpu) + sum(vgpu),
-                    "start_time": (metadata.creation_timestamp + datetime.timedelta(hours=8)).replace(tzinfo=None),   # 时间格式
-                    "node_selector": node_selector
-                }
-                temp.update(ai_resource)
-
-
-
-                back_pods.append(temp)
+                back_pods.append(self.format_pod(pod))
             # print(back_pods)
             return back_pods
 
@@ -176,8 +172,88 @@ class K8s():
             print(e)
             return back_pods
 
+    # 获取pod申请的cpu，内存和各类gpu资源
+    def get_pod_resource(self, pod):
+        containers = pod.spec.containers
+        # mem = [container.resources.requests for container in containers]
+        memory = [self.to_memory_GB(container.resources.requests.get('memory','0G')) for container in containers if container.resources and container.resources.requests]
+        cpu = [self.to_cpu(container.resources.requests.get('cpu', '0')) for container in containers if container.resources  and container.resources.requests]
+
+        # gpu = [int(container.resources.requests.get('nvidia.com/gpu', '0')) for container in containers if container.resources and container.resources.requests]
+        vgpu = [float(container.resources.requests.get('tencent.com/vcuda-core', '0'))/100 for container in containers if container.resources and container.resources.requests]
+        vgpu += [float(container.resources.requests.get('tke.cloud.tencent.com/qgpu-core', '0'))/100 for container in containers if container.resources and container.resources.requests]
+        # 获取gpu异构资源占用
+        ai_resource={}
+        for name in self.gpu_resource:
+            resource = self.gpu_resource[name]
+            gpu = [int(container.resources.requests.get(resource, '0')) for container in containers if container.resources and container.resources.requests]
+            ai_resource[name]=sum(gpu)
+        ai_resource['gpu']=ai_resource.get('gpu',0)+sum(vgpu)
+        ai_resource['memory'] = sum(memory)
+        ai_resource['cpu'] = sum(cpu)
+        return ai_resource
+
+    # 获取pod的机器选择，包括亲和性里面的必选条件
+    def get_pod_node_selector(self, pod):
+        node_selector = {}
+        try:
+            # aa=client.V1NodeSelector
+            match_expressions = pod.spec.affinity.node_affinity.required_during_scheduling_ignored_during_execution.node_selector_terms
+            match_expressions = [ex.match_expressions for ex in match_expressions]
+            match_expressions = match_expressions[0]
+            for match_expression in match_expressions:
+                if match_expression.operator == 'In':
+                    node_selector[match_expression.key] = match_expression.values[0]
+                if match_expression.operator == 'Equal':
+                    node_selector[match_expression.key] = match_expression.values
+
+        except Exception:
+            pass
+            # print(e)
+        if pod.spec.node_selector:
+            node_selector.update(pod.spec.node_selector)
+        return node_selector
+
+    # 将k8s的pod对象转换为平台使用的资源信息
+    def format_pod(self, pod):
+        # print(pod)
+        metadata = pod.metadata
+        status = pod.status.phase if pod and hasattr(pod, 'status') and hasattr(pod.status, 'phase') else ''
+        # 如果是running 也分为重启运行中
+        if status.lower()=='running':
+            status = 'Running' if [x.status for x in pod.status.conditions if x.type == 'Ready' and x.status == 'True'] else 'CrashLoopBackOff'
+
+        username = ''
+        if pod.metadata.labels:
+            username = pod.metadata.labels.get('run-rtx', '')
+            if not username:
+                username = pod.metadata.labels.get('user', '')
+            if not username:
+                username = pod.metadata.labels.get('rtx-user', '')
+
+        temp = {
+            'name': metadata.name,
+            "username": username,
+            'host_ip': pod.status.host_ip,
+            'pod_ip': pod.status.pod_ip,
+            'status': status,  # 每个容器都正常才算正常
+            'status_more': pod.status.to_dict(),  # 无法json序列化
+            'node_name': pod.spec.node_name,
+            "labels": metadata.labels if metadata.labels else {},
+            "annotations": metadata.annotations if metadata.annotations else {},
+            # "gpu": sum(gpu) + sum(vgpu),
+            "start_time": (metadata.creation_timestamp + datetime.timedelta(hours=8)).replace(tzinfo=None),   # 时间格式
+            "node_selector": self.get_pod_node_selector(pod)
+        }
+        temp.update(self.get_pod_resource(pod))
+        return temp
+
     def get_pod_event(self, namespace, pod_name):
-        events = [item.to_dict() for item in self.v1.list_namespaced_event(namespace, field_selector=f'involvedObject.name={pod_name}').items]
+        informer = self.get_informer('event')
+        if informer:
+            events = [item.to_dict() for item in informer.list(namespace=namespace) if item.involved_object and item.involved_object.name == pod_name]
+        else:
+            events = [item.to_dict() for item in self.v1.list_namespaced_event(namespace, field_selector=f'involvedObject.name={pod_name}').items]
         for event in events:
             event['time'] = (event['first_timestamp'] + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S') if event.get('first_timestamp', None) else None
             if not event['time']:
@@ -189,8 +265,7 @@ class K8s():
         try:
             pod = self.v1.read_namespaced_pod(namespace=namespace, name=pod_name)
             if pod:
-                from kubernetes.client import ApiClient
-                pod = ApiClient().sanitize_for_serialization(pod)
+                pod = self.api_client.sanitize_for_serialization(pod)
                 if 'managedFields' in pod.get('metadata', {}):
                     del pod['metadata']['managedFields']
                 if 'ownerReferences' in pod.get('metadata', {}):
@@ -236,7 +311,8 @@ class K8s():
     def get_all_node_allocated_resources(self):
         nodes_resource = {}
         try:
-            pods = self.v1.list_pod_for_all_namespaces(watch=False).items
+            informer = self.get_informer('pod')
+            pods = informer.list() if informer else self.v1.list_pod_for_all_namespaces(watch=False).items
 
             for pod in pods:
                 if not pod.status or pod.status.phase != 'Running':
@@ -280,7 +356,11 @@ class K8s():
 
     def get_node_event(self, node_name):
         node = self.get_node(name=node_name)
-        events = [item.to_dict() for item in self.v1.list_event_for_all_namespaces().items]   # field_selector=f'source.host={node["hostip"]}'
+        informer = self.get_informer('event')
+        if informer:
+            events = [item.to_dict() for item in informer.list(node_name=node["hostip"])]
+        else:
+            events = [item.to_dict() for item in self.v1.list_event_for_all_namespaces().items]   # field_selector=f'source.host={node["hostip"]}'
         for event in events:
             event['time'] = (event['first_timestamp'] + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S') if event.get('first_timestamp', None) else None
             if not event['time']:
@@ -296,7 +376,12 @@ class K8s():
     def get_node(self, label=None, name=None, ip=None):
         try:
             back_nodes = []
-            all_node = self.v1.list_node(label_selector=label).items
+            informer = self.get_informer('node')
+            labels = parse_label_selector(label)
+            if informer and labels is not None:
+                all_node = informer.list(labels=labels)
+            else:
+                all_node = self.v1.list_node(label_selector=label).items
             # print(all_node)
             for node in all_node:
                 try:
@@ -444,84 +529,134 @@ class K8s():
             print(e)
             return {}
 
+    # 分页查询crd，不指定namespace时为集群范围的查询
+    def list_crd(self, group, version, plural, namespace=None, label_selector=None):
+        crd_objects = []
+        _continue = None
+        while True:
+            kwargs = {
+                "group": group,
+                "version": version,
+                "plural": plural,
+                "limit": conf.get('K8S_LIST_PAGE_SIZE', 500)
+            }
+            if label_selector:
+                kwargs['label_selector'] = label_selector
+            if _continue:
+                kwargs['_continue'] = _continue
+            if namespace:
+                result = self.CustomObjectsApi.list_namespaced_custom_object(namespace=namespace, **kwargs)
+            else:
+                result = self.CustomObjectsApi.list_cluster_custom_object(**kwargs)
+            crd_objects += result.get('items', [])
+            _continue = result.get('metadata', {}).get('continue', None)
+            if not _continue:
+                return crd_objects
+
+    # 将crd对象转换为平台使用的格式
+    def format_crd(self, crd_object, group, plural):
+        # print(crd_object['status']['conditions'][-1]['type'])
+        status = self.get_crd_status(crd_object, group, plural)
+
+        creat_time = crd_object['metadata']['creationTimestamp'].replace('T', ' ').replace('Z', '')
+        creat_time = (datetime.datetime.strptime(creat_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
+        finish_time=''
+        if 'status' in crd_object and 'finishedAt' in crd_object['status'] and crd_object['status']['finishedAt']:
+            finish_time = crd_object['status']['finishedAt'].replace('T', ' ').replace('Z', '')
+            finish_time = (datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
+        elif 'status' in crd_object and 'completionTime' in crd_object['status'] and crd_object['status']['completionTime']:
+            finish_time = crd_object['status']['completionTime'].replace('T', ' ').replace('Z', '')
+            finish_time = (datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
+
+        # vcjob的结束时间
+        elif 'status' in crd_object and 'state' in crd_object['status'] and 'lastTransitionTime' in crd_object['status']['state']:
+            if crd_object['status']['state'].get('phase','')=='Completed' or crd_object['status']['state'].get('phase','')=='Aborted' or crd_object['status']['state'].get('phase','')=='Failed' or crd_object['status']['state'].get('phase','')=='Terminated':
+                finish_time = crd_object['status']['state']['lastTransitionTime'].replace('T', ' ').replace('Z', '')
+                finish_time = (datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+        back_object={
+            "name":crd_object['metadata']['name'],
+            "namespace":crd_object['metadata']['namespace'] if 'namespace' in crd_object['metadata'] else '',
+            "annotations":json.dumps(crd_object['metadata']['annotations'],indent=4,ensure_ascii=False) if 'annotations' in crd_object['metadata'] else '',
+            "labels": json.dumps(crd_object['metadata']['labels'], indent=4, ensure_ascii=False) if 'labels' in crd_object['metadata'] else '{}',
+            "spec": json.dumps(crd_object['spec'], indent=4, ensure_ascii=False),
+            "create_time": creat_time,
+            "finish_time": finish_time,
+            "status": status,
+            "status_more": json.dumps(crd_object['status'], indent=4, ensure_ascii=False) if 'status' in crd_object else ''
+        }
+        return back_object
+
     # @pysnooper.snoop(watch_explode=())
     def get_crd(self, group, version, plural, namespace, label_selector=None, return_dict=None):
         crd_objects=[]
         try:
-            if label_selector:
-                crd_objects = self.CustomObjectsApi.list_namespaced_custom_object(group=group,version=version,namespace=namespace,plural=plural,label_selector=label_selector)['items']
+            informer = self.get_informer('crd', group=group, version=version, plural=plural)
+            labels = parse_label_selector(label_selector)
+            if informer and labels is not None:
+                crd_objects = informer.list(namespace=namespace, labels=labels)
             else:
-                crd_objects = self.CustomObjectsApi.list_namespaced_custom_object(group=group, version=version, namespace=namespace, plural=plural)['items']
+                crd_objects = self.list_crd(group=group, version=version, plural=plural, namespace=namespace, label_selector=label_selector)
         except ApiException as api_e:
             if api_e.status != 404:
                 print(api_e)
         except Exception as e:
             print(e)
-        back_objects=[]
-        for crd_object in crd_objects:
-            # print(crd_object['status']['conditions'][-1]['type'])
-            status = self.get_crd_status(crd_object, group, plural)
-
-            creat_time = crd_object['metadata']['creationTimestamp'].replace('T', ' ').replace('Z', '')
-            creat_time = (datetime.datetime.strptime(creat_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
-            finish_time=''
-            if 'status' in crd_object and 'finishedAt' in crd_object['status'] and crd_object['status']['finishedAt']:
-                finish_time = crd_object['status']['finishedAt'].replace('T', ' ').replace('Z', '')
-                finish_time = (datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
-            elif 'status' in crd_object and 'completionTime' in crd_object['status'] and crd_object['status']['completionTime']:
-                finish_time = crd_object['status']['completionTime'].replace('T', ' ').replace('Z', '')
-                finish_time = (datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
-
-            # vcjob的结束时间
-            elif 'status' in crd_object and 'state' in crd_object['status'] and 'lastTransitionTime' in crd_object['status']['state']:
-                if crd_object['status']['state'].get('phase','')=='Completed' or crd_object['status']['state'].get('phase','')=='Aborted' or crd_object['status']['state'].get('phase','')=='Failed' or crd_object['status']['state'].get('phase','')=='Terminated':
-                    finish_time = crd_object['status']['state']['lastTransitionTime'].replace('T', ' ').replace('Z', '')
-                    finish_time = (datetime.datetime.strptime(finish_time, '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=8)).strftime('%Y-%m-%d %H:%M:%S')
-
-
-            back_object={
-                "name":crd_object['metadata']['name'],
-                "namespace":crd_object['metadata']['namespace'] if 'namespace' in crd_object['metadata'] else '',
-                "annotations":json.dumps(crd_object['metadata']['annotations'],indent=4,ensure_ascii=False) if 'annotations' in crd_object['metadata'] else '',
-                "labels": json.dumps(crd_object['metadata']['labels'], indent=4, ensure_ascii=False) if 'labels' in crd_object['metadata'] else '{}',
-                "spec": json.dumps(crd_object['spec'], indent=4, ensure_ascii=False),
-                "create_time": creat_time,
-                "finish_time": finish_time,
-                "status": status,
-                "status_more": json.dumps(crd_object['status'], indent=4, ensure_ascii=False) if 'status' in crd_object else ''
-            }
-            back_objects.append(back_object)
-            # return
+        back_objects = [self.format_crd(crd_object, group, plural) for crd_object in crd_objects]
         if return_dict != None:
             return_dict[namespace] = back_objects
         return back_objects
 
+    # 获取所有命名空间的crd，有集群范围的权限时直接集群范围分页查询，否则按命名空间并发查询
+    # errors 传入字典时，记录查询失败的命名空间和原因
     # @pysnooper.snoop(watch_explode=())
-    def get_crd_all_namespaces(self, group, version, plural, pool=False):
+    def get_crd_all_namespaces(self, group, version, plural, pool=False, errors=None):
+        informer = self.get_informer('crd', group=group, version=version, plural=plural)
+        if informer:
+            return [self.format_crd(crd_object, group, plural) for crd_object in informer.list()]
+        try:
+            crd_objects = self.list_crd(group=group, version=version, plural=plural)
+            return [self.format_crd(crd_object, group, plural) for crd_object in crd_objects]
+        except ApiException as api_e:
+            # crd不存在
+            if api_e.status == 404:
+                return []
+            # 没有集群范围的list权限时，按命名空间查询
+            if api_e.status not in [401, 403]:
+                logging.error('list %s in all namespaces error: %s', plural, api_e)
+
         all_namespace = self.v1.list_namespace().items
         all_namespace = [namespace.metadata.name for namespace in all_namespace]
-        back_objects = []
-        jobs = []
+
+        # 不存在的crd返回404，不算失败
+        def list_namespace_crd(namespace):
+            try:
+                return self.list_crd(group=group, version=version, plural=plural, namespace=namespace)
+            except ApiException as e:
+                if e.status == 404:
+                    return []
+                raise e
+
         if pool:
-            from multiprocessing import Manager
-            manager = Manager()
-            return_dict = manager.dict()
-            for namespace in all_namespace:
-                p = multiprocessing.Process(target=self.get_crd, args=(group, version, plural, namespace, return_dict))
-                jobs.append(p)
-                p.start()
-            for proc in jobs:
-                proc.join(timeout=5)
-            for namespace_name in return_dict:
-                for crd_object in return_dict[namespace_name]:
-                    back_objects.append(crd_object)
-            return back_objects
+            all_crd_objects, namespace_errors = core.fan_out(list_namespace_crd, dict((namespace, namespace) for namespace in all_namespace))
         else:
+            all_crd_objects, namespace_errors = {}, {}
             for namespace in all_namespace:
-                crds = self.get_crd(group=group, version=version, plural=plural, namespace=namespace)
-                for crd_object in crds:
-                    back_objects.append(crd_object)
-            return back_objects
+                try:
+                    all_crd_objects[namespace] = list_namespace_crd(namespace)
+                except Exception as e:
+                    namespace_errors[namespace] = str(e)
+        if namespace_errors:
+            logging.error('list %s failed in namespaces: %s', plural, namespace_errors)
+        if errors != None:
+            errors.update(namespace_errors)
+
+        back_objects = []
+        for namespace in all_namespace:
+            for crd_object in all_crd_objects.get(namespace, []):
+                back_objects.append(self.format_crd(crd_object, group, plural))
+        return back_objects
 
     # @pysnooper.snoop(watch_explode=())
     def delete_crd(self, group, version, plural, namespace, name='', labels=None):
@@ -1198,7 +1333,7 @@ class K8s():
 
     # 创建notebook
     def create_crd(self,group,version,plural,namespace,body):
-        crd_objects = client.CustomObjectsApi().create_namespaced_custom_object(group=group, version=version, namespace=namespace, plural=plural,body=body)
+        crd_objects = client.CustomObjectsApi(self.api_client).create_namespaced_custom_object(group=group, version=version, namespace=namespace, plural=plural,body=body)
         return crd_objects
 
     # 创建pod
@@ -1271,7 +1406,7 @@ class K8s():
     def delete_deployment(self, namespace, name=None, labels=None):
         if name:
             try:
-                client.AppsV1Api().delete_namespaced_deployment(name=name, namespace=namespace, grace_period_seconds=0)
+                client.AppsV1Api(self.api_client).delete_namespaced_deployment(name=name, namespace=namespace, grace_period_seconds=0)
             except ApiException as api_e:
                 if api_e.status != 404:
                     print(api_e)
@@ -1283,7 +1418,7 @@ class K8s():
                 labels_str = ','.join(labels_arr)
                 deploys = self.AppsV1Api.list_namespaced_deployment(namespace=namespace, label_selector=labels_str).items
                 for deploy in deploys:
-                    client.AppsV1Api().delete_namespaced_deployment(name=deploy.metadata.name, namespace=namespace, grace_period_seconds=0)
+                    client.AppsV1Api(self.api_client).delete_namespaced_deployment(name=deploy.metadata.name, namespace=namespace, grace_period_seconds=0)
             except ApiException as api_e:
                 if api_e.status != 404:
                     print(api_e)
@@ -1338,7 +1473,7 @@ class K8s():
     def delete_statefulset(self, namespace, name=None, labels=None):
         if name:
             try:
-                client.AppsV1Api().delete_namespaced_stateful_set(name=name, namespace=namespace)
+                client.AppsV1Api(self.api_client).delete_namespaced_stateful_set(name=name, namespace=namespace)
             except ApiException as api_e:
                 if api_e.status != 404:
                     print(api_e)
@@ -1350,7 +1485,7 @@ class K8s():
                 labels_str = ','.join(labels_arr)
                 stss = self.AppsV1Api.list_namespaced_stateful_set(namespace=namespace, label_selector=labels_str).items
                 for sts in stss:
-                    client.AppsV1Api().delete_namespaced_stateful_set(name=sts.metadata.name, namespace=namespace)
+                    client.AppsV1Api(self.api_client).delete_namespaced_stateful_set(name=sts.metadata.name, namespace=namespace)
             except ApiException as api_e:
                 if api_e.status != 404:
                     print(api_e)
@@ -1449,7 +1584,7 @@ class K8s():
     # 创建pod
     # @pysnooper.snoop()
     def create_ingress(self, namespace, name, host, username, port):
-        self.v1beta1 = client.ExtensionsV1beta1Api()
+        self.v1beta1 = client.ExtensionsV1beta1Api(self.api_client)
         ingress_metadata = v1_object_meta.V1ObjectMeta(name=name, namespace=namespace, labels={"app":name,'user':username},annotations={"nginx.ingress.kubernetes.io/proxy-connect-timeout":"3000","nginx.ingress.kubernetes.io/proxy-send-timeout":"3000","nginx.ingress.kubernetes.io/proxy-read-timeout":"3000","nginx.ingress.kubernetes.io/proxy-body-size":"1G"})
         backend = client.ExtensionsV1beta1IngressBackend(service_name=name,service_port=port)
         path = client.ExtensionsV1beta1HTTPIngressPath(backend=backend,path='/')
@@ -1592,14 +1727,14 @@ class K8s():
                 crd_json['spec']['http'][0]['mirror_percent'] = mirror_percent
 
             try:
-                client.CustomObjectsApi().get_namespaced_custom_object(
+                client.CustomObjectsApi(self.api_client).get_namespaced_custom_object(
                     group=crd_info['group'],
                     version=crd_info['version'],
                     plural=crd_info['plural'],
                     name=name,
                     namespace=namespace
                 )
-                crd_objects = client.CustomObjectsApi().replace_namespaced_custom_object(
+                crd_objects = client.CustomObjectsApi(self.api_client).replace_namespaced_custom_object(
                     group=crd_info['group'],
                     version=crd_info['version'],
                     namespace=namespace,
@@ -1609,7 +1744,7 @@ class K8s():
                 )
             except ApiException as e:
                 if e.status == 404:
-                    crd_objects = client.CustomObjectsApi().create_namespaced_custom_object(
+                    crd_objects = client.CustomObjectsApi(self.api_client).create_namespaced_custom_object(
                         group=crd_info['group'],
                         version=crd_info['version'],
                         namespace=namespace,
@@ -1650,14 +1785,14 @@ class K8s():
             }
 
             try:
-                client.CustomObjectsApi().get_namespaced_custom_object(
+                client.CustomObjectsApi(self.api_client).get_namespaced_custom_object(
                     group=crd_info['group'],
                     version=crd_info['version'],
                     plural=crd_info['plural'],
                     name=name + '-8080',
                     namespace=namespace
                 )
-                crd_objects = client.CustomObjectsApi().replace_namespaced_custom_object(
+                crd_objects = client.CustomObjectsApi(self.api_client).replace_namespaced_custom_object(
                     group=crd_info['group'],
                     version=crd_info['version'],
                     namespace=namespace,
@@ -1667,7 +1802,7 @@ class K8s():
                 )
             except ApiException as e:
                 if e.status == 404:
-                    crd_objects = client.CustomObjectsApi().create_namespaced_custom_object(
+                    crd_objects = client.CustomObjectsApi(self.api_client).create_namespaced_custom_object(
                         group=crd_info['group'],
                         version=crd_info['version'],
                         namespace=namespace,
@@ -1717,14 +1852,14 @@ class K8s():
 
     def delete_hpa(self, namespace, name):
         try:
-            client.AutoscalingV2beta1Api().delete_namespaced_horizontal_pod_autoscaler(name=name,namespace=namespace,grace_period_seconds=0)
+            client.AutoscalingV2beta1Api(self.api_client).delete_namespaced_horizontal_pod_autoscaler(name=name,namespace=namespace,grace_period_seconds=0)
         except ApiException as api_e:
             if api_e.status != 404:
                 print(api_e)
         except Exception as e:
             print(e)
         try:
-            client.AutoscalingV1Api().delete_namespaced_horizontal_pod_autoscaler(name=name,namespace=namespace,grace_period_seconds=0)
+            client.AutoscalingV1Api(self.api_client).delete_namespaced_horizontal_pod_autoscaler(name=name,namespace=namespace,grace_period_seconds=0)
         except ApiException as api_e:
             if api_e.status != 404:
                 print(api_e)
@@ -1822,7 +1957,7 @@ class K8s():
         # )
         print(json.dumps(hpa_json, indent=4, ensure_ascii=4))
         try:
-            client.AutoscalingV2beta1Api().create_namespaced_horizontal_pod_autoscaler(namespace=namespace, body=hpa_json, pretty=True)
+            client.AutoscalingV2beta1Api(self.api_client).create_namespaced_horizontal_pod_autoscaler(namespace=namespace, body=hpa_json, pretty=True)
         except ValueError as e:
             if str(e) == 'Invalid value for `conditions`, must not be `None`':
                 print(e)
@@ -1852,7 +1987,7 @@ class K8s():
     # @pysnooper.snoop(watch_explode=('item'))
     def get_node_metrics(self):
         back_metrics = []
-        cust = client.CustomObjectsApi()
+        cust = client.CustomObjectsApi(self.api_client)
         metrics = cust.list_cluster_custom_object('metrics.k8s.io', 'v1beta1', 'nodes')  # All node metrics
         items = metrics['items']
         for item in items:
@@ -1869,7 +2004,7 @@ class K8s():
     # @pysnooper.snoop()
     def get_pod_metrics(self, namespace=None):
         back_metrics = []
-        cust = client.CustomObjectsApi()
+        cust = client.CustomObjectsApi(self.api_client)
         if namespace:
             metrics = cust.list_namespaced_custom_object('metrics.k8s.io', 'v1beta1', namespace,'pods')  # Just pod metrics for the default namespace
         else:
@@ -1955,6 +2090,57 @@ class K8s():
         )
         return logs
 
+    # 流式读取pod日志，按块下载并逐行去除ANSI转义序列，调用方读完或者中途停止时释放连接
+    def iter_pod_log(self, name, namespace, container=None, tail_lines=None, since_seconds=None, since_time=None, chunk_size=64 * 1024):
+        response = self.v1.read_namespaced_pod_log(
+            name=name,
+            namespace=namespace,
+            container=container,
+            _preload_content=False,
+            tail_lines=int(tail_lines) if tail_lines else None,
+            since_seconds=int(since_seconds) if since_seconds else int(datetime.datetime.now().timestamp() - int(since_time)) if since_time else None,
+        )
+
+        def iter_lines():
+            try:
+                for line in iter_log_lines(response.stream(chunk_size)):
+                    yield line
+            finally:
+                response.close()
+                response.release_conn()
+
+        return iter_lines()
+
+    # 带时间戳follow pod日志，返回原始响应，给日志分发使用
+    def follow_pod_log(self, name, namespace, container=None, since_seconds=None, tail_lines=None, request_timeout=None):
+        return self.v1.read_namespaced_pod_log(
+            name=name,
+            namespace=namespace,
+            container=container,
+            follow=True,
+            timestamps=True,
+            _preload_content=False,
+            since_seconds=since_seconds,
+            tail_lines=tail_lines,
+            _request_timeout=request_timeout
+        )
+
+    # 容器是否还在运行或者等待运行，pod不存在或者容器已经退出返回False
+    def is_container_alive(self, name, namespace, container=None):
+        try:
+            pod = self.v1.read_namespaced_pod(name=name, namespace=namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return False
+            raise e
+        if pod.status.phase in ['Succeeded', 'Failed']:
+            return False
+        for container_status in pod.status.container_statuses or []:
+            if container is None or container_status.name == container:
+                if container_status.state and container_status.state.terminated and not container_status.state.running:
+                    return False
+        return True
+
     def get_uesd_gpu(self, namespaces):
         all_gpu_pods = []
 
@@ -2053,6 +2239,116 @@ class K8s():
         return {}
 
         pass
+all_resource_indexes = {}
+all_resource_indexes_lock = threading.Lock()
+
+
+# 按 集群，资源组，空间，项目组，用户 维度聚合的pod资源占用，每个维度同时累加到具体值和all上，额度校验时直接按key查询
+class PodResourceIndex():
+    dims = ['cluster', 'org', 'namespace', 'project', 'user']
+
+    def __init__(self, k8s_client, cluster_name, namespaces):
+        self.k8s_client = k8s_client
+        self.cluster_name = cluster_name
+        self.namespaces = namespaces
+        self.lock = threading.RLock()
+        self.totals = {}
+        self.pods = {}   # (namespace, name) -> pod资源记录
+        self.label_index = {}   # (label_key, label_value) -> pod keys
+
+    def pod_record(self, pod):
+        namespace = pod.metadata.namespace
+        if namespace not in self.namespaces:
+            return None
+        labels = pod.metadata.labels or {}
+        annotations = pod.metadata.annotations or {}
+        resource = self.k8s_client.get_pod_resource(pod)
+        return {
+            "cluster": self.cluster_name,
+            "org": self.k8s_client.get_pod_node_selector(pod).get('org', 'public'),
+            "namespace": namespace,
+            "project": annotations.get('project', 'public'),
+            "user": labels.get('user', labels.get('username', labels.get('run-rtx', labels.get('rtx-user', 'admin')))),
+            "name": pod.metadata.name,
+            "labels": labels,
+            "resource": dict((name, float(resource.get(name, 0))) for name in ['cpu', 'memory'] + list(conf.get('GPU_RESOURCE', {}).keys()))
+        }
+
+    def _update(self, record, sign):
+        for values in itertools.product(*[(record[dim], 'all') for dim in self.dims]):
+            for resource_name, value in record['resource'].items():
+                key = values + (resource_name,)
+                self.totals[key] = self.totals.get(key, 0) + sign * value
+
+    def _add(self, record):
+        key = (record['namespace'], record['name'])
+        self.pods[key] = record
+        for label in record['labels'].items():
+            self.label_index.setdefault(label, set()).add(key)
+        self._update(record, 1)
+
+    def _remove(self, key):
+        record = self.pods.pop(key, None)
+        if record:
+            for label in record['labels'].items():
+                self.label_index.get(label, set()).discard(key)
+            self._update(record, -1)
+
+    def on_replace(self, objects):
+        with self.lock:
+            self.totals = {}
+            self.pods = {}
+            self.label_index = {}
+            for pod in objects:
+                record = self.pod_record(pod)
+                if record:
+                    self._add(record)
+
+    def on_event(self, event_type, old, new):
+        with self.lock:
+            self._remove((new.metadata.namespace, new.metadata.name))
+            if event_type != 'DELETED':
+                record = self.pod_record(new)
+                if record:
+                    self._add(record)
+
+    # exclude_pod数组格式表示忽略的名称数组，字典格式表述忽略的pod标签，字符串表示原始的pod名
+    def exclude_records(self, exclude_pod):
+        if type(exclude_pod) == str:
+            exclude_pod = [exclude_pod]
+        if type(exclude_pod) == list:
+            return [self.pods[(namespace, name)] for namespace in self.namespaces for name in exclude_pod if (namespace, name) in self.pods]
+        if type(exclude_pod) == dict and exclude_pod:
+            keys = None
+            for label in exclude_pod.items():
+                label_keys = self.label_index.get(label, set())
+                keys = set(label_keys) if keys is None else keys & label_keys
+            return [self.pods[key] for key in keys if key in self.pods]
+        return []
+
+    # 查询指定维度下某种资源的占用，未指定的维度按all处理
+    def get_resource(self, resource_name, exclude_pod=None, **filters):
+        with self.lock:
+            key = tuple(filters.get(dim, 'all') for dim in self.dims) + (resource_name,)
+            total = self.totals.get(key, 0)
+            for record in self.exclude_records(exclude_pod):
+                if all(filters.get(dim, 'all') in ('all', record[dim]) for dim in self.dims):
+                    total -= record['resource'].get(resource_name, 0)
+            return max(round(total, 3), 0)
+
+    # 列出指定维度下占用某种资源的pod，只在额度不满足需要提示时使用
+    def get_pods(self, resource_name, exclude_pod=None, **filters):
+        with self.lock:
+            exclude = [(record['namespace'], record['name']) for record in self.exclude_records(exclude_pod)]
+            back_pods = []
+            for key, record in self.pods.items():
+                if key in exclude or not record['resource'].get(resource_name, 0):
+                    continue
+                if all(filters.get(dim, 'all') in ('all', record[dim]) for dim in self.dims):
+                    back_pods.append(record)
+            return back_pods
+
+
 class K8SStreamThread(threading.Thread):
 
     def __init__(self, ws, container_stream):
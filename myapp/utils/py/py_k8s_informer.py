@@ -0,0 +1,402 @@
+# 进程级的k8s informer缓存：先list全量，再watch增量，把pod/node/event/crd维护在内存中，并按namespace/label/node建立索引
+# 页面和定时任务的查询直接读内存，避免每次请求都打到apiserver上
+import time
+import threading
+import logging
+import traceback
+from collections import defaultdict, deque
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+
+# 兼容kubernetes model对象和crd返回的dict对象，统一取出元数据
+def get_object_meta(obj):
+    if isinstance(obj, dict):
+        metadata = obj.get('metadata', {}) or {}
+        node_name = (obj.get('spec', {}) or {}).get('nodeName', '')
+        return {
+            "namespace": metadata.get('namespace', '') or '',
+            "name": metadata.get('name', ''),
+            "labels": metadata.get('labels', {}) or {},
+            "node_name": node_name or '',
+            "resource_version": metadata.get('resourceVersion', '')
+        }
+    metadata = obj.metadata
+    node_name = ''
+    # pod按所在机器索引，event按上报的机器索引
+    if getattr(obj, 'spec', None) is not None and hasattr(obj.spec, 'node_name'):
+        node_name = obj.spec.node_name
+    elif getattr(obj, 'source', None) is not None:
+        node_name = obj.source.host
+    return {
+        "namespace": metadata.namespace or '',
+        "name": metadata.name,
+        "labels": metadata.labels or {},
+        "node_name": node_name or '',
+        "resource_version": metadata.resource_version
+    }
+
+
+# 只支持等值的label selector，例如 app=xx,user=yy。 复杂表达式返回None，由调用方回退到直接查询apiserver
+def parse_label_selector(label_selector):
+    if not label_selector:
+        return {}
+    labels = {}
+    for item in label_selector.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '!=' in item or ' in ' in item or ' notin ' in item or '=' not in item:
+            return None
+        key, value = item.replace('==', '=').split('=', 1)
+        labels[key.strip()] = value.strip()
+    return labels
+
+
+class Informer():
+
+    def __init__(self, api_client, kind, group=None, version=None, plural=None, watch_timeout=60):
+        self.api_client = api_client
+        self.kind = kind
+        self.group = group
+        self.version = version
+        self.plural = plural
+        self.watch_timeout = watch_timeout
+
+        self.lock = threading.RLock()
+        self.items = {}   # (namespace, name) -> object
+        self.namespace_index = defaultdict(set)
+        self.label_index = defaultdict(set)   # (label_key, label_value) -> keys
+        self.node_index = defaultdict(set)
+
+        self.resource_version = None
+        self.last_sync = 0   # 最后一次确认和apiserver保持同步的时间
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.handlers = []   # 增量维护派生数据的处理器，需要实现on_replace(objects)和on_event(event_type, old, new)
+
+    # 各类资源的全量list接口
+    def list_func(self):
+        if self.kind == 'pod':
+            return client.CoreV1Api(self.api_client).list_pod_for_all_namespaces
+        if self.kind == 'node':
+            return client.CoreV1Api(self.api_client).list_node
+        if self.kind == 'event':
+            return client.CoreV1Api(self.api_client).list_event_for_all_namespaces
+        api = client.CustomObjectsApi(self.api_client)
+
+        def list_crd(**kwargs):
+            return api.list_cluster_custom_object(group=self.group, version=self.version, plural=self.plural, **kwargs)
+
+        return list_crd
+
+    def start(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='informer-%s' % (self.plural or self.kind), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    # 注册处理器，先用当前缓存初始化，之后在informer线程中接收全量和增量变更
+    def add_handler(self, handler):
+        with self.lock:
+            if handler in self.handlers:
+                return
+            handler.on_replace(list(self.items.values()))
+            self.handlers.append(handler)
+
+    def is_fresh(self, max_staleness):
+        return self.synced.is_set() and (time.time() - self.last_sync) < max_staleness
+
+    def _add_index(self, key, meta):
+        self.namespace_index[meta['namespace']].add(key)
+        for label in meta['labels'].items():
+            self.label_index[label].add(key)
+        if meta['node_name']:
+            self.node_index[meta['node_name']].add(key)
+
+    def _remove_index(self, key):
+        old = self.items.pop(key, None)
+        if old is None:
+            return
+        meta = get_object_meta(old)
+        self.namespace_index[meta['namespace']].discard(key)
+        for label in meta['labels'].items():
+            self.label_index[label].discard(key)
+            if not self.label_index[label]:
+                del self.label_index[label]
+        if meta['node_name']:
+            self.node_index[meta['node_name']].discard(key)
+
+    def replace(self, objects, resource_version):
+        with self.lock:
+            self.items = {}
+            self.namespace_index = defaultdict(set)
+            self.label_index = defaultdict(set)
+            self.node_index = defaultdict(set)
+            for obj in objects:
+                meta = get_object_meta(obj)
+                key = (meta['namespace'], meta['name'])
+                self.items[key] = obj
+                self._add_index(key, meta)
+            self.resource_version = resource_version
+            self.last_sync = time.time()
+            for handler in self.handlers:
+                try:
+                    handler.on_replace(objects)
+                except Exception as e:
+                    logging.error('informer handler error: %s', e)
+        self.synced.set()
+
+    def apply(self, event_type, obj):
+        meta = get_object_meta(obj)
+        key = (meta['namespace'], meta['name'])
+        with self.lock:
+            old = self.items.get(key)
+            self._remove_index(key)
+            if event_type != 'DELETED':
+                self.items[key] = obj
+                self._add_index(key, meta)
+            for handler in self.handlers:
+                try:
+                    handler.on_event(event_type, old, obj)
+                except Exception as e:
+                    logging.error('informer handler error: %s', e)
+            if meta['resource_version']:
+                self.resource_version = meta['resource_version']
+            self.last_sync = time.time()
+
+    def relist(self):
+        result = self.list_func()()
+        if isinstance(result, dict):
+            self.replace(result.get('items', []), result.get('metadata', {}).get('resourceVersion'))
+        else:
+            self.replace(result.items, result.metadata.resource_version)
+
+    def run(self):
+        need_relist = True
+        while not self.stopped.is_set():
+            try:
+                if need_relist:
+                    self.relist()
+                    need_relist = False
+                w = watch.Watch()
+                for event in w.stream(self.list_func(), resource_version=self.resource_version, timeout_seconds=self.watch_timeout):
+                    if self.stopped.is_set():
+                        w.stop()
+                        break
+                    if event['type'] == 'ERROR':
+                        # resourceVersion过期，需要重新list
+                        need_relist = True
+                        w.stop()
+                        break
+                    self.apply(event['type'], event['object'])
+                # watch超时正常结束，说明这段时间内的数据是同步的
+                if not need_relist:
+                    with self.lock:
+                        self.last_sync = time.time()
+            except ApiException as e:
+                need_relist = True
+                if e.status != 410:
+                    logging.error('informer %s watch error: %s', self.plural or self.kind, e)
+                    time.sleep(5)
+            except Exception as e:
+                need_relist = True
+                logging.error('Traceback: %s', traceback.format_exc())
+                time.sleep(5)
+
+    # 根据索引查询，多个条件之间取交集
+    def list(self, namespace=None, labels=None, node_name=None):
+        with self.lock:
+            keys = None
+            if namespace:
+                keys = set(self.namespace_index.get(namespace, set()))
+            if node_name:
+                node_keys = self.node_index.get(node_name, set())
+                keys = set(node_keys) if keys is None else keys & node_keys
+            for label in (labels or {}).items():
+                label_keys = self.label_index.get(label, set())
+                keys = set(label_keys) if keys is None else keys & label_keys
+            if keys is None:
+                return list(self.items.values())
+            return [self.items[key] for key in keys if key in self.items]
+
+    def get(self, namespace, name):
+        with self.lock:
+            return self.items.get((namespace or '', name))
+
+
+all_informers = {}
+all_informers_lock = threading.Lock()
+
+
+# 同一个kubeconfig同一种资源，在进程内只启动一个informer
+def get_informer(api_client, file_path, kind, group=None, version=None, plural=None, watch_timeout=60):
+    key = (file_path or '', kind, group, version, plural)
+    with all_informers_lock:
+        informer = all_informers.get(key)
+        if not informer:
+            informer = Informer(api_client, kind, group=group, version=version, plural=plural, watch_timeout=watch_timeout)
+            all_informers[key] = informer
+        # kubeconfig变更后使用新的client
+        informer.api_client = api_client
+    informer.start()
+    return informer
+
+
+# 可断点续传的watch：记录最后处理的resourceVersion，重连时从该版本继续watch，只有版本过期(410)时才重新list
+# store 需要提供get(key)和set(key, value, timeout=0)，例如flask_caching的cache，为空时只在内存中记录
+class ResumableWatch():
+    """从持久化的resourceVersion继续watch，版本过期(410)时重新list
+
+    manual_commit为False时事件交给handler就算处理完成。为True时事件中带有resource_version，
+    handler的调用方处理完(例如数据库事务提交)后调用commit(versions)确认，只有按事件顺序全部确认了的最大版本才会持久化，
+    进程重启后从这个版本继续watch，未确认的事件会重新收到。processed只用于进程内去重，不作为持久化的依据。
+    """
+
+    def __init__(self, list_func, name, store=None, watch_timeout=300, persist_interval=5, manual_commit=False, **kwargs):
+        self.list_func = list_func
+        self.name = name
+        self.store = store
+        self.watch_timeout = watch_timeout
+        self.persist_interval = persist_interval
+        self.manual_commit = manual_commit
+        self.kwargs = kwargs
+        self.resource_version = None    # watch读取到的位置
+        self.committed_version = None   # 之前的事件都已经确认处理完成的位置，只持久化这个版本
+        self.inflight = deque()         # 按分发顺序排列的事件 [resource_version, 是否作为watch位置, 是否已确认]
+        self.lock = threading.Lock()
+        self.last_persist = 0
+        self.processed = {}   # (namespace, name) -> 已处理的resourceVersion，用于过滤重连和重新list时的重复事件
+        self.stopped = threading.Event()
+
+    def load(self):
+        if self.store:
+            try:
+                return self.store.get('watch_resource_version/' + self.name)
+            except Exception as e:
+                logging.error('load resource version of %s error: %s', self.name, e)
+        return None
+
+    def persist(self, force=False):
+        with self.lock:
+            committed_version = self.committed_version
+        if not self.store or not committed_version:
+            return
+        if not force and time.time() - self.last_persist < self.persist_interval:
+            return
+        try:
+            self.store.set('watch_resource_version/' + self.name, committed_version, timeout=0)
+            self.last_persist = time.time()
+        except Exception as e:
+            logging.error('persist resource version of %s error: %s', self.name, e)
+
+    def stop(self):
+        self.stopped.set()
+
+    # 记录一个分发出去的事件。position为False的事件(重新list得到的对象)只阻塞确认进度，不作为watch位置
+    def track(self, resource_version, position=True, done=False):
+        with self.lock:
+            self.inflight.append([resource_version, position, done])
+            self.advance()
+
+    # 确认一批事件已经处理完成
+    def commit(self, resource_versions):
+        resource_versions = set(resource_versions)
+        with self.lock:
+            for entry in self.inflight:
+                if entry[0] in resource_versions:
+                    entry[2] = True
+            self.advance()
+        self.persist()
+
+    # 从最早的事件开始，连续确认完成的事件出队，最后一个作为watch位置的版本就是已提交版本
+    def advance(self):
+        while self.inflight and self.inflight[0][2]:
+            resource_version, position, done = self.inflight.popleft()
+            if position and resource_version:
+                self.committed_version = resource_version
+
+    # 处理一个事件，重复的事件直接跳过
+    def dispatch(self, handler, event_type, obj, position=True):
+        meta = get_object_meta(obj)
+        key = (meta['namespace'], meta['name'])
+        if event_type == 'DELETED':
+            self.processed.pop(key, None)
+        elif meta['resource_version'] and self.processed.get(key) == meta['resource_version']:
+            return
+        else:
+            self.processed[key] = meta['resource_version']
+        if self.manual_commit:
+            self.track(meta['resource_version'], position=position)
+            handler({"type": event_type, "object": obj, "resource_version": meta['resource_version']})
+        else:
+            handler({"type": event_type, "object": obj})
+            self.track(meta['resource_version'], position=position, done=True)
+
+    # 重新list，只把没处理过或者有变化的对象作为ADDED事件处理
+    def relist(self, handler):
+        result = self.list_func(**self.kwargs)
+        if isinstance(result, dict):
+            items, resource_version = result.get('items', []), result.get('metadata', {}).get('resourceVersion')
+        else:
+            items, resource_version = result.items, result.metadata.resource_version
+        exist_keys = set()
+        for obj in items:
+            meta = get_object_meta(obj)
+            exist_keys.add((meta['namespace'], meta['name']))
+            self.dispatch(handler, 'ADDED', obj, position=False)
+        # list期间已经删除的对象不再记录
+        for key in list(self.processed.keys()):
+            if key not in exist_keys:
+                self.processed.pop(key, None)
+        self.resource_version = resource_version
+        # list的版本在所有对象都确认后才成为已提交版本
+        self.track(resource_version, done=True)
+        self.persist(force=True)
+
+    def run(self, handler):
+        self.resource_version = self.load()
+        with self.lock:
+            self.committed_version = self.resource_version
+        need_relist = not self.resource_version
+        while not self.stopped.is_set():
+            try:
+                if need_relist:
+                    logging.info('relist %s', self.name)
+                    self.relist(handler)
+                    need_relist = False
+                w = watch.Watch()
+                for event in w.stream(self.list_func, resource_version=self.resource_version, allow_watch_bookmarks=True, timeout_seconds=self.watch_timeout, **self.kwargs):
+                    obj = event['object']
+                    meta = get_object_meta(obj) if event['type'] != 'ERROR' else {}
+                    if meta.get('resource_version'):
+                        self.resource_version = meta['resource_version']
+                    if event['type'] == 'BOOKMARK':
+                        self.track(self.resource_version, done=True)
+                        self.persist(force=True)
+                        continue
+                    if event['type'] == 'ERROR':
+                        raise ApiException(status=event['raw_object'].get('code', 500), reason=event['raw_object'].get('message', ''))
+                    self.dispatch(handler, event['type'], obj)
+                    self.persist()
+                    if self.stopped.is_set():
+                        w.stop()
+                        break
+                self.persist(force=True)
+            except ApiException as e:
+                # 版本过期，只能重新list
+                if e.status == 410:
+                    need_relist = True
+                else:
+                    logging.error('watch %s error: %s', self.name, e)
+                    time.sleep(5)
+            except Exception as e:
+                logging.error('watch %s error: %s', self.name, e)
+                time.sleep(5)
+        self.persist(force=True)
@@ -1,16 +1,165 @@
 import json, datetime, time
+import copy
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import pysnooper
+from myapp.utils.cache import LRUCache
+
+# 同一个prometheus地址复用带连接池的session
+prometheus_sessions = {}
+prometheus_sessions_lock = threading.Lock()
+# 查询结果缓存，key为(地址, 表达式, step, 按step对齐后的时间窗口)
+prometheus_cache = LRUCache(max_size=1000, timeout=60)
+# 多个查询并发执行
+prometheus_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='prometheus')
+
+
+def get_session(host, pool_maxsize=20):
+    with prometheus_sessions_lock:
+        session = prometheus_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            prometheus_sessions[host] = session
+        return session
+
+
+# step转为秒数，支持 30s 1m 1h 1d 或者数字
+def step_seconds(step):
+    if isinstance(step, (int, float)):
+        return max(int(step), 1)
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if step[-1] in units:
+        return max(int(float(step[:-1]) * units[step[-1]]), 1)
+    return max(int(float(step)), 1)
+
+
+# 多组时间序列一次性按时间分箱求平均。groups为 名称->序列列表(query_range_many返回的格式)
+# 返回 名称->长度为num_bins的平均值数组，第i个分箱为[start+interval*i, start+interval*(i+1))，没有数据的分箱为0
+def bin_series_groups(groups, start, interval, num_bins, end=None):
+    names = list(groups)
+    timestamps, values, group_index = [], [], []
+    for i, name in enumerate(names):
+        for series in groups[name]:
+            timestamps.append(series['timestamps'])
+            values.append(series['values'])
+            group_index.append(np.full(len(series['timestamps']), i, dtype=np.int64))
+    if not timestamps:
+        return dict((name, np.zeros(num_bins)) for name in names)
+    timestamps = np.concatenate(timestamps)
+    values = np.concatenate(values)
+    group_index = np.concatenate(group_index)
+
+    mask = (timestamps > start) & ~np.isnan(values)
+    if end is not None:
+        mask &= timestamps < end
+    bins = ((timestamps[mask] - start) // interval).astype(np.int64)
+    index = group_index[mask] * num_bins + bins
+    keep = bins < num_bins
+    size = len(names) * num_bins
+    sums = np.bincount(index[keep], weights=values[mask][keep], minlength=size)
+    counts = np.bincount(index[keep], minlength=size)
+    means = np.divide(sums, counts, out=np.zeros(size), where=counts > 0).reshape(len(names), num_bins)
+    return dict((name, means[i]) for i, name in enumerate(names))
 
 
 class Prometheus():
 
-    def __init__(self, host=''):
+    def __init__(self, host='', timeout=30, cache_timeout=60):
         #  '/api/v1/query_range'    查看范围数据
         #  '/api/v1/query'    瞬时数据查询
         self.host = host
         self.query_path = 'http://%s/api/v1/query' % self.host
         self.query_range_path = 'http://%s/api/v1/query_range' % self.host
+        self.timeout = timeout
+        self.cache_timeout = cache_timeout
+        self.session = get_session(host)
+
+    def request(self, url, params):
+        res = self.session.get(url=url, params=params, timeout=self.timeout)
+        metrics = res.json()
+        if metrics['status'] != 'success':
+            raise RuntimeError('prometheus query %s fail: %s' % (params.get('query'), metrics.get('error', '')))
+        return metrics['data']['result']
+
+    # 范围查询，返回原始的result列表。时间窗口按step对齐，同一个窗口内的重复查询直接读缓存
+    # 缓存和返回的是不同的副本，调用方修改返回结果不会影响缓存
+    def query_range(self, expr, start, end, step='1m'):
+        seconds = step_seconds(step)
+        start = int(start) // seconds * seconds
+        end = int(end) // seconds * seconds
+        cache_key = (self.host, expr, step, start, end)
+        if self.cache_timeout:
+            hit, result = prometheus_cache.get(cache_key)
+            if hit:
+                return copy.deepcopy(result)
+        result = self.request(self.query_range_path, {
+            'query': expr,
+            'start': start,
+            'end': end,
+            'step': step  # 运行小于1分钟的，将不会被采集到
+        })
+        if self.cache_timeout:
+            prometheus_cache.set(cache_key, copy.deepcopy(result), timeout=self.cache_timeout)
+        return result
+
+    # 并发执行多个范围查询，queries为 名称->表达式，失败的查询返回空列表
+    # 表达式也可以是(表达式, start, end)，时间窗口不同的查询也能一起提交
+    def query_range_batch(self, queries, start=None, end=None, step='1m'):
+        futures = {}
+        for name, expr in queries.items():
+            expr, query_start, query_end = expr if isinstance(expr, tuple) else (expr, start, end)
+            futures[name] = (expr, prometheus_executor.submit(self.query_range, expr, query_start, query_end, step))
+        results = {}
+        for name, (expr, future) in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error('prometheus query %s error: %s', expr, e)
+                results[name] = []
+        return results
+
+    # 并发执行多个范围查询，每条时间序列返回 {"metric": 标签, "timestamps": 时间戳数组, "values": 值数组}
+    def query_range_many(self, queries, start=None, end=None, step='1m'):
+        results = self.query_range_batch(queries, start, end, step)
+        back = {}
+        for name, result in results.items():
+            back[name] = []
+            for series in result:
+                values = series.get('values', [])
+                back[name].append({
+                    "metric": series.get('metric', {}),
+                    "timestamps": np.array([value[0] for value in values], dtype=np.float64),
+                    "values": np.array([value[1] for value in values], dtype=np.float64)
+                })
+        return back
+
+    # 瞬时查询，queries为 名称->表达式，并发执行，失败的查询返回空列表
+    # 每条时间序列返回 {"metric": 标签, "timestamp": 时间戳, "value": 值}，时间戳和值为numpy.float64
+    def query_many(self, queries):
+        futures = dict((name, prometheus_executor.submit(self.request, self.query_path, {'query': expr, 'timeout': "30s"})) for name, expr in queries.items())
+        results = {}
+        for name, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error('prometheus query %s error: %s', queries[name], e)
+                result = []
+            results[name] = []
+            for series in result:
+                timestamp, value = series.get('value', [np.nan, np.nan])
+                results[name].append({
+                    "metric": series.get('metric', {}),
+                    "timestamp": np.float64(timestamp),
+                    "value": np.float64(value)
+                })
+        return results
 
     # @pysnooper.snoop()
     def get_istio_service_metric(self, namespace):
@@ -20,397 +169,93 @@ class Prometheus():
             "memory": {},
             "cpu": {}
         }
-        # qps请求
-        mem_expr = 'sum by (destination_workload,response_code) (irate(istio_requests_total{destination_service_namespace="%s"}[1m]))' % (namespace,)
-        # print(mem_expr)
-        params = {
-            'query': mem_expr,
-            'start': int(time.time())-300,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-
-        try:
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for service in metrics:
-                        service_name = service['metric']['destination_workload']
-                        if service_name not in service_metric['qps']:
-                            service_metric['qps'][service_name] = {}
-                        service_metric["qps"][service_name] = service['values']
-
-        except Exception as e:
-            print(e)
-
-        # 内存
-        mem_expr = 'sum by (pod) (container_memory_working_set_bytes{job="kubelet", image!="",container_name!="POD",namespace="%s"})' % (namespace,)
-        # print(mem_expr)
-        params = {
-            'query': mem_expr,
-            'start': int(time.time()) - 300,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-
-        try:
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for pod in metrics:
-                        pod_name = pod['metric']['pod']
-                        if pod_name not in service_metric['memory']:
-                            service_metric[pod_name] = {}
-                        service_metric['memory'][pod_name] = pod['values']
-
-        except Exception as e:
-            print(e)
-
-        # cpu获取
-        cpu_expr = "sum by (pod) (rate(container_cpu_usage_seconds_total{namespace='%s',container!='POD'}[1m]))" % (namespace)
-
-        params = {
-            'query': cpu_expr,
-            'start': int(time.time()) - 300,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for pod in metrics:
-                        pod_name = pod['metric']['pod']
-                        if pod_name not in service_metric['cpu']:
-                            service_metric[pod_name] = {}
-                        service_metric['cpu'][pod_name] = pod['values']
-
-        except Exception as e:
-            print(e)
-
-        gpu_expr = "avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='%s'})" % (namespace)
-
-        params = {
-            'query': gpu_expr,
-            'start': (datetime.datetime.now() - datetime.timedelta(days=1) - datetime.timedelta(hours=8)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-            'end': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
+        now = int(time.time())
+        queries = {
+            # qps请求
+            "qps": 'sum by (destination_workload,response_code) (irate(istio_requests_total{destination_service_namespace="%s"}[1m]))' % (namespace,),
+            # 内存
+            "memory": 'sum by (pod) (container_memory_working_set_bytes{job="kubelet", image!="",container_name!="POD",namespace="%s"})' % (namespace,),
+            # cpu获取
+            "cpu": "sum by (pod) (rate(container_cpu_usage_seconds_total{namespace='%s',container!='POD'}[1m]))" % (namespace),
+            # gpu查询最近一天
+            "gpu": ("avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='%s'})" % (namespace), now - 60 * 60 * 24, now),
         }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    # print(metrics)
-                    for pod in metrics:
-                        pod_name = pod['metric']['pod']
-                        if pod_name not in service_metric['gpu']:
-                            service_metric['gpu'][pod_name] = {}
-                        service_metric['gpu'][pod_name] = pod['values']
+        # 四个查询一起并发提交
+        results = self.query_range_batch(queries, now - 300, now)
 
-        except Exception as e:
-            print(e)
+        for service in results['qps']:
+            service_metric["qps"][service['metric'].get('destination_workload', '')] = service['values']
+        for metric_name in ['memory', 'cpu', 'gpu']:
+            for pod in results[metric_name]:
+                service_metric[metric_name][pod['metric'].get('pod', '')] = pod['values']
 
         return service_metric
 
-
+    # 每个pod在时间窗口内的内存(G)/cpu/gpu最大值
+    def get_pods_max_metric(self, queries, start, end):
+        pod_metric = {}
+        results = self.query_range_many(queries, start, end)
+        for metric_name, all_series in results.items():
+            for series in all_series:
+                pod_name = series['metric'].get('pod')
+                if not pod_name or not len(series['values']):
+                    continue
+                value = float(np.max(series['values']))
+                if pod_name not in pod_metric:
+                    pod_metric[pod_name] = {}
+                if metric_name == 'memory':
+                    pod_metric[pod_name]['memory'] = round(value / 1024 / 1024 / 1024, 2)
+                elif metric_name == 'gpu':
+                    pod_metric[pod_name]['gpu'] = round(value, 2) / 100
+                else:
+                    pod_metric[pod_name][metric_name] = round(value, 2)
+        return pod_metric
 
     # 获取当前pod利用率
     # @pysnooper.snoop()
     def get_resource_metric(self):
-        max_cpu = 0
-        max_mem = 0
-        ave_gpu = 0
-        pod_metric = {}
-        # 这个pod  30分钟内的最大值
-        mem_expr = "sum by (pod) (container_memory_working_set_bytes{container!='POD', container!=''})"
-        # print(mem_expr)
-        params = {
-            'query': mem_expr,
-            'start': int(time.time()) - 300,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-
-        try:
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for pod in metrics:
-                        if pod['metric']:
-                            pod_name = pod['metric']['pod']
-                            values = max([float(x[1]) for x in pod['values']])
-                            if pod_name not in pod_metric:
-                                pod_metric[pod_name] = {}
-                            pod_metric[pod_name]['memory'] = round(values / 1024 / 1024 / 1024, 2)
-
-        except Exception as e:
-            print(e)
-
-        cpu_expr = "sum by (pod) (rate(container_cpu_usage_seconds_total{container!='POD'}[1m]))"
-
-        params = {
-            'query': cpu_expr,
-            'start': int(time.time()) - 300,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for pod in metrics:
-                        if pod['metric']:
-                            pod_name = pod['metric']['pod']
-                            values = [float(x[1]) for x in pod['values']]
-                            # values = round(sum(values) / len(values), 2)
-                            values = round(max(values), 2)
-                            if pod_name not in pod_metric:
-                                pod_metric[pod_name] = {}
-                            pod_metric[pod_name]['cpu'] = values
-
-        except Exception as e:
-            print(e)
-
-        gpu_expr = "avg by (pod) (DCGM_FI_DEV_GPU_UTIL)"
-
-        params = {
-            'query': gpu_expr,
-            'start': int(time.time()) - 300,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
+        now = int(time.time())
+        queries = {
+            "memory": "sum by (pod) (container_memory_working_set_bytes{container!='POD', container!=''})",
+            "cpu": "sum by (pod) (rate(container_cpu_usage_seconds_total{container!='POD'}[1m]))",
+            "gpu": "avg by (pod) (DCGM_FI_DEV_GPU_UTIL)"
         }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    # print(metrics)
-                    for pod in metrics:
-                        if pod['metric']:
-                            pod_name = pod['metric']['pod']
-                            values = [float(x[1]) for x in pod['values']]
-                            # values = round(sum(values)/len(values),2)
-                            values = round(max(values), 2)
-                            if pod_name not in pod_metric:
-                                pod_metric[pod_name] = {}
-                            pod_metric[pod_name]['gpu'] = values / 100
-
-        except Exception as e:
-            print(e)
-
-        return pod_metric
+        return self.get_pods_max_metric(queries, now - 300, now)
 
     # @pysnooper.snoop()
     def get_namespace_resource_metric(self, namespace):
-        max_cpu = 0
-        max_mem = 0
-        ave_gpu = 0
-        pod_metric = {}
-        # 这个pod  30分钟内的最大值
-        mem_expr = "sum by (pod) (container_memory_working_set_bytes{namespace='%s',container!='POD', container!=''})" % (namespace,)
-        # print(mem_expr)
-        params = {
-            'query': mem_expr,
-            'start': int(time.time()) - 60*60*24,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-
-        try:
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for pod in metrics:
-                        pod_name = pod['metric']['pod']
-                        values = max([float(x[1]) for x in pod['values']])
-                        if pod_name not in pod_metric:
-                            pod_metric[pod_name] = {}
-                        pod_metric[pod_name]['memory'] = round(values / 1024 / 1024 / 1024, 2)
-
-        except Exception as e:
-            print(e)
-
-        cpu_expr = "sum by (pod) (rate(container_cpu_usage_seconds_total{namespace='%s',container!='POD'}[1m]))" % (namespace)
-
-        params = {
-            'query': cpu_expr,
-            'start': int(time.time()) - 60*60*24,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    for pod in metrics:
-                        pod_name = pod['metric']['pod']
-                        values = [float(x[1]) for x in pod['values']]
-                        # values = round(sum(values) / len(values), 2)
-                        values = round(max(values), 2)
-                        if pod_name not in pod_metric:
-                            pod_metric[pod_name] = {}
-                        pod_metric[pod_name]['cpu'] = values
-
-        except Exception as e:
-            print(e)
-
-        gpu_expr = "avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='%s'})" % (namespace)
-
-        params = {
-            'query': gpu_expr,
-            'start': int(time.time()) - 60*60*24,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
+        now = int(time.time())
+        queries = {
+            "memory": "sum by (pod) (container_memory_working_set_bytes{namespace='%s',container!='POD', container!=''})" % (namespace,),
+            "cpu": "sum by (pod) (rate(container_cpu_usage_seconds_total{namespace='%s',container!='POD'}[1m]))" % (namespace),
+            "gpu": "avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='%s'})" % (namespace)
         }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    # print(metrics)
-                    for pod in metrics:
-                        pod_name = pod['metric']['pod']
-                        values = [float(x[1]) for x in pod['values']]
-                        # values = round(sum(values)/len(values),2)
-                        values = round(max(values), 2)
-                        if pod_name not in pod_metric:
-                            pod_metric[pod_name] = {}
-                        pod_metric[pod_name]['gpu'] = values / 100
-
-        except Exception as e:
-            print(e)
-
-        return pod_metric
-
-        # @pysnooper.snoop()
+        return self.get_pods_max_metric(queries, now - 60 * 60 * 24, now)
 
+    # 这个pod一天内的内存和cpu最大值，gpu平均值
     def get_pod_resource_metric(self, pod_name, namespace):
         max_cpu = 0
         max_mem = 0
         ave_gpu = 0
-
-        # 这个pod  30分钟内的最大值
-        mem_expr = "sum by (pod) (container_memory_working_set_bytes{namespace='%s', pod=~'%s.*',container!='POD', container!=''})"%(namespace,pod_name)
-        # print(mem_expr)
-        params = {
-            'query': mem_expr,
-            'start': int(time.time()) - 60*60*24,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-
-        try:
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    metrics = metrics[0]['values']
-                    for metric in metrics:
-                        if int(metric[1]) > max_mem:
-                            max_mem = int(metric[1]) / 1024 / 1024 / 1024
-
-        except Exception as e:
-            print(e)
-
-        cpu_expr = "sum by (pod) (rate(container_cpu_usage_seconds_total{namespace='%s',pod=~'%s.*',container!='POD'}[1m]))" % (namespace, pod_name)
-
-        params = {
-            'query': cpu_expr,
-            'start': int(time.time()) - 60*60*24,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
+        now = int(time.time())
+        queries = {
+            "memory": "sum by (pod) (container_memory_working_set_bytes{namespace='%s', pod=~'%s.*',container!='POD', container!=''})" % (namespace, pod_name),
+            "cpu": "sum by (pod) (rate(container_cpu_usage_seconds_total{namespace='%s',pod=~'%s.*',container!='POD'}[1m]))" % (namespace, pod_name),
+            "gpu": "avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='%s',pod=~'%s.*'})" % (namespace, pod_name)
         }
-        print(params)
-        try:
-
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    metrics = metrics[0]['values']
-                    for metric in metrics:
-                        if float(metric[1]) > max_cpu:
-                            max_cpu = float(metric[1])
-        except Exception as e:
-            print(e)
-
-        gpu_expr = "avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='%s',pod=~'%s.*'})" % (namespace, pod_name)
-
-        params = {
-            'query': gpu_expr,
-            'start': int(time.time()) - 60*60*24,
-            'end': int(time.time()),
-            'step': "1m",  # 运行小于1分钟的，将不会被采集到
-            # 'timeout':"30s"
-        }
-        print(params)
-        try:
-            res = requests.get(url=self.query_range_path, params=params)
-            metrics = json.loads(res.content.decode('utf8', 'ignore'))
-            if metrics['status'] == 'success':
-                metrics = metrics['data']['result']
-                if metrics:
-                    metrics = metrics[0]['values']
-                    all_util = [float(metric[1]) for metric in metrics]
-                    ave_gpu = sum(all_util) / len(all_util) / 100
-        except Exception as e:
-            print(e)
+        results = self.query_range_many(queries, now - 60 * 60 * 24, now)
+        if results['memory'] and len(results['memory'][0]['values']):
+            max_mem = float(np.max(results['memory'][0]['values'])) / 1024 / 1024 / 1024
+        if results['cpu'] and len(results['cpu'][0]['values']):
+            max_cpu = float(np.max(results['cpu'][0]['values']))
+        if results['gpu'] and len(results['gpu'][0]['values']):
+            ave_gpu = float(np.mean(results['gpu'][0]['values'])) / 100
 
         return {"cpu": round(max_cpu, 2), "memory": round(max_mem, 2), 'gpu': round(ave_gpu, 2)}
 
     # todo 获取机器的负载补充完整
     # @pysnooper.snoop()
     def get_machine_metric(self):
-        # 这个pod  30分钟内的最大值
         metrics = {
             "pod_num": "sum(kubelet_running_pod_count)by (node)",
             "request_memory": "",
@@ -420,32 +265,14 @@ class Prometheus():
             "used_cpu": "",
             "used_gpu": "",
         }
-        back = {}
-        for metric_name in metrics:
-            # print(mem_expr)
-            params = {
-                'query': metrics[metric_name],
-                'timeout': "30s"
-            }
-            print(params)
-            back[metric_name] = {}
-
-            try:
-                res = requests.get(url=self.query_path, params=params)
-                metrics = json.loads(res.content.decode('utf8', 'ignore'))
-                if metrics['status'] == 'success':
-                    metrics = metrics['data']['result']
-                    if metrics:
-                        for metric in metrics:
-                            node = metric['metric']['node']
-                            if ':' in node:
-                                node = node[:node.index(':')]
-                            value = metric['value'][1]
-                            back[metric_name][node] = int(value)
-
-
-            except Exception as e:
-                print(e)
+        back = dict((metric_name, {}) for metric_name in metrics)
+        results = self.query_many(dict((metric_name, expr) for metric_name, expr in metrics.items() if expr))
+        for metric_name, result in results.items():
+            for metric in result:
+                node = metric['metric']['node']
+                if ':' in node:
+                    node = node[:node.index(':')]
+                back[metric_name][node] = int(metric['value'])
 
         return back
 
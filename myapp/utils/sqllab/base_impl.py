@@ -1,5 +1,7 @@
 import os, sys
 import logging
+import threading
+from collections import OrderedDict
 import pandas as pd
 from io import StringIO
 from flask_babel import gettext as __
@@ -11,9 +13,10 @@ from myapp.tasks.celery_app import celery_app
 from flask import g, request
 import traceback, requests
 from myapp.models.model_sqllab_query import Sqllab_Query
-from myapp import app, db
+from myapp import app, db, cache
 
 BASE_LOGGING_CONF = '[%(levelname)s] [%(asctime)s] [%(filename)s:%(lineno)d] %(message)s\n'
+RESULT_DIR = '/data/k8s/kubeflow/global/sqllab/result/'
 
 
 def db_commit_helper(dbsession):
@@ -38,6 +41,139 @@ def convert_to_str(res_text):
     return res_text
 
 
+# 按连接串复用engine，同一个worker进程内的多次查询共享连接池，超过数量上限时释放最久未使用的
+engines = OrderedDict()
+engines_lock = threading.Lock()
+
+
+def get_engine(uri):
+    from sqlalchemy import create_engine
+    with engines_lock:
+        engine = engines.get(uri)
+        if engine is None:
+            engine = create_engine(
+                uri,
+                pool_size=app.config.get('SQLLAB_ENGINE_POOL_SIZE', 5),
+                pool_recycle=3600,
+                pool_pre_ping=True
+            )
+            engines[uri] = engine
+        engines.move_to_end(uri)
+        while len(engines) > app.config.get('SQLLAB_MAX_ENGINES', 50):
+            _, old_engine = engines.popitem(last=False)
+            old_engine.dispose()
+        return engine
+
+
+# 查询所在的数据库会话id，用于从其他进程kill查询。不支持的数据库返回None，只能在两批数据之间终止
+def get_backend_id(conn):
+    dialect = conn.engine.dialect.name
+    try:
+        if dialect == 'mysql':
+            return conn.exec_driver_sql('SELECT CONNECTION_ID()').scalar()
+        if dialect == 'postgresql':
+            return conn.exec_driver_sql('SELECT pg_backend_pid()').scalar()
+    except Exception as e:
+        logging.error('get backend id error: %s', e)
+    return None
+
+
+def kill_query(uri, backend_id):
+    engine = get_engine(uri)
+    with engine.connect() as conn:
+        if engine.dialect.name == 'mysql':
+            conn.exec_driver_sql('KILL QUERY %d' % int(backend_id))
+        elif engine.dialect.name == 'postgresql':
+            conn.exec_driver_sql('SELECT pg_cancel_backend(%d)' % int(backend_id))
+
+
+def is_canceled(qid):
+    try:
+        return bool(cache.get('sqllab/cancel/%s' % qid))
+    except Exception as e:
+        logging.error('get sqllab cancel flag error: %s', e)
+        return False
+
+
+# 分批写结果，csv给下载使用，parquet按行组分页读取。pyarrow不可用或者各批数据类型不一致时只写csv
+class ResultWriter():
+
+    def __init__(self, qid):
+        self.csv_path = RESULT_DIR + f'{qid}.csv'
+        self.parquet_path = RESULT_DIR + f'{qid}.parquet'
+        self.csv_file = None
+        self.parquet_writer = None
+        self.parquet_enable = True
+        self.rows = 0
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        if os.path.exists(self.parquet_path):
+            os.remove(self.parquet_path)
+
+    def write_parquet(self, df):
+        try:
+            import pyarrow
+            import pyarrow.parquet as pq
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.parquet_path, table.schema)
+            else:
+                table = table.cast(self.parquet_writer.schema)
+            self.parquet_writer.write_table(table)
+        except Exception as e:
+            logging.error('write sqllab parquet result error, only write csv: %s', e)
+            self.parquet_enable = False
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+                self.parquet_writer = None
+            if os.path.exists(self.parquet_path):
+                os.remove(self.parquet_path)
+
+    def write(self, df):
+        if self.csv_file is None:
+            self.csv_file = open(self.csv_path, 'w', encoding='utf-8-sig', newline='')
+            df.to_csv(self.csv_file, index=None, header=True)
+        else:
+            df.to_csv(self.csv_file, index=None, header=False)
+        if self.parquet_enable:
+            self.write_parquet(df)
+        self.rows += len(df)
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+# 分页读取结果，优先只读取parquet中覆盖该范围的行组，否则跳行读取csv
+def read_result(qid, offset=0, limit=None):
+    parquet_path = RESULT_DIR + f'{qid}.parquet'
+    csv_path = RESULT_DIR + f'{qid}.csv'
+    if os.path.exists(parquet_path):
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(parquet_path)
+        total = pf.metadata.num_rows
+        columns = pf.schema_arrow.names
+        dfs = []
+        start = 0
+        for i in range(pf.num_row_groups):
+            num_rows = pf.metadata.row_group(i).num_rows
+            end = start + num_rows
+            if end > offset and (limit is None or start < offset + limit):
+                df = pf.read_row_group(i).to_pandas()
+                dfs.append(df.iloc[max(offset - start, 0):(offset + limit - start) if limit is not None else None])
+            start = end
+        df = pd.concat(dfs) if dfs else pd.DataFrame(columns=columns)
+        # 时间类型转为字符串，和读取csv的结果保持一致
+        for col in df.select_dtypes(include=['datetime', 'datetimetz']).columns:
+            df[col] = df[col].astype(str)
+    else:
+        df = pd.read_csv(csv_path, encoding='utf-8-sig', header=0, skiprows=range(1, offset + 1), nrows=limit)
+        total = None
+    df = df.astype(object).where(pd.notnull(df), '')
+    return df, total
+
+
 @celery_app.task(name="task.idex.handle_base_task", bind=False)
 def handle_task(qid, username=""):
     logging.info("============= begin run sqllab_base_task start, id:" + str(qid))
@@ -53,6 +189,9 @@ def handle_task(qid, username=""):
             if not 'limit' in q.qsql:
                 raise RuntimeError(__("查询sql必须包含limit"))
 
+            if is_canceled(qid):
+                raise RuntimeError(__("任务已终止"))
+
             q.start_time = str(datetime.datetime.now())
 
             # 校验参数
@@ -61,28 +200,42 @@ def handle_task(qid, username=""):
             q.stage = 'execute'
             dbsession.commit()
 
-            # 发起远程sql查询
-            from sqlalchemy import create_engine
-            import pandas as pd
-
-            engine = create_engine(q.engine_arg2)
-            df = pd.read_sql_query(q.qsql, engine)
-            save_path = f"/data/k8s/kubeflow/global/sqllab/result/{qid}.csv"
-            print(save_path)
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            df.to_csv(save_path, encoding='utf-8-sig', index=None, header=True)
-            print(df)
-
+            # 发起远程sql查询，服务端游标分批读取，边读边写结果文件
+            from sqlalchemy import text
+            fetch_size = app.config.get('SQLLAB_FETCH_SIZE', 10000)
+            writer = ResultWriter(qid)
+            try:
+                with get_engine(q.engine_arg2).connect() as conn:
+                    backend_id = get_backend_id(conn)
+                    if backend_id is not None:
+                        cache.set('sqllab/backend/%s' % qid, backend_id, timeout=86400)
+                    result = conn.execution_options(stream_results=True).execute(text(q.qsql))
+                    columns = list(result.keys())
+                    while True:
+                        if is_canceled(qid):
+                            raise RuntimeError(__("任务已终止"))
+                        rows = result.fetchmany(fetch_size)
+                        if not rows and writer.rows:
+                            break
+                        writer.write(pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns))
+                        if not rows:
+                            break
+                    result.close()
+            finally:
+                writer.close()
+                cache.delete('sqllab/backend/%s' % qid)
+
+            q.result_line_num = str(writer.rows)
             q.stage = 'end'
             q.status = 'success'
             dbsession.commit()
 
         except Exception as e:
             print(e)
-            # 记录异常信息
+            # 记录异常信息，被kill的查询记为终止
             err_msg = traceback.format_exc()
             q.err_msg = err_msg
-            q.status = 'failure'
+            q.status = 'stop' if is_canceled(qid) else 'failure'
             dbsession.commit()
         finally:
             q.end_time = str(datetime.datetime.now())
@@ -100,6 +253,11 @@ class Base_Impl():
         try:
             if enable_async:
                 async_task = handle_task.delay(qid, username=g.user.username)
+                # 记录celery任务id，终止时撤销还在排队的任务
+                q = db.session.query(Sqllab_Query).filter(Sqllab_Query.id == int(qid)).first()
+                if q:
+                    q.task_id = async_task.id
+                    db.session.commit()
             else:
                 stage, status, _err_msg = handle_task(qid, username=g.user.username)
                 if _err_msg != "":
@@ -142,30 +300,29 @@ class Base_Impl():
 
         return {'stage': stage, 'state': status, 'err_msg': err_msg, "spark_log_url": ui_url, "spark_ui_url": log_url}
 
-    # 同步或者异步的任务
+    # 同步或者异步的任务，limit不为空时只读取[offset, offset+limit)范围内的行
     # @pysnooper.snoop()
-    def get_result(self, task_id):
+    def get_result(self, task_id, offset=0, limit=None):
         err_msg = ""
         qid = task_id
         try:
-            csv_path = f"/data/k8s/kubeflow/global/sqllab/result/{qid}.csv"
-            df = pd.read_csv(csv_path, encoding='utf-8-sig', header=0)
-            df = df.fillna('')
+            df, total = read_result(qid, offset=offset, limit=limit)
+            if total is None:
+                q = db.session.query(Sqllab_Query).filter(Sqllab_Query.id == int(qid)).first()
+                total = int(q.result_line_num) if q and q.result_line_num.lstrip('-').isdigit() else -1
 
             res = [df.columns.values.tolist()] + df.values.tolist()
         except:
             err_msg = traceback.format_exc()
             raise RuntimeError(__("下载失败，desc: ") + err_msg)
-        return {"err_msg": err_msg, "result": res}
+        return {"err_msg": err_msg, "result": res, "total": total}
 
     # 根据分隔符生成下载文件地址
     def download_url(self, task_id):
         err_msg = ""
         qid = task_id
-        deli = '<@>'
         separator = request.args.get('separator')
-        result_route = '/data/k8s/kubeflow/global/sqllab/result/'
-        result_line_num = 0
+        result_route = RESULT_DIR
         name_map = {
             ",": "comma",
             "|": "vertical",
@@ -175,25 +332,42 @@ class Base_Impl():
         back_path = result_route + f'{qid}.{name_map[separator]}.csv'
         os.makedirs(os.path.dirname(back_path), exist_ok=True)
 
+        # 分批转换分隔符，不把整个结果文件读入内存
         if not os.path.exists(back_path):
-            with open(result_path, 'r') as f:
-                data = f.read()
-            result_line_num = data.count('\n') - 1
-            with open(back_path, 'w') as f:
-                f.write(data.replace(deli, separator))
-                f.close()
+            sep = '\t' if separator == 'TAB' else separator
+            header = True
+            with open(back_path + '.tmp', 'w', encoding='utf-8-sig', newline='') as f:
+                for df in pd.read_csv(result_path, encoding='utf-8-sig', header=0, chunksize=app.config.get('SQLLAB_FETCH_SIZE', 10000)):
+                    df.to_csv(f, sep=sep, index=None, header=header)
+                    header = False
+            os.rename(back_path + '.tmp', back_path)
 
         url = f'{request.host_url.rstrip("/")}/static/global/sqllab/result/{qid}.{name_map[separator]}.csv'
 
-        # 获取数据库记录
+        return {"err_msg": "", "download_url": url}
+
+    # 终止任务：设置终止标记，撤销排队中的celery任务，并在远程数据库上kill正在执行的查询
+    def stop(self, task_id):
+        qid = task_id
         q = db.session.query(Sqllab_Query).filter(Sqllab_Query.id == int(qid)).first()
         if not q:
             raise RuntimeError(__("任务异常，数据库记录不存在"))
-        q.result_line_num = str(result_line_num)
-        db.session.commit()
-
-        return {"err_msg": "", "download_url": url}
+        if q.status in ['success', 'failure', 'stop']:
+            return {"err_msg": __("任务已结束")}
 
-    def stop(self, task_id):
-        err_msg = __("暂未实现远程数据库kill操作")
+        err_msg = ""
+        cache.set('sqllab/cancel/%s' % qid, 1, timeout=86400)
+        if q.task_id:
+            celery_app.control.revoke(q.task_id)
+        backend_id = cache.get('sqllab/backend/%s' % qid)
+        if backend_id is not None:
+            try:
+                kill_query(q.engine_arg2, backend_id)
+            except Exception as e:
+                err_msg = __("远程数据库kill操作失败，desc: ") + str(e)
+        # 还没开始执行的任务直接标记为终止，执行中的任务由worker标记
+        if q.status != 'running':
+            q.status = 'stop'
+            q.stage = 'end'
+            db.session.commit()
         return {"err_msg": err_msg}
@@ -1,25 +1,32 @@
 import copy
 import csv
+import base64
+import datetime
 import functools
+import hashlib
+import io
 import json
 import logging
 import re
 import traceback
 import urllib.parse
+import uuid
 import os
-from flask import Markup, Response, current_app, make_response, send_file, flash, g, jsonify, request
+from flask import Markup, Response, current_app, make_response, send_file, flash, g, jsonify, request, stream_with_context
 from inspect import isfunction
 
-from sqlalchemy import create_engine
 from flask_appbuilder.actions import action
 from flask_babel import gettext as __
 from flask_babel import lazy_gettext as _
+from flask_babel import get_locale
 from flask_appbuilder.actions import ActionItem
 from flask.globals import session
 import jsonschema
 from marshmallow import ValidationError
 from marshmallow_sqlalchemy.fields import Related, RelatedList
 import prison
+from sqlalchemy import and_, or_, cast, text, Integer
+from sqlalchemy import inspect as sa_inspect
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.orm.properties import ColumnProperty
@@ -69,7 +76,9 @@ from flask_appbuilder.security.decorators import permission_name, protect, has_a
 from flask_appbuilder.api import BaseModelApi, BaseApi, ModelRestApi
 from sqlalchemy.sql import sqltypes
 from myapp import app, appbuilder, db, event_logger, cache
+from myapp.exceptions import InvalidCursorException
 from myapp.models.favorite import Favorite
+from myapp.utils.cache import get_memoize_backend, get_table_versions, watch_tables, watched_tables
 
 conf = app.config
 
@@ -234,6 +243,15 @@ def json_response(message, status, result):
 import pysnooper
 
 
+# csv异步导入的进度，保存在共享缓存中，web和worker都可以读写
+def get_upload_progress(job_id):
+    return cache.get('csv_upload/' + job_id)
+
+
+def set_upload_progress(job_id, **progress):
+    cache.set('csv_upload/' + job_id, progress, timeout=conf.get('CSV_UPLOAD_PROGRESS_TIMEOUT', 3600))
+
+
 # @pysnooper.snoop(depth=5)
 # 暴露url+视图函数。视图函数会被覆盖，暴露url也会被覆盖
 class MyappModelRestApi(ModelRestApi):
@@ -343,6 +361,8 @@ class MyappModelRestApi(ModelRestApi):
     download_data = False
     enable_favorite = False
     enable_echart = False
+    list_count_mode = 'exact'   # 列表总数的计算方式，exact/cached/approximate/none
+    info_cache = True   # _info是否分层缓存，字段结构会动态变化的页面要关闭
     pre_upload = None
     set_columns_related = None
     echart_option = None
@@ -456,6 +476,10 @@ class MyappModelRestApi(ModelRestApi):
         # 帮助地址
         self.help_url = conf.get('HELP_URL', {}).get(self.datamodel.obj.__tablename__, '') if self.datamodel else ''
 
+        # 注册视图时就登记_info依赖的关联表，每个进程中对这些表的修改都会更新版本号
+        if self.datamodel:
+            watch_tables(self.info_related_tables())
+
         # 配置搜索转换器
         self._filters = self.datamodel.get_filters(self.search_columns)
 
@@ -1022,9 +1046,81 @@ class MyappModelRestApi(ModelRestApi):
             except Exception as e:
                 print(e)
 
-        self.set_response_key_mappings(_response, self.api_info, _args, **_args)
+        # 编辑页的_info依赖具体记录，不走缓存
+        if id or not self.info_cache:
+            self.set_response_key_mappings(_response, self.api_info, _args, **_args)
+        else:
+            self.merge_cached_info(_response, _args)
         return self.response(200, **_response)
 
+    # 依赖关联表数据的merge函数，关联表有变化时缓存失效
+    def info_related_funcs(self):
+        return [MyappModelRestApi.merge_add_field_info, MyappModelRestApi.merge_edit_field_info, MyappModelRestApi.merge_search_filters, MyappModelRestApi.merge_related_field_info]
+
+    # 和当前用户相关的merge函数，每次请求都计算
+    def info_user_funcs(self):
+        return [MyappModelRestApi.merge_user_permissions, MyappModelRestApi.merge_exist_add_args, MyappModelRestApi.merge_more_info]
+
+    # 关联字段的可选值来自本表和关联表，related_views的关联表也要包含
+    def info_related_tables(self):
+        tables = set([self.datamodel.obj.__tablename__])
+        models = [self.datamodel.obj] + [related_view.datamodel.obj for related_view in self.related_views]
+        for model in models:
+            tables.add(model.__tablename__)
+            for relationship in model.__mapper__.relationships:
+                tables.add(relationship.mapper.local_table.name)
+                if relationship.secondary is not None:
+                    tables.add(relationship.secondary.name)
+        return tables
+
+    # 关联字段有过滤条件，或者页面渲染前会根据用户修改字段时，可选值和用户相关，需要按用户缓存
+    def info_per_user(self):
+        if self.add_form_query_rel_fields or self.edit_form_query_rel_fields:
+            return True
+        if [related_view for related_view in self.related_views if related_view.add_form_query_rel_fields]:
+            return True
+        return type(self).pre_add_web is not MyappModelRestApi.pre_add_web
+
+    # 分层合并_info：和用户无关的结构按视图+角色+语言缓存，依赖关联表的字段信息在关联表变化后失效，用户相关的部分每次现算
+    def merge_cached_info(self, response, args):
+        mappings = self.api_info._response_key_func_mappings
+        keys = args.get('keys', None)
+        funcs = [func for key, func in mappings.items() if not keys or key in keys]
+        related_funcs = [func for func in funcs if func in self.info_related_funcs()]
+        user_funcs = [func for func in funcs if func in self.info_user_funcs()]
+        schema_funcs = [func for func in funcs if func not in related_funcs and func not in user_funcs]
+
+        user_id = g.user.get_id() if getattr(g, 'user', None) and g.user.get_id() else ''
+        roles = sorted([role.name for role in g.user.roles]) if user_id else []
+        args_hash = hashlib.md5(json.dumps(args, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        cache_key = 'api_info/%s.%s/%s/%s/%s/%s' % (self.__class__.__module__, self.__class__.__qualname__, self.route_base, ','.join(roles), str(get_locale()), args_hash)
+        versions = get_table_versions(self.info_related_tables())
+        related_key = '%s/related/%s/%s' % (cache_key, user_id if self.info_per_user() else '', hashlib.md5(json.dumps(versions, sort_keys=True).encode('utf-8')).hexdigest())
+
+        for layer_key, layer_funcs in [(cache_key + '/schema', schema_funcs), (related_key, related_funcs)]:
+            layer = None
+            try:
+                hit, layer = get_memoize_backend().get(layer_key)
+            except Exception as e:
+                logging.error('get api_info cache error: %s', e)
+            if layer is None:
+                layer = {}
+                for func in layer_funcs:
+                    func(self, layer, **args)
+                # 转为纯json结构，缓存的内容不会被后续的修改影响
+                layer = json.loads(json.dumps(layer, default=str))
+                try:
+                    get_memoize_backend().set(layer_key, layer, timeout=conf.get('API_INFO_CACHE_TIMEOUT', 300))
+                except Exception as e:
+                    logging.error('set api_info cache error: %s', e)
+            response.update(copy.deepcopy(layer))
+
+        for func in user_funcs:
+            func(self, response, **args)
+        # 搜索的默认值和用户相关
+        for col in response.get(API_FILTERS_RES_KEY, {}):
+            response[API_FILTERS_RES_KEY][col]['default'] = self.default_filter.get(col, '')
+
     # 将expand类型的字段展开
     # @pysnooper.snoop(watch_explode=('json_data'))
     def show_expand(self,json_data_src):
@@ -1152,30 +1248,27 @@ class MyappModelRestApi(ModelRestApi):
         # Make the query
         query_select_columns = _pruned_select_cols or self.list_columns
 
-        # @pysnooper.snoop()
-        def get_favorite():
-            all_rows = db.session.query(Favorite.row_id).filter(Favorite.model_name == self.datamodel.obj.__tablename__).filter(Favorite.user_id == g.user.id).all()
-            all_rows_id = [int(row[0]) for row in all_rows]
-            return all_rows_id
-
-        # 如果只查询收藏
-        if _args.get('only_favorite', False):
-            if self.primary_key not in self.search_columns:
-                self.search_columns.append(self.primary_key)
+        # 如果只查询收藏，收藏通过子查询过滤，不再先查出所有收藏的id
+        only_favorite = _args.get('only_favorite', False)
+        if only_favorite:
             _args['filters'] = []
             self._filters.clear_filters()
-            from flask_appbuilder.models.sqla.filters import FilterInFunction
-            self._filters.add_filter(self.primary_key, FilterInFunction, get_favorite)
             joined_filters = self._filters.get_joined_filters(self._base_filters)  # 将基础filter加入到过滤器中你那个
 
-        count, lst = self.datamodel.query(
-            joined_filters,
-            order_column,
-            order_direction,
-            page=page_index,
-            page_size=page_size,
-            select_columns=query_select_columns,
-        )
+        try:
+            count, lst, next_cursor = self.query_list(
+                joined_filters,
+                order_column,
+                order_direction,
+                page=page_index,
+                page_size=page_size,
+                select_columns=query_select_columns,
+                only_favorite=only_favorite,
+                cursor=_args.get('cursor', None),
+                count_mode=_args.get('count_mode', self.list_count_mode)
+            )
+        except InvalidCursorException as e:
+            return self.response_error(400, message=str(e))
         if self.post_list:
             lst = self.post_list(lst)
 
@@ -1198,6 +1291,9 @@ class MyappModelRestApi(ModelRestApi):
         _response['data'] = data  # [item.to_json() for item in lst]
         # _response["ids"] = pks
         _response["count"] = count  # 这个是总个数
+        # 游标分页时返回下一页的游标，为空表示没有下一页了
+        if next_cursor is not None:
+            _response['next_cursor'] = next_cursor
         for index in range(len(lst)):
             _response['data'][index][self.primary_key] = getattr(lst[index], self.primary_key)
         result = _response
@@ -1216,6 +1312,116 @@ class MyappModelRestApi(ModelRestApi):
         # back_data['result']['data'][0]['creator']='aaaa'
         return self.response(200, **back_data)
 
+    # 总数的计算方式，exact 精确count，cached 缓存一段时间的count，approximate 无过滤条件时使用表统计信息，none 不计算
+    def query_list_count(self, query, joined_filters, select_columns, count_mode):
+        if count_mode == 'none':
+            return -1
+        if count_mode == 'approximate' and not joined_filters.filters and query.whereclause is None:
+            try:
+                bind = self.datamodel.session.get_bind(mapper=self.datamodel.obj.__mapper__)
+                if bind.dialect.name == 'mysql':
+                    count = self.datamodel.session.execute(
+                        text('select TABLE_ROWS from information_schema.TABLES where TABLE_SCHEMA=database() and TABLE_NAME=:table_name'),
+                        {"table_name": self.datamodel.obj.__tablename__}
+                    ).scalar()
+                    if count is not None:
+                        return int(count)
+            except Exception as e:
+                logging.error('approximate count error: %s', e)
+        if count_mode in ['cached', 'approximate']:
+            # 过滤条件里包含了用户相关的基础过滤，所以按sql语句和参数区分缓存
+            statement = self.datamodel.apply_all(query, joined_filters).statement.compile()
+            cache_key = 'list_count/%s/%s' % (self.datamodel.obj.__tablename__, hashlib.md5((str(statement) + repr(sorted(statement.params.items(), key=lambda x: x[0]))).encode('utf-8')).hexdigest())
+            count = cache.get(cache_key)
+            if count is None:
+                count = self.datamodel.query_count(query, joined_filters, select_columns)
+                cache.set(cache_key, count, timeout=conf.get('LIST_COUNT_CACHE_TIMEOUT', 60))
+            return count
+        return self.datamodel.query_count(query, joined_filters, select_columns)
+
+    # 游标编码了上一页最后一行的排序列和主键
+    def encode_cursor(self, item, order_column):
+        value = getattr(item, order_column) if order_column else None
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.isoformat()
+        last = {
+            "pk": getattr(item, self.primary_key),
+            "value": value
+        }
+        return base64.urlsafe_b64encode(json.dumps(last, default=str).encode('utf-8')).decode('utf-8')
+
+    # 游标不合法时抛出InvalidCursorException，接口返回400
+    def decode_cursor(self, cursor, order_attr):
+        try:
+            last = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+            value = last.get('value', None)
+            if order_attr is not None and value is not None:
+                column_type = order_attr.property.columns[0].type
+                if isinstance(column_type, sqltypes.DateTime):
+                    value = datetime.datetime.fromisoformat(value)
+                elif isinstance(column_type, sqltypes.Date):
+                    value = datetime.date.fromisoformat(value)
+            return last['pk'], value
+        except Exception as e:
+            raise InvalidCursorException('invalid cursor: %s' % e)
+
+    # 列表查询，传了cursor参数时使用游标分页(第一页传空字符串)，按排序列+主键定位，不再扫描offset之前的行
+    def query_list(self, joined_filters, order_column, order_direction, page=None, page_size=None, select_columns=None, only_favorite=False, cursor=None, count_mode='exact'):
+        model = self.datamodel.obj
+        pk_attr = getattr(model, self.primary_key)
+        query = self.datamodel.session.query(model)
+        if only_favorite:
+            favorite_ids = db.session.query(cast(Favorite.row_id, Integer)).filter(Favorite.model_name == model.__tablename__).filter(Favorite.user_id == g.user.id)
+            query = query.filter(pk_attr.in_(favorite_ids))
+
+        count = self.query_list_count(query, joined_filters, select_columns, count_mode)
+
+        next_cursor = None
+        if cursor is None:
+            query = self.datamodel.apply_all(
+                query,
+                joined_filters,
+                order_column,
+                order_direction,
+                page=page,
+                page_size=page_size,
+                select_columns=select_columns
+            )
+        else:
+            # 只支持按本表的普通列排序，其他情况按主键排序
+            order_attr = getattr(model, order_column, None) if order_column and order_column != self.primary_key else None
+            if not isinstance(order_attr, InstrumentedAttribute) or not isinstance(order_attr.property, ColumnProperty):
+                order_attr = None
+                order_column = ''
+            desc = order_direction == 'desc'
+            query = self.datamodel.apply_all(query, joined_filters, select_columns=select_columns)
+            # 排序列为NULL的行视为最小值，升序时排在最前，降序时排在最后，和游标的过滤条件保持一致
+            if cursor:
+                last_pk, last_value = self.decode_cursor(cursor, order_attr)
+                if order_attr is None:
+                    query = query.filter(pk_attr < last_pk if desc else pk_attr > last_pk)
+                elif desc and last_value is None:
+                    query = query.filter(and_(order_attr.is_(None), pk_attr < last_pk))
+                elif desc:
+                    query = query.filter(or_(order_attr < last_value, and_(order_attr == last_value, pk_attr < last_pk), order_attr.is_(None)))
+                elif last_value is None:
+                    query = query.filter(or_(order_attr.isnot(None), and_(order_attr.is_(None), pk_attr > last_pk)))
+                else:
+                    query = query.filter(or_(order_attr > last_value, and_(order_attr == last_value, pk_attr > last_pk)))
+            order_by = [order_attr.isnot(None), order_attr, pk_attr] if order_attr is not None else [pk_attr]
+            query = query.order_by(*[attr.desc() if desc else attr.asc() for attr in order_by])
+            if page_size and page_size > 0:
+                query = query.limit(page_size)
+
+        lst = query.all()
+        # 和datamodel.query一样，查询结果是元组时取出model对象
+        if lst and not isinstance(lst[0], model) and hasattr(lst[0], model.__name__):
+            lst = [getattr(item, model.__name__) for item in lst]
+
+        if cursor is not None:
+            next_cursor = self.encode_cursor(lst[-1], order_column) if lst and page_size and 0 < page_size <= len(lst) else ''
+        return count, lst, next_cursor
+
     # @pysnooper.snoop()
     def json_to_item(self, data):
         class Back:
@@ -1494,89 +1700,255 @@ class MyappModelRestApi(ModelRestApi):
 
         return jsonify({})
 
-    @expose("/upload/", methods=["POST"])
-    def upload(self):
-        csv_file = request.files.get('csv_file')  # FileStorage
-        # 文件保存至指定路径
-        i_path = csv_file.filename
-        if os.path.exists(i_path):
-            os.remove(i_path)
-        csv_file.save(i_path)
-        # 读取csv，读取header，按行处理
-        import csv
-        csv_reader = csv.reader(open(i_path, mode='r', encoding='utf-8-sig'))
-        header = None
-        result = []
-        for line in csv_reader:
-            if not header:
-                header = line
-                continue
-            # 判断header里面的字段是否在数据库都有
-            for col_name in header:
-                # attr = self.datamodel.obj
-                if not hasattr(self.datamodel.obj, col_name):
-                    message = __('csv首行header与数据库字段不对应')
-                    flash(message, 'warning')
-                    back = {
-                        "status": 1,
-                        "result": [],
-                        "message": message
-                    }
-                    return self.response(200, **back)
-
-            # 个数不对的去掉
-            if len(line) != len(header):
-                continue
-
-            # 全是空值的去掉
-            ll = [l.strip() for l in line if l.strip()]
-            if not ll:
-                continue
-
-            data = dict(zip(header, line))
-
+    # 一批数据先执行钩子再批量写入，批量写入失败时逐行写入，定位出错的行
+    def import_batch(self, batch):
+        result = {}
+        models = []
+        for line_num, data in batch:
             try:
                 if self.pre_upload:
                     data = self.pre_upload(data)
                 model = self.datamodel.obj(**data)
                 self.pre_add(model)
-                db.session.add(model)
-                self.post_add(model)
-                db.session.commit()
-                result.append('success')
+                models.append((line_num, model))
             except Exception as e:
+                result[line_num] = 'line %s: %s' % (line_num, str(e))
+
+        if models:
+            try:
+                self.save_batch([model for line_num, model in models])
+                for line_num, model in models:
+                    result[line_num] = 'success'
+            except Exception:
                 db.session.rollback()
-                print(e)
-                result.append(str(e))
+                for line_num, model in models:
+                    try:
+                        self.save_batch([model])
+                        result[line_num] = 'success'
+                    except Exception as e:
+                        db.session.rollback()
+                        result[line_num] = 'line %s: %s' % (line_num, str(e))
+
+        return [result[line_num] for line_num, data in batch]
+
+    def save_batch(self, models):
+        # 没有post_add钩子的直接批量insert，否则先flush拿到主键再执行post_add
+        # bulk_save_objects不会触发insert监听器和flush事件，有监听器或者表被缓存依赖时也走正常的flush
+        mapper = sa_inspect(self.datamodel.obj)
+        has_listeners = bool(mapper.dispatch.before_insert) or bool(mapper.dispatch.after_insert)
+        if type(self).post_add is MyappModelRestApi.post_add and not has_listeners and mapper.local_table.name not in watched_tables:
+            db.session.bulk_save_objects(models)
+        else:
+            db.session.add_all(models)
+            db.session.flush()
+            for model in models:
+                self.post_add(model)
+        db.session.commit()
+
+    # 流式读取csv，header只校验一次，按批导入。返回每一行的结果，header不对应时返回None和错误信息
+    def import_csv(self, file_path, batch_size=None, progress=None):
+        batch_size = batch_size or conf.get('CSV_UPLOAD_BATCH_SIZE', 1000)
+        result = []
+        with open(file_path, mode='r', encoding='utf-8-sig', newline='') as csv_file:
+            csv_reader = csv.reader(csv_file)
+            header = next(csv_reader, None)
+            # 判断header里面的字段是否在数据库都有
+            if not header or [col_name for col_name in header if not hasattr(self.datamodel.obj, col_name)]:
+                return None, __('csv首行header与数据库字段不对应')
+
+            batch = []
+            for line in csv_reader:
+                line_num = csv_reader.line_num
+                # 个数不对的去掉
+                if len(line) != len(header):
+                    result.append('line %s: column number %s not match header %s' % (line_num, len(line), len(header)))
+                    continue
+
+                # 全是空值的去掉
+                ll = [l.strip() for l in line if l.strip()]
+                if not ll:
+                    continue
+
+                batch.append((line_num, dict(zip(header, line))))
+                if len(batch) >= batch_size:
+                    result.extend(self.import_batch(batch))
+                    batch = []
+                    if progress:
+                        progress(result)
+            if batch:
+                result.extend(self.import_batch(batch))
+        return result, ''
+
+    @expose("/upload/", methods=["POST"])
+    def upload(self):
+        csv_file = request.files.get('csv_file')  # FileStorage
+        # 文件保存至共享目录，使用随机文件名，避免不同用户上传同名文件互相覆盖
+        upload_folder = conf.get('CSV_UPLOAD_FOLDER', '/data/k8s/kubeflow/global/csv_upload/')
+        os.makedirs(upload_folder, exist_ok=True)
+        i_path = os.path.join(upload_folder, uuid.uuid4().hex + '.csv')
+        csv_file.save(i_path)
+
+        # 大文件放到celery中异步导入，前端通过 upload/<job_id> 查看进度
+        if os.path.getsize(i_path) > conf.get('CSV_UPLOAD_ASYNC_SIZE', 10 * 1024 * 1024):
+            from myapp.tasks.async_task import import_csv
+            job_id = uuid.uuid4().hex
+            set_upload_progress(job_id, status='pending', success=0, fail=0, errors=[])
+            kwargs = {
+                "view_name": self.__class__.__name__,
+                "file_path": i_path,
+                "user_id": g.user.id,
+                "job_id": job_id
+            }
+            import_csv.apply_async(kwargs=kwargs)
+            back = {
+                "status": 0,
+                "message": __('文件较大，已转为后台导入'),
+                "result": {
+                    "job_id": job_id
+                }
+            }
+            return self.response(200, **back)
 
-        flash('success %s rows，fail %s rows' % (len([x for x in result if x == 'success']), len([x for x in result if x == 'fail'])),'warning')
+        try:
+            result, message = self.import_csv(i_path)
+        finally:
+            os.remove(i_path)
+        if result is None:
+            flash(message, 'warning')
+            back = {
+                "status": 1,
+                "result": [],
+                "message": message
+            }
+            return self.response(200, **back)
+
+        success = len([x for x in result if x == 'success'])
+        flash('success %s rows，fail %s rows' % (success, len(result) - success), 'warning')
         back = {
             "status": 0,
-            "message": "success %s rows" % len([x for x in result if x == 'success']),
+            "message": "success %s rows" % success,
             "result": result
         }
         return self.response(200, **back)
 
+    @expose("/upload/<job_id>", methods=["GET"])
+    def upload_progress(self, job_id):
+        progress = get_upload_progress(job_id)
+        if not progress:
+            back = {
+                "status": 1,
+                "result": {},
+                "message": 'job %s not exist or expired' % job_id
+            }
+            return self.response(404, **back)
+        back = {
+            "status": 0,
+            "result": progress,
+            "message": progress.get('status', '')
+        }
+        return self.response(200, **back)
+
+    # 分批产出导出的数据，全量导出时直接使用数据库的服务端游标，搜索结果导出时使用orm的yield_per
+    def export_rows(self, joined_filters=None):
+        batch_size = conf.get('EXPORT_BATCH_SIZE', 5000)
+        if joined_filters is None:
+            # 复用flask_sqlalchemy按bind缓存的连接池，不再每次请求创建engine
+            bind_key = getattr(self.datamodel.obj, '__bind_key__', None)
+            engine = db.get_engine(bind=bind_key) if bind_key else db.engine
+            table = self.datamodel.obj.__table__
+            with engine.connect() as connection:
+                result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(table.select())
+                for rows in result.partitions(batch_size):
+                    yield [list(row) for row in rows]
+            return
+
+        query = self.datamodel.session.query(self.datamodel.obj)
+        query = self.datamodel.apply_all(query, joined_filters)
+        rows = []
+        for item in query.execution_options(stream_results=True).yield_per(batch_size):
+            rows.append([getattr(item, col) for col in self.show_columns])
+            if len(rows) >= batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    # csv按块输出，不落盘
+    def stream_csv(self, columns, batches):
+        buffer = io.StringIO()
+        csvwrite = csv.writer(buffer, delimiter=',')
+        buffer.write('\ufeff')  # 带bom头，excel打开不乱码，和原来的utf-8-sig保持一致
+        csvwrite.writerow(columns)
+        for rows in batches:
+            csvwrite.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue().encode('utf-8')
+
+    # parquet每批数据写一个row group，写完立刻输出
+    def stream_parquet(self, columns, batches):
+        import pyarrow
+        import pyarrow.parquet
+
+        # 只需要顺序写，记录写入的位置给pyarrow使用
+        class StreamSink(io.RawIOBase):
+            def __init__(self):
+                self.buffer = bytearray()
+                self.position = 0
+
+            def writable(self):
+                return True
+
+            def write(self, data):
+                self.buffer.extend(data)
+                self.position += len(data)
+                return len(data)
+
+            def tell(self):
+                return self.position
+
+            def pop(self):
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return data
+
+        # 根据数据库字段类型确定schema，非数据库字段和无法识别的类型按字符串处理
+        def arrow_type(col):
+            column = self.datamodel.obj.__table__.columns.get(col)
+            column_type = getattr(column, 'type', None)
+            if isinstance(column_type, sqltypes.Boolean):
+                return pyarrow.bool_()
+            if isinstance(column_type, sqltypes.Integer):
+                return pyarrow.int64()
+            if isinstance(column_type, (sqltypes.Float, sqltypes.Numeric)):
+                return pyarrow.float64()
+            if isinstance(column_type, sqltypes.DateTime):
+                return pyarrow.timestamp('us')
+            if isinstance(column_type, sqltypes.Date):
+                return pyarrow.date32()
+            return pyarrow.string()
+
+        schema = pyarrow.schema([(col, arrow_type(col)) for col in columns])
+        sink = StreamSink()
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+        for rows in batches:
+            data = {}
+            for index, field in enumerate(schema):
+                values = [row[index] for row in rows]
+                if field.type == pyarrow.string():
+                    values = [str(value) if value is not None else None for value in values]
+                data[field.name] = values
+            writer.write_table(pyarrow.Table.from_pydict(data, schema=schema))
+            yield sink.pop()
+        writer.close()
+        yield sink.pop()
+
     @expose("/download/", methods=["GET"])
     # @pysnooper.snoop()
     def download(self):
-        import pandas
-        sqllchemy_uri = conf.get('SQLALCHEMY_DATABASE_URI', '')
-        bind_key = getattr(self.datamodel.obj, '__bind_key__', None)
-        if bind_key:
-            bind_sqllchemy_uri = conf['SQLALCHEMY_BINDS'].get(bind_key, '')
-            if bind_sqllchemy_uri:
-                sqllchemy_uri = bind_sqllchemy_uri
-
-        import sqlalchemy.engine.url as url
-        uri = url.make_url(sqllchemy_uri)
-        sql_engine = create_engine(uri)
         table_name = self.datamodel.obj.__tablename__
-        # sql = 'select `%s` from %s' % ('`,`'.join(self.show_columns), table_name)
-        file_name = '%s.csv' % table_name
-        csv_file_path = os.path.abspath(file_name)
-        if os.path.exists(csv_file_path):
-            os.remove(csv_file_path)
+        export_format = request.args.get('format', 'csv')
 
         _args = request.get_json(silent=True) or {}
         req_json = json.loads(request.args.get('form_data', "{}"))  # 根据请求筛选下载数据，而不是全量下载
@@ -1584,43 +1956,32 @@ class MyappModelRestApi(ModelRestApi):
         # 下载搜索出来的
         if _args and _args.get('filters', []):
             joined_filters = self._handle_filters_args(_args)
-            count, lst = self.datamodel.query(
-                joined_filters,
-                '',
-                '',
-                page=0,
-                page_size='20000',
-                select_columns=self.show_columns,
-            )
-            # print(count,lst)
-            if count > 0:
-                with(open(csv_file_path, 'w', newline='', encoding="utf-8-sig")) as csvfile:
-                    csvwrite = csv.writer(csvfile, delimiter=',')
-                    csvwrite.writerow(self.show_columns)
-                    for item in lst:
-                        data = []
-                        for col in self.show_columns:
-                            data.append(getattr(item, col))
-                        csvwrite.writerow(data)
-                    csvfile.close()
-
-                response = Response(self.send_file(csv_file_path), content_type='application/octet-stream')
-                response.headers["Content-disposition"] = 'attachment; filename=%s' % file_name  # 如果不加上这行代码，导致下图的问题
-                return response
-
+            columns = self.show_columns
         # 下载全量
-        sql = 'select * from %s' % (table_name)
-        print(sql)
-        results = pandas.read_sql_query(sql, sql_engine)
-        results.to_csv(csv_file_path, index=False, sep=",", encoding='utf-8-sig')  # index 是第几行的表示
+        else:
+            joined_filters = None
+            columns = [column.name for column in self.datamodel.obj.__table__.columns]
 
-        response = Response(self.send_file(csv_file_path), content_type='application/octet-stream')
+        if export_format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                back = {
+                    "status": 1,
+                    "result": {},
+                    "message": 'parquet export need pyarrow'
+                }
+                return self.response(400, **back)
+            file_name = '%s.parquet' % table_name
+            body = self.stream_parquet(columns, self.export_rows(joined_filters))
+        else:
+            file_name = '%s.csv' % table_name
+            body = self.stream_csv(columns, self.export_rows(joined_filters))
+
+        response = Response(stream_with_context(body), content_type='application/octet-stream')
         response.headers["Content-disposition"] = 'attachment; filename=%s' % file_name  # 如果不加上这行代码，导致下图的问题
         return response
 
-        # response = self.csv_response(csv_file_path, file_name=table_name)
-        # return response
-
     @expose("/favorite/<pk>", methods=["POST", 'DELETE'])
     # @pysnooper.snoop()
     def favorite(self, pk):
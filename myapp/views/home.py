@@ -9,12 +9,22 @@ import datetime
 from flask import jsonify
 from myapp import conf
 from myapp.views.base import BaseMyappView
+from myapp.utils.cache import memoized_func, view_cache_key
+from myapp.security import MyappSecurityManager
 
 from flask_appbuilder import expose
 from myapp import appbuilder
 from flask import stream_with_context, request
 
 
+# 菜单按用户权限生成，缓存key带上权限版本号，角色或权限变化后版本号递增，旧的菜单缓存不再命中
+def menu_cache_key(*args, **kwargs):
+    key = view_cache_key(*args, **kwargs)
+    if key is None:
+        return None
+    return '%s/%s' % (key, MyappSecurityManager.get_permission_version())
+
+
 class Myapp(BaseMyappView):
     route_base = '/myapp'
     default_view = 'welcome'  # 设置进入蓝图的默认访问视图（没有设置网址的情况下）
@@ -69,6 +79,7 @@ class Myapp(BaseMyappView):
         return jsonify(data)
 
     @expose('/menu')
+    @memoized_func(key=menu_cache_key, timeout=conf.get('MENU_CACHE_TIMEOUT', 300))
     def menu(self):
 
         # 项目空间
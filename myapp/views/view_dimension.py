@@ -933,6 +933,7 @@ class Dimension_remote_table_ModelView_Api(MyappModelRestApi):
                     import_data=True,
                     download_data=True,
                     cols_width=cols_width,
+                    info_cache=False,
                     base_order=(get_primary_key(columns), "desc") if get_primary_key(columns) else None,
                     cols=columns
                 )
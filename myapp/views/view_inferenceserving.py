@@ -9,7 +9,8 @@ from myapp.utils import core
 from flask_babel import gettext as __
 from flask_babel import lazy_gettext as _
 from flask_appbuilder.actions import action
-from myapp import app, appbuilder, db
+from myapp import app, appbuilder, db, cache
+import numpy as np
 import re
 import pytz
 import pysnooper
@@ -44,10 +45,104 @@ import datetime, time, json
 
 conf = app.config
 
-global_all_service_load = {
-    "data": None,
-    "check_time": None
-}
+SERVICE_LOAD_CACHE_KEY = 'inferenceservice/echart_option'
+
+
+# 生成在线服务当天的gpu负载曲线。所有服务的时间序列一次性按5分钟分箱，pod按名称前缀归属到服务
+# @pysnooper.snoop()
+def build_service_load_option(dbsession):
+    from myapp.utils.py.py_prometheus import Prometheus, bin_series_groups
+    all_services = dbsession.query(InferenceService).filter_by(model_status='online').all()
+    services = dict((service.name, service.created_by.username + ":" + service.label) for service in all_services)
+
+    prometheus = Prometheus(conf.get('PROMETHEUS', ''))
+    now = time.time()
+    today_time = int(datetime.datetime.strptime(datetime.datetime.now().strftime("%Y-%m-%d"), "%Y-%m-%d").timestamp())
+    time_during = 5 * 60
+    num_bins = 60 * 60 * 24 // time_during   # 每5分钟一个分箱
+    end_point = min(int(now - today_time) // time_during, num_bins - 1)
+    start_point = max(end_point - 60, 0)
+    legend = ['qps', 'cpu', 'memory', 'gpu']
+
+    gpu_metrics = prometheus.query_range_many({
+        "gpu": "avg by (pod) (DCGM_FI_DEV_GPU_UTIL{namespace='service'})"
+    }, now - 60 * 60 * 24, now)['gpu']
+    groups = {}
+    for series in gpu_metrics:
+        parts = series['metric'].get('pod', '').split('-')
+        for i in range(1, len(parts) + 1):
+            service_name = '-'.join(parts[:i])
+            if service_name in services:
+                groups.setdefault(service_name, []).append(series)
+
+    services_metrics = []
+    metric_binning = bin_series_groups(groups, today_time, time_during, num_bins, end=now)
+    times = (today_time + time_during * np.arange(1, end_point + 2)) * 1000
+    for service_name in groups:
+        services_metrics.append(
+            {
+                "name": services[service_name],
+                "type": 'line',
+                "smooth": True,
+                "showSymbol": False,
+                "data": np.column_stack([times, metric_binning[service_name][:end_point + 1].astype(np.int64)]).tolist()
+            }
+        )
+
+    option = '''
+    {
+      "title": {
+        "text": 'GPU monitor'
+      },
+      "tooltip": {
+        "trigger": 'axis',
+         "position": [10, 10]
+      },
+
+      "legend": {
+        "data": {{ legend }}
+      },
+       
+      "grid": {
+        "left": '3%',
+        "right": '4%',
+        "bottom": '3%',
+        "containLabel": true
+      },
+      "xAxis": {
+        "type": "time",
+        "min": new Date('{{today}}'),
+        "max": new Date('{{tomorrow}}'),
+        "boundaryGap": false,
+        "timezone" : 'Asia/Shanghai', 
+      },
+      "yAxis": {
+        "type": "value",
+        "boundaryGap": false,
+        "axisLine":{       //y轴
+          "show":false
+        },
+        "axisTick":{       //y轴刻度线
+          "show":true
+        },
+        "splitLine": {     //网格线
+          "show": true,
+          "color": '#f1f2f6'
+        }
+      },
+      "series": {{services_metric}}
+    }
+    
+    '''
+    rtemplate = Environment(loader=BaseLoader, undefined=DebugUndefined).from_string(option)
+    return rtemplate.render(
+        legend=legend,
+        services_metric=json.dumps(services_metrics, ensure_ascii=False, indent=4),
+        start_point=start_point,
+        end_point=end_point,
+        today=datetime.datetime.now().strftime('%Y/%m/%d'),
+        tomorrow=(datetime.datetime.now() + datetime.timedelta(days=1)).strftime('%Y/%m/%d'),
+    )
 
 
 class InferenceService_Filter(MyappFilter):
@@ -1147,152 +1242,13 @@ output %s
             raise e
         return redirect(request.referrer)
 
+    # 在线服务的负载曲线，优先读取定时任务写入共享缓存的结果
     # @pysnooper.snoop()
     def echart_option(self, filters=None):
-        print(filters)
-        global global_all_service_load
-        if not global_all_service_load:
-            global_all_service_load['check_time'] = None
-
-        option=global_all_service_load['data']
-        if not global_all_service_load['check_time'] or (datetime.datetime.now() - global_all_service_load['check_time']).total_seconds()>3600:
-            all_services = db.session.query(InferenceService).filter_by(model_status='online').all()
-
-            from myapp.utils.py.py_prometheus import Prometheus
-            prometheus = Prometheus(conf.get('PROMETHEUS', ''))
-            # prometheus = Prometheus('10.101.142.16:8081')
-            all_services_load = prometheus.get_istio_service_metric(namespace='service')
-            services_metrics = []
-            legend=['qps','cpu','memory','gpu']
-            today_time = int(datetime.datetime.strptime(datetime.datetime.now().strftime("%Y-%m-%d"),"%Y-%m-%d").timestamp())
-            time_during = 5 * 60
-            end_point = min(int(datetime.datetime.now().timestamp() - today_time)//time_during, 60*60*24//time_during)
-            start_point = max(end_point - 60, 0)
-
-            # @pysnooper.snoop()
-            def add_metric_data(metric, metric_name, service_name):
-                if metric_name == 'qps':
-                    metric = [[date_value[0], int(float(date_value[1]))] for date_value in metric if datetime.datetime.now().timestamp() > date_value[0] > today_time]
-                if metric_name == 'memory':
-                    metric = [[date_value[0], round(float(date_value[1]) / 1024 / 1024 / 1024, 2)] for date_value in metric if datetime.datetime.now().timestamp() > date_value[0] > today_time]
-                if metric_name == 'cpu' or metric_name == 'gpu':
-                    metric = [[date_value[0], round(float(date_value[1]), 2)] for date_value in metric if datetime.datetime.now().timestamp() > date_value[0] > today_time]
-
-                if metric:
-                    # 将时间戳转化为时间段分箱，按分钟分箱
-
-                    metric_binning = [[0] for x in range(60 * 60 * 24 // time_during)]  # 每5分钟一个分箱
-                    for date_value in metric:
-                        timestamp, value = date_value[0], date_value[1]
-                        metric_binning[(timestamp - today_time) // time_during].append(value)
-                    metric_binning = [int(sum(x) / len(x)) for x in metric_binning]
-
-                    # metric_binning = [[datetime.datetime.fromtimestamp(today_time+time_during*i+time_during).strftime('%Y-%m-%dT%H:%M:%S.000Z'),metric_binning[i]] for i in range(len(metric_binning)) if i<=end_point]
-                    metric_binning = [[(today_time+time_during*i+time_during)*1000,metric_binning[i]] for i in range(len(metric_binning)) if i<=end_point]
-
-                    services_metrics.append(
-                        {
-                            "name": service_name,
-                            "type": 'line',
-                            "smooth": True,
-                            "showSymbol": False,
-                            "data": metric_binning
-                        }
-                    )
-
-            for service in all_services:
-                # qps_metric = all_services_load['qps'].get(service.name,[])
-                # add_metric_data(qps_metric, 'qps',service.name)
-                #
-                # servie_pod_metrics = []
-                # for pod_name in all_services_load['memory']:
-                #     if service.name in pod_name:
-                #         pod_metric = all_services_load['memory'][pod_name]
-                #         servie_pod_metrics = servie_pod_metrics + pod_metric
-                # add_metric_data(servie_pod_metrics, 'memory', service.name)
-                #
-                # servie_pod_metrics = []
-                # for pod_name in all_services_load['cpu']:
-                #     if service.name in pod_name:
-                #         pod_metric = all_services_load['cpu'][pod_name]
-                #         servie_pod_metrics = servie_pod_metrics + pod_metric
-                # add_metric_data(servie_pod_metrics, 'cpu',service.name)
-
-                servie_pod_metrics = []
-                for pod_name in all_services_load['gpu']:
-                    if service.name in pod_name:
-                        pod_metric = all_services_load['gpu'][pod_name]
-                        servie_pod_metrics = servie_pod_metrics + pod_metric
-                add_metric_data(servie_pod_metrics, 'gpu', service.created_by.username + ":" + service.label)
-
-            # dataZoom: [
-            #     {
-            #         start: {{start_point}},
-            #         end: {{end_point}}
-            #     }
-            # ],
-            option = '''
-            {
-              "title": {
-                "text": 'GPU monitor'
-              },
-              "tooltip": {
-                "trigger": 'axis',
-                 "position": [10, 10]
-              },
-        
-              "legend": {
-                "data": {{ legend }}
-              },
-               
-              "grid": {
-                "left": '3%',
-                "right": '4%',
-                "bottom": '3%',
-                "containLabel": true
-              },
-              "xAxis": {
-                "type": "time",
-                "min": new Date('{{today}}'),
-                "max": new Date('{{tomorrow}}'),
-                "boundaryGap": false,
-                "timezone" : 'Asia/Shanghai', 
-              },
-              "yAxis": {
-                "type": "value",
-                "boundaryGap": false,
-                "axisLine":{       //y轴
-                  "show":false
-                },
-                "axisTick":{       //y轴刻度线
-                  "show":true
-                },
-                "splitLine": {     //网格线
-                  "show": true,
-                  "color": '#f1f2f6'
-                }
-              },
-              "series": {{services_metric}}
-            }
-    
-            '''
-            # print(services_metrics)
-            rtemplate = Environment(loader=BaseLoader, undefined=DebugUndefined).from_string(option)
-            option = rtemplate.render(
-                legend=legend,
-                services_metric=json.dumps(services_metrics, ensure_ascii=False, indent=4),
-                start_point=start_point,
-                end_point=end_point,
-                today=datetime.datetime.now().strftime('%Y/%m/%d'),
-                tomorrow=(datetime.datetime.now() + datetime.timedelta(days=1)).strftime('%Y/%m/%d'),
-            )
-            # global_all_service_load['check_time']=datetime.datetime.now()
-
-        global_all_service_load['data'] = option
-        # print(option)
-        # file = open('myapp/test.txt',mode='w')
-        # file.write(option)
-        # file.close()
+        option = cache.get(SERVICE_LOAD_CACHE_KEY)
+        if option is None:
+            option = build_service_load_option(db.session)
+            cache.set(SERVICE_LOAD_CACHE_KEY, option, timeout=conf.get('SERVICE_LOAD_CACHE_TIMEOUT', 600))
         return option
 
 
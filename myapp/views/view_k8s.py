@@ -5,7 +5,8 @@ from flask_babel import gettext as __
 from flask_babel import lazy_gettext as _
 from myapp import app, conf
 from myapp.utils.py.py_k8s import K8s, K8SStreamThread
-from flask import g, flash, request, render_template, send_from_directory, send_file, make_response, Markup, jsonify
+from myapp.utils.py.py_log import LogWindow, LogFanout
+from flask import g, flash, request, render_template, send_from_directory, send_file, make_response, Markup, jsonify, Response, stream_with_context
 
 import datetime, time
 from myapp import app, appbuilder, db, event_logger
@@ -13,6 +14,15 @@ from .base import BaseMyappView
 from flask_appbuilder import CompactCRUDMixin, expose
 
 
+# 同一个web进程内，多个用户查看同一个容器的实时日志时只从kubelet读取一次。
+# 日志流只在进程内共享，gunicorn每个worker进程各有一份，需要使用gthread等多线程worker，长连接只占用一个线程
+log_fanout = LogFanout(
+    buffer_lines=conf.get('LOG_FANOUT_BUFFER_LINES', 1000),
+    tail_lines=conf.get('LOG_FANOUT_BUFFER_LINES', 1000),
+    idle_timeout=conf.get('LOG_FANOUT_IDLE_TIMEOUT', 60)
+)
+
+
 class K8s_View(BaseMyappView):
     route_base = '/k8s'
 
@@ -20,7 +30,7 @@ class K8s_View(BaseMyappView):
     @expose("/watch/log/<cluster_name>/<namespace>/<pod_name>/<container_name>", methods=["GET", ])
     def watch_log(self, cluster_name, namespace, pod_name, container_name):
         data = {
-            "url": '/k8s/stream/log',
+            "url": f'/k8s/stream/log/{cluster_name}/{namespace}/{pod_name}/{container_name}',
             "server_event_name": "server_event_name",
             "user_event_name": cluster_name + "_" + namespace + "_" + pod_name + "_" + container_name,
             "cluster_name": cluster_name,
@@ -31,6 +41,50 @@ class K8s_View(BaseMyappView):
         # print(data)
         return self.render_template('log.html', data=data)
 
+    # 实时获取pod日志，server-sent events 推送，多个订阅者共享同一个follow连接
+    @expose("/stream/log/<cluster_name>/<namespace>/<pod_name>/<container_name>", methods=["GET", ])
+    def stream_log(self, cluster_name, namespace, pod_name, container_name):
+        all_clusters = conf.get('CLUSTERS', {})
+        if cluster_name in all_clusters:
+            kubeconfig = all_clusters[cluster_name].get('KUBECONFIG', '')
+        else:
+            kubeconfig = None
+        k8s = K8s(kubeconfig)
+
+        def follow_func(since_seconds=None, tail_lines=None, request_timeout=None):
+            return k8s.follow_pod_log(name=pod_name, namespace=namespace, container=container_name, since_seconds=since_seconds, tail_lines=tail_lines, request_timeout=request_timeout)
+
+        def alive_func():
+            return k8s.is_container_alive(name=pod_name, namespace=namespace, container=container_name)
+
+        # 断线重连时浏览器带上最后收到的事件id，从该位置继续推送
+        lines = log_fanout.subscribe((cluster_name, namespace, pod_name, container_name), follow_func, alive_func, last_event_id=request.headers.get('Last-Event-ID'), with_id=True)
+        max_seconds = conf.get('LOG_STREAM_MAX_SECONDS', 240)
+        begin_time = time.time()
+
+        def generate():
+            try:
+                for event_id, line in lines:
+                    # 连接时长不超过worker的超时时间，主动断开后浏览器自动重连并续传
+                    if time.time() - begin_time > max_seconds:
+                        yield 'retry: 1000\n\n'
+                        return
+                    # 空行为心跳，客户端断开时在这里结束订阅
+                    if not line:
+                        yield ': heartbeat\n\n'
+                    elif event_id:
+                        yield 'id: %s\ndata: %s\n\n' % (event_id, line.rstrip('\n'))
+                    else:
+                        yield 'data: %s\n\n' % line.rstrip('\n')
+                yield 'event: end\ndata: \n\n'
+            finally:
+                lines.close()
+
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
     # from myapp import socketio
     # # 实时获取pod日志
     # @socketio.on("k8s_stream_log",namespace='/k8s/stream/log')
@@ -126,11 +180,9 @@ class K8s_View(BaseMyappView):
                 kubeconfig = None
 
             k8s = K8s(kubeconfig)
-            logs = k8s.download_pod_log(namespace=namespace, name=pod_name)
-            file = open(pod_name, mode='w')
-            file.write(logs)
-            file.close()
-            response = make_response(send_file(pod_name, as_attachment=True, conditional=True))
+            lines = k8s.iter_pod_log(namespace=namespace, name=pod_name)
+            response = Response(stream_with_context(lines), mimetype='text/plain')
+            response.headers['Content-Disposition'] = 'attachment; filename=%s' % pod_name
             return response
         except Exception as e:
             print(e)
@@ -150,19 +202,23 @@ class K8s_View(BaseMyappView):
 
             k8s = K8s(kubeconfig)
             if not tail:
-                logs = k8s.download_pod_log(namespace=namespace, name=pod_name, container=container)
+                lines = k8s.iter_pod_log(namespace=namespace, name=pod_name, container=container)
             elif 's' in tail:
-                logs = k8s.download_pod_log(namespace=namespace, name=pod_name,container=container,since_seconds=tail.replace('s', ''))
+                lines = k8s.iter_pod_log(namespace=namespace, name=pod_name,container=container,since_seconds=tail.replace('s', ''))
             elif int(tail)>100000000:
-                logs = k8s.download_pod_log(namespace=namespace, name=pod_name, container=container,since_time=tail)
+                lines = k8s.iter_pod_log(namespace=namespace, name=pod_name, container=container,since_time=tail)
             else:
-                logs = k8s.download_pod_log(namespace=namespace, name=pod_name, container=container, tail_lines=tail)
-
-            import re
-            # 删除 ANSI 转义序列
-            ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-            logs = ansi_escape.sub('', logs)
-            return logs
+                lines = k8s.iter_pod_log(namespace=namespace, name=pod_name, container=container, tail_lines=tail)
+
+            # 按块读取并删除 ANSI 转义序列，传入offset/limit等参数时只返回窗口内的日志
+            window = LogWindow.from_args(request.args, max_lines=conf.get('LOG_READ_MAX_LINES', 10000), max_bytes=conf.get('LOG_READ_MAX_BYTES', 10 * 1024 * 1024))
+            if window.bounded:
+                response = make_response(''.join(window.filter(lines)))
+                response.headers['X-Log-Next-Offset'] = str(window.next_offset)
+                response.headers['X-Log-Next-Byte-Offset'] = str(window.next_byte_offset)
+                response.headers['X-Log-Eof'] = str(window.eof).lower()
+                return response
+            return Response(stream_with_context(window.filter(lines)))
         except Exception as e:
             print(e)
             return str(e)
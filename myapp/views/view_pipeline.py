@@ -4,15 +4,18 @@ from flask_babel import lazy_gettext as _
 import uuid
 import logging
 import urllib.parse
+import hashlib
 from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import joinedload
 from myapp.models.model_job import Job_Template
-from myapp.models.model_job import Task, Pipeline, Workflow, RunHistory
+from myapp.models.model_job import Task, Pipeline, Workflow, RunHistory, Images
 from myapp.models.model_team import Project
 from myapp.views.view_team import Project_Join_Filter
 from flask_appbuilder.actions import action
 from flask import jsonify, Response, request
 from flask_appbuilder.forms import GeneralModelConverter
 from myapp.utils import core
+from myapp.utils.cache import LRUCache
 from myapp import app, appbuilder, db
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 from jinja2 import Environment, BaseLoader, DebugUndefined,Undefined
@@ -124,6 +127,20 @@ def make_workflow_yaml(pipeline,workflow_label,hubsecret_list,dag_templates,cont
     return workflow_crd_json
 
 
+template_env = Environment(loader=BaseLoader, undefined=Undefined)
+compiled_templates = LRUCache(max_size=conf.get('PIPELINE_TEMPLATE_CACHE_SIZE', 1000), timeout=0)
+
+
+# 编译后的模板按源码的hash缓存，相同的全局变量，参数等不用重复编译
+def get_template(src_str):
+    key = hashlib.md5(src_str.encode('utf-8')).hexdigest()
+    hit, rtemplate = compiled_templates.get(key)
+    if not hit:
+        rtemplate = template_env.from_string(src_str)
+        compiled_templates.set(key, rtemplate)
+    return rtemplate
+
+
 # 转化为worfklow的yaml
 # @pysnooper.snoop()
 def dag_to_pipeline(pipeline, dbsession, workflow_label=None, **kwargs):
@@ -135,12 +152,14 @@ def dag_to_pipeline(pipeline, dbsession, workflow_label=None, **kwargs):
     if not dag:
         return None, None
 
+    # 一次查询出所有的task，同时加载模板，镜像和仓库，避免每个节点都查询一次
+    tasks = dbsession.query(Task).filter_by(pipeline_id=pipeline.id).options(
+        joinedload(Task.job_template).joinedload(Job_Template.images).joinedload(Images.repository)
+    ).all()
+    tasks = dict((task.name, task) for task in tasks)
     all_tasks = {}
     for task_name in dag:
-        # 使用临时连接，避免连接中断的问题
-        # try:
-        # db.session().ping()
-        task = dbsession.query(Task).filter_by(name=task_name, pipeline_id=pipeline.id).first()
+        task = tasks.get(task_name)
         if not task:
             raise MyappException('task %s not exist ' % task_name)
         all_tasks[task_name] = task
@@ -151,8 +170,8 @@ def dag_to_pipeline(pipeline, dbsession, workflow_label=None, **kwargs):
 
     # 渲染字符串模板变量
     # @pysnooper.snoop()
-    def template_str(src_str):
-        rtemplate = Environment(loader=BaseLoader, undefined=Undefined).from_string(src_str)
+    def template_str(src_str, cache=True):
+        rtemplate = get_template(src_str) if cache else template_env.from_string(src_str)
         des_str = rtemplate.render(creator=pipeline.created_by.username,
                                    datetime=datetime,
                                    runner=g.user.username if g and g.user and g.user.username else pipeline.created_by.username,
@@ -525,7 +544,8 @@ def dag_to_pipeline(pipeline, dbsession, workflow_label=None, **kwargs):
     # 先这是某个模板变量不进行渲染，一直向后传递到argo
     pipeline_file = json.dumps(workflow_json,ensure_ascii=False,indent=4)
     # print(pipeline_file)
-    pipeline_file = template_str(pipeline_file)
+    # 整个workflow每次都不一样，不进入模板缓存
+    pipeline_file = template_str(pipeline_file, cache=False)
 
     return pipeline_file, workflow_label['run-id']
 
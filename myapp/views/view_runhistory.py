@@ -79,6 +79,7 @@ appbuilder.add_view_no_menu(RunHistory_ModelView)
 class RunHistory_ModelView_Api(RunHistory_ModelView_Base, MyappModelRestApi):
     datamodel = SQLAInterface(RunHistory)
     route_base = '/runhistory_modelview/api'
+    list_count_mode = 'cached'   # 记录数很多，总数缓存一段时间
 
 
 appbuilder.add_api(RunHistory_ModelView_Api)
@@ -175,12 +175,17 @@ class Sqllab_Query_View(BaseMyappView):
         res_keys = ['stage', 'state', 'err_msg', "spark_log_url", "spark_ui_url"]
         return check_process_res(res_keys, res)
 
-    # 获取结果（必须）
+    # 获取结果（必须），传入offset和limit时分页返回，并返回总行数
     @expose('/result/<task_id>', methods=(["GET"]))
     def get_result(self, task_id):
         qid, engine_impl = check_task_engine(task_id)
-        res = engine_impl.get_result(qid)
-        res_keys = ["err_msg", "result"]
+        limit = request.args.get('limit', type=int)
+        if limit:
+            res = engine_impl.get_result(qid, offset=request.args.get('offset', 0, type=int), limit=limit)
+            res_keys = ["err_msg", "result", "total"]
+        else:
+            res = engine_impl.get_result(qid)
+            res_keys = ["err_msg", "result"]
         return check_process_res(res_keys, res)
 
     # 下载结果（必须）
@@ -13,6 +13,8 @@ from flask_babel import lazy_gettext as _
 import datetime, time, json
 import pysnooper
 from myapp.utils.py.py_k8s import K8s
+from myapp.utils import core
+from myapp.utils.cache import memoized_func
 
 conf = app.config
 
@@ -20,44 +22,14 @@ pipeline_resource_used = {
     "check_time": None,
     "data": {}
 }
-node_resource_used = {
-    "check_time": None,
-    "data": {}
-}
-global_cluster_load = {}
 
 
 # 机器学习首页资源弹窗
 # @pysnooper.snoop()
 def node_traffic():
-    if not node_resource_used['check_time'] or node_resource_used['check_time'] < (datetime.datetime.now() - datetime.timedelta(seconds=10)):
-
-        all_node_json = {}
-        clusters = conf.get('CLUSTERS', {})
-        for cluster_name in clusters:
-            try:
-                cluster = clusters[cluster_name]
-                k8s_client = K8s(cluster.get('KUBECONFIG', ''))
-
-                all_node = k8s_client.get_node()
-                all_node_resource = k8s_client.get_all_node_allocated_resources()
-                all_node_json[cluster_name] = {}
-                for node in all_node:
-                    all_node_json[cluster_name][node['hostip']] = node
-                    node_allocated_resources = all_node_resource.get(node['name'], {
-                        "used_cpu": 0,
-                        "used_memory": 0,
-                        "used_gpu": 0
-                    })
-                    # print(node_allocated_resources)
-                    all_node_json[cluster_name][node['hostip']].update(node_allocated_resources)
-            except Exception as e:
-                print(e)
-
-        node_resource_used['data'] = all_node_json
-        node_resource_used['check_time'] = datetime.datetime.now()
-
-    all_node_json = node_resource_used['data']
+    # 读取定时任务采集的机器资源快照，不再在每个web进程中查询集群
+    snapshot = core.get_node_resource_snapshot()
+    all_node_json = dict((cluster_name, core.get_snapshot_nodes(snapshot['clusters'][cluster_name])) for cluster_name in snapshot['clusters'])
     # print(all_node_json)
     # 数据格式说明 dict:
     # 'delay': Integer 延时隐藏 单位: 毫秒 0为不隐藏
@@ -73,16 +45,7 @@ def node_traffic():
         td_html % __("集群"), td_html % __("资源组"), td_html % __("机器"), td_html % __("机型"), td_html % __("cpu占用率"), td_html % __("内存占用率"),
         td_html % __("AI加速卡"))
 
-    global global_cluster_load
     for cluster_name in all_node_json:
-        global_cluster_load[cluster_name] = {
-            "cpu_req": 0,
-            "cpu_all": 0,
-            "mem_req": 0,
-            "mem_all": 0,
-            "gpu_req": 0,
-            "gpu_all": 0
-        }
         nodes = all_node_json[cluster_name]
         # nodes = sorted(nodes.items(), key=lambda item: item[1]['labels'].get('org','public'))
         # ips = [node[0] for node in nodes]
@@ -154,12 +117,6 @@ def node_traffic():
                 # td_html % (','.join(list(set(nodes[ip]['user']))[0:1]))
             )
 
-            global_cluster_load[cluster_name]['cpu_req'] += int(nodes[ip]['used_cpu'])
-            global_cluster_load[cluster_name]['cpu_all'] += int(nodes[ip]['cpu'])
-            global_cluster_load[cluster_name]['mem_req'] += int(nodes[ip]['used_memory'])
-            global_cluster_load[cluster_name]['mem_all'] += int(nodes[ip]['memory'])
-            global_cluster_load[cluster_name]['gpu_req'] += round(gpu_used, 2)
-            global_cluster_load[cluster_name]['gpu_all'] += int(float(gpu_total))
 
     message = Markup('<table style="margin:20px">%s</table>' % message)
 
@@ -330,12 +287,10 @@ class Total_Resource_ModelView_Api(MyappFormRestApi):
         return total_count,lst
 
     # @pysnooper.snoop()
+    @memoized_func(timeout=conf.get('RESOURCE_OVERVIEW_CACHE_TIMEOUT', 30))
     def echart_option(self, filters=None):
-        global global_cluster_load
-
-        if not global_cluster_load:
-            node_resource_used['check_time'] = None
-            node_traffic()
+        # 集群整体负载直接读取机器资源快照
+        global_cluster_load = core.get_node_resource_snapshot()['load']
 
         from myapp.utils.py.py_prometheus import Prometheus
         prometheus = Prometheus(conf.get('PROMETHEUS', 'prometheus-k8s.monitoring:9090'))
@@ -26,8 +26,12 @@ from flask import (
     abort,
     flash,
     g,
-    redirect
+    redirect,
+    Response,
+    stream_with_context
 )
+from markupsafe import escape
+from myapp.utils.py.py_log import LogWindow, iter_log_lines
 
 from .base import (
     DeleteMixin,
@@ -522,20 +526,66 @@ class Workflow_ModelView_Base(Crd_ModelView_Base):
     @expose("/web/log_node/<cluster_name>/<namespace>/<workflow_name>/<pod_name>", methods=["GET", ])
     @expose("/web/log/<cluster_name>/<namespace>/<workflow_name>/<pod_name>/<file_name>", methods=["GET", ])
     def log_node(self, cluster_name, namespace, workflow_name, pod_name,file_name='main.log'):
-        log = self.get_minio_content(f'{workflow_name}/{pod_name}/{file_name}')
-        if '/web/log/' in request.path:
-            from wtforms.widgets.core import HTMLString, html_params
+        key = f'{workflow_name}/{pod_name}/{file_name}'
+        window = None
+        # 压缩文件需要整体解压，普通日志文件流式读取，传入offset/limit等参数时只返回窗口内的日志
+        if '.zip' in key or '.tgz' in key or request.host=='127.0.0.1':
+            log = self.get_minio_content(key)
+        else:
+            window = LogWindow.from_args(request.args, max_lines=conf.get('LOG_READ_MAX_LINES', 10000), max_bytes=conf.get('LOG_READ_MAX_BYTES', 10 * 1024 * 1024))
+            lines = window.filter(self.iter_minio_lines(key))
+            if '/web/log/' in request.path and not window.bounded:
+                def generate():
+                    yield '<pre><code>'
+                    for line in lines:
+                        yield str(escape(line))
+                    yield '</code></pre>'
+                return Response(stream_with_context(generate()))
+            log = ''.join(lines)
 
+        if '/web/log/' in request.path:
             return Markup("<pre><code>%s</code></pre>"%log)
+        result = {
+            "type": "html",
+            "value": Markup(log)
+        }
+        if window and window.bounded:
+            result.update({
+                "next_offset": window.next_offset,
+                "next_byte_offset": window.next_byte_offset,
+                "eof": window.eof
+            })
         return jsonify({
             "status": 0,
             "message": "",
-            "result": {
-                "type": "html",
-                "value": Markup(log)
-            }
+            "result": result
         })
 
+    # 流式读取minio中的日志文件，读完或者中途停止时释放连接
+    def iter_minio_lines(self, key, chunk_size=64 * 1024):
+        from minio import Minio
+        try:
+            minioClient = Minio(
+                endpoint=conf.get('MINIO_HOST','minio.kubeflow:9000'),
+                access_key='minio',
+                secret_key='minio123',
+                secure=False
+            )
+            response = minioClient.get_object('mlpipeline', key)
+        except Exception as e:
+            print(e)
+            return iter([str(e)])
+
+        def iter_lines():
+            try:
+                for line in iter_log_lines(response.stream(chunk_size)):
+                    yield line
+            finally:
+                response.close()
+                response.release_conn()
+
+        return iter_lines()
+
     # @pysnooper.snoop(watch_explode=())
     def get_minio_content(self, key, decompress=True, download=False):
         if request.host=='127.0.0.1':
@@ -981,6 +1031,7 @@ appbuilder.add_view_no_menu(Workflow_ModelView)
 class Workflow_ModelView_Api(Workflow_ModelView_Base, MyappModelRestApi):
     datamodel = SQLAInterface(Workflow)
     route_base = '/workflow_modelview/api'
+    list_count_mode = 'cached'   # 记录数很多，总数缓存一段时间
 
 
 appbuilder.add_api(Workflow_ModelView_Api)
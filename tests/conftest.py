@@ -0,0 +1,19 @@
+import os
+import pytest
+
+# 导入myapp前指定测试配置，未设置时myapp会加载空的myapp/config.py
+os.environ.setdefault('MYAPP_CONFIG', 'testing_config')
+
+
+# 建表并创建管理员，接口请求通过myapp_username的cookie登录
+@pytest.fixture(scope='session')
+def admin_client():
+    from myapp import app, appbuilder, db
+    db.create_all()
+    security_manager = appbuilder.sm
+    if not security_manager.find_user('admin'):
+        role = security_manager.find_role('Admin') or security_manager.add_role('Admin')
+        security_manager.add_user('admin', 'admin', 'admin', 'admin@example.com', role, password='admin')
+    test_client = app.test_client()
+    test_client.set_cookie('myapp_username', 'admin')
+    return test_client
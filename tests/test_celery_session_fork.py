@@ -0,0 +1,110 @@
+# celery worker fork后子进程的engine测试：子进程重新创建engine，不使用父进程连接池里的连接
+import json
+import os
+import sys
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import QueuePool
+
+from myapp import conf
+from myapp.utils import celery as celery_utils
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='need os.fork')
+
+
+@pytest.fixture()
+def engines(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % (tmp_path / 'celery.db'))
+    created = []
+
+    # 线上mysql使用QueuePool，sqlite文件库默认是NullPool，这里指定为QueuePool，并记录创建的engine
+    def create_queue_pool_engine(*args, **kwargs):
+        engine = create_engine(*args, poolclass=QueuePool, **kwargs)
+        created.append(engine)
+        return engine
+
+    monkeypatch.setattr(celery_utils, 'create_engine', create_queue_pool_engine)
+    celery_utils.reset_engines()
+    yield created
+    celery_utils.dispose_engine()
+    celery_utils.reset_engines()
+
+
+# 在子进程中执行func，通过管道返回结果
+def run_in_child(func):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 1
+        try:
+            result = func()
+            code = 0
+        except BaseException as e:
+            result = {'error': repr(e)}
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        sys.stdout.flush()
+        os._exit(code)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    _, status = os.waitpid(pid, 0)
+    result = json.loads(output) if output else {}
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, result
+    return result
+
+
+def test_child_creates_own_engine(engines):
+    session_class = celery_utils.get_session_class()
+    assert celery_utils.get_session_class() is session_class
+    session = session_class()
+    assert session.execute(text('select 1')).scalar() == 1
+    session.close()
+    parent_engine = engines[0]
+    assert parent_engine.pool.checkedin() == 1
+
+    def child():
+        # 继承来的engine在fork时已经被丢弃
+        inherited = dict(celery_utils.process_engines)
+        parent_checkouts = []
+        event.listen(parent_engine, 'checkout', lambda *args: parent_checkouts.append(args))
+        child_session_class = celery_utils.get_session_class()
+        child_session = child_session_class()
+        value = child_session.execute(text('select 1')).scalar()
+        child_session.close()
+        child_engine = celery_utils.process_engines[os.getpid()][0]
+        return {
+            'inherited': len(inherited),
+            'value': value,
+            'new_session_class': child_session_class is not session_class,
+            'new_engine': child_engine is not parent_engine,
+            'engine_num': len(engines),
+            'parent_checkouts': len(parent_checkouts),
+        }
+
+    result = run_in_child(child)
+    assert result == {'inherited': 0, 'value': 1, 'new_session_class': True, 'new_engine': True, 'engine_num': 2, 'parent_checkouts': 0}
+
+    # 子进程退出后，父进程的engine和连接池还可以继续使用
+    assert celery_utils.process_engines[os.getpid()][0] is parent_engine
+    session = celery_utils.get_session_class()()
+    assert session.execute(text('select 1')).scalar() == 1
+    session.close()
+    assert len(engines) == 1
+
+
+def test_fork_while_lock_held(engines):
+    celery_utils.get_session_class()
+    # fork时锁被父进程持有，子进程中锁会重建，不会死锁
+    with celery_utils.process_engines_lock:
+        def child():
+            acquired = celery_utils.process_engines_lock.acquire(timeout=5)
+            celery_utils.process_engines_lock.release()
+            session = celery_utils.get_session_class()()
+            value = session.execute(text('select 1')).scalar()
+            session.close()
+            return {'acquired': acquired, 'value': value}
+
+        result = run_in_child(child)
+    assert result == {'acquired': True, 'value': 1}
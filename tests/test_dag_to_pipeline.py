@@ -0,0 +1,112 @@
+# dag_to_pipeline生成workflow的基准测试，构造500个task的pipeline，统计耗时和sql查询(select)次数
+# 查询次数不能随task数增长，模板编译后按源码缓存，第二次生成不再编译。耗时用 pytest -s 查看
+import json
+import random
+import time
+import pytest
+from flask import g
+from sqlalchemy import event
+
+from myapp import app, appbuilder, db
+from myapp.models.model_job import Images, Job_Template, Pipeline, Repository, Task
+from myapp.models.model_team import Project
+from myapp.views import view_pipeline
+
+TASK_NUM = 500
+
+
+def create_pipeline(name, task_num, random_state):
+    project = Project(name='%s-project' % name, describe='dag to pipeline', type='org', expand=json.dumps({'node_selector': 'org=public'}))
+    repository = Repository(name='%s-repository' % name, server='registry.example.com', user='test', password='test', hubsecret='%s-hubsecret' % name)
+    job_templates = []
+    for index in range(5):
+        images = Images(name='registry.example.com/%s/job:%s' % (name, index), describe='job image', repository=repository, project=project)
+        job_templates.append(Job_Template(
+            name='%s-job-template-%s' % (name, index), describe='job template %s' % index, images=images, project=project,
+            env='TEMPLATE_ENV=%s\nTASK_RESOURCE_GPU=0' % index, hostAliases='10.0.0.%s job-%s.example.com' % (index, index),
+            entrypoint='python /app/job.py', args='{}', expand='{}', version='Release'
+        ))
+    pipeline = Pipeline(
+        name=name, describe='synthetic dag', project=project, parallelism=10,
+        global_env='RUN_DATE={{ execution_date }}\nRUNNER={{ runner }}\nPIPELINE={{ pipeline_name }}',
+        expand='[]', parameter='{}'
+    )
+    dag = {}
+    tasks = []
+    for index in range(task_num):
+        task_name = 'task-%s' % index
+        upstream = ['task-%s' % upstream_index for upstream_index in random_state.sample(range(index), min(index, 3))]
+        dag[task_name] = {'upstream': upstream}
+        task_args = {
+            '--date': '{{ execution_date }}',
+            '--input': '/mnt/{{ creator }}/%s/input-%s' % (name, index % 20),
+            '--params': {'batch_size': 32, 'epoch': index % 5},
+            '--debug': bool(index % 2),
+        }
+        tasks.append(Task(
+            name=task_name, label='task %s' % index, job_template=random_state.choice(job_templates), pipeline=pipeline,
+            args=json.dumps(task_args), command='' if index % 3 else 'python /app/run.py --task %s' % index,
+            volume_mount='kubeflow-user-workspace(pvc):/mnt', resource_memory='2G', resource_cpu='2', resource_gpu='0',
+            retry=index % 2, outputs='{}', monitoring='{}', expand='{}'
+        ))
+    pipeline.dag_json = json.dumps(dag)
+    db.session.add_all([project, repository, pipeline] + job_templates + tasks)
+    db.session.commit()
+    return pipeline
+
+
+# 执行dag_to_pipeline，返回workflow，耗时和执行的sql数目
+def run_dag_to_pipeline(pipeline):
+    statements = []
+
+    # 不统计连接池的ping
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('SELECT') and statement != 'SELECT 1':
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        begin = time.time()
+        pipeline_file, run_id = view_pipeline.dag_to_pipeline(pipeline, db.session, execution_date='2024-01-01 00:00:00')
+        cost = time.time() - begin
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return json.loads(pipeline_file), cost, statements
+
+
+@pytest.fixture()
+def request_context(admin_client):
+    with app.test_request_context():
+        g.user = appbuilder.sm.find_user('admin')
+        yield
+        db.session.rollback()
+
+
+def test_dag_to_pipeline_benchmark(request_context):
+    random_state = random.Random(3)
+    small_pipeline = create_pipeline('small-dag', 50, random_state)
+    big_pipeline = create_pipeline('big-dag', TASK_NUM, random_state)
+    db.session.expire_all()
+
+    _, small_cost, small_statements = run_dag_to_pipeline(small_pipeline)
+    db.session.expire_all()
+    workflow, cost, statements = run_dag_to_pipeline(big_pipeline)
+
+    templates = workflow['spec']['templates']
+    assert len(templates) == TASK_NUM + 1
+    assert len(templates[0]['dag']['tasks']) == TASK_NUM
+    container = templates[1]['container']
+    assert '2024-01-01 00:00:00' in container['args']
+    assert {'name': 'PIPELINE', 'value': 'big-dag'} in container['env']
+
+    # task在一次查询中加载，查询次数和task数无关
+    assert len(statements) == len(small_statements)
+
+    # 再次生成时模板已经编译过，只有整个workflow的渲染不走缓存
+    cached_num = len(view_pipeline.compiled_templates.data)
+    db.session.expire_all()
+    _, cached_cost, _ = run_dag_to_pipeline(big_pipeline)
+    assert len(view_pipeline.compiled_templates.data) == cached_num
+
+    print('\ndag_to_pipeline: %s tasks %.3fs (%s sql), %s tasks %.3fs (%s sql), cached templates %.3fs' % (
+        50, small_cost, len(small_statements), TASK_NUM, cost, len(statements), cached_cost))
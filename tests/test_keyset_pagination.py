@@ -0,0 +1,197 @@
+# 列表接口游标分页测试：升序降序，排序列有重复值和NULL时逐页遍历不漏行不重复，非法游标返回400，
+# 以及深分页时OFFSET查询和游标查询的执行计划对比
+import base64
+import datetime
+import json
+import random
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String, event, insert
+
+from myapp import appbuilder, db
+from flask_appbuilder import Model
+from flask_appbuilder.models.sqla.interface import SQLAInterface
+from myapp.views.baseApi import MyappModelRestApi
+
+
+class KeysetItem(Model):
+    __tablename__ = 'test_keyset_item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100))
+    score = Column(Integer, nullable=True, index=True)
+    changed_on = Column(DateTime, nullable=True)
+
+
+class KeysetItem_ModelView_Api(MyappModelRestApi):
+    datamodel = SQLAInterface(KeysetItem)
+    route_base = '/test_keyset_item_modelview/api'
+    list_columns = ['name', 'score', 'changed_on']
+    show_columns = list_columns
+    order_columns = ['id', 'name', 'score', 'changed_on']
+
+
+appbuilder.add_api(KeysetItem_ModelView_Api)
+
+ROW_NUM = 53
+BIG_ROW_NUM = 100000
+
+
+@pytest.fixture(scope='module')
+def client(admin_client):
+    KeysetItem.__table__.create(db.engine, checkfirst=True)
+    random_state = random.Random(5)
+    rows = []
+    for index in range(ROW_NUM):
+        # 排序列取值很少，大量重复，并且有NULL
+        score = random_state.choice([None, 1, 2, 3])
+        changed_on = random_state.choice([None, datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 2, 8, 30)])
+        rows.append(dict(name='item-%s' % index, score=score, changed_on=changed_on))
+    random_state.shuffle(rows)
+    db.session.execute(insert(KeysetItem), rows)
+    db.session.commit()
+    yield admin_client
+    db.session.remove()
+    KeysetItem.__table__.drop(db.engine)
+
+
+def list_page(client, **form_data):
+    response = client.get(KeysetItem_ModelView_Api.route_base + '/', json=form_data)
+    return response.status_code, response.json
+
+
+def expect_ids(order_column, order_direction):
+    items = db.session.query(KeysetItem).all()
+    # 排序列为NULL的行视为最小值，值相同时按主键
+    if order_column == 'id':
+        key = lambda item: item.id
+    else:
+        key = lambda item: (getattr(item, order_column) is not None, getattr(item, order_column) or 0, item.id)
+    return [item.id for item in sorted(items, key=key, reverse=order_direction == 'desc')]
+
+
+@pytest.mark.parametrize('order_direction', ['asc', 'desc'])
+@pytest.mark.parametrize('order_column', ['id', 'score', 'changed_on'])
+@pytest.mark.parametrize('page_size', [1, 7, 100])
+def test_cursor_walk(client, order_column, order_direction, page_size):
+    ids = []
+    cursor = ''
+    while True:
+        status, result = list_page(client, cursor=cursor, page_size=page_size, order_column=order_column, order_direction=order_direction)
+        assert status == 200
+        page = result['result']['data']
+        assert len(page) <= page_size
+        ids += [item['id'] for item in page]
+        cursor = result['result'].get('next_cursor')
+        if not cursor:
+            break
+        assert len(ids) <= ROW_NUM
+
+    assert len(ids) == len(set(ids)) == ROW_NUM
+    assert ids == expect_ids(order_column, order_direction)
+
+
+def encode(last):
+    return base64.urlsafe_b64encode(json.dumps(last).encode('utf-8')).decode('utf-8')
+
+
+@pytest.mark.parametrize('cursor,order_column', [
+    ('!!not-base64', 'id'),
+    (base64.urlsafe_b64encode(b'not json').decode('utf-8'), 'id'),
+    (encode({'value': 1}), 'score'),
+    (encode({'pk': 3, 'value': 'yesterday'}), 'changed_on'),
+])
+def test_invalid_cursor(client, cursor, order_column):
+    status, result = list_page(client, cursor=cursor, page_size=10, order_column=order_column, order_direction='asc')
+    assert status == 400
+    assert result['status'] == 1
+    assert 'invalid cursor' in result['message']
+
+
+class KeysetLog(Model):
+    __tablename__ = 'test_keyset_log'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100))
+    score = Column(Integer, nullable=True, index=True)
+    changed_on = Column(DateTime, nullable=True)
+
+
+class KeysetLog_ModelView_Api(MyappModelRestApi):
+    datamodel = SQLAInterface(KeysetLog)
+    route_base = '/test_keyset_log_modelview/api'
+    list_columns = ['name', 'score']
+    show_columns = list_columns
+    order_columns = ['id', 'score']
+
+
+appbuilder.add_api(KeysetLog_ModelView_Api)
+
+
+@pytest.fixture(scope='module')
+def big_client(admin_client):
+    KeysetLog.__table__.create(db.engine, checkfirst=True)
+    db.session.execute(insert(KeysetLog), [dict(name='log-%s' % index, score=index % 1000 or None) for index in range(BIG_ROW_NUM)])
+    db.session.commit()
+    yield admin_client
+    db.session.remove()
+    KeysetLog.__table__.drop(db.engine)
+
+
+# 记录接口执行的分页查询语句
+def capture_list_query(client, **form_data):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM test_keyset_log' in statement and 'LIMIT' in statement:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(KeysetLog_ModelView_Api.route_base + '/', json=dict(count_mode='none', **form_data))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200
+    assert len(statements) == 1
+    return response.json['result'], statements[0]
+
+
+# sqlite的执行计划，以及执行语句用到的虚拟机指令数，用来对比扫描的行数
+def query_plan(statement, parameters):
+    connection = db.engine.raw_connection()
+    try:
+        plan = [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()]
+        steps = [0]
+
+        def progress():
+            steps[0] += 1
+            return 0
+
+        connection.set_progress_handler(progress, 100)
+        connection.execute(statement, parameters).fetchall()
+        connection.set_progress_handler(None, 100)
+        return plan, steps[0] * 100
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('order_column', ['id', 'score'])
+def test_query_plan_offset_vs_cursor(big_client, order_column):
+    page_size = 20
+    page = BIG_ROW_NUM // page_size - 10
+    # 用OFFSET的深分页拿到最后一行，作为游标定位的起点，两种方式应该返回同样的下一页
+    offset_result, offset_query = capture_list_query(big_client, page=page, page_size=page_size, order_column=order_column, order_direction='asc')
+    last = offset_result['data'][-1]
+    last_value = None if order_column == 'id' else last[order_column]
+    cursor = encode({'pk': last['id'], 'value': last_value})
+    cursor_result, cursor_query = capture_list_query(big_client, cursor=cursor, page_size=page_size, order_column=order_column, order_direction='asc')
+    next_result, _ = capture_list_query(big_client, page=page + 1, page_size=page_size, order_column=order_column, order_direction='asc')
+    assert [item['id'] for item in cursor_result['data']] == [item['id'] for item in next_result['data']]
+
+    offset_plan, offset_steps = query_plan(*offset_query)
+    cursor_plan, cursor_steps = query_plan(*cursor_query)
+    print('\norder by %s, page %s' % (order_column, page))
+    print('offset plan: %s, vm steps: %s' % (offset_plan, offset_steps))
+    print('cursor plan: %s, vm steps: %s' % (cursor_plan, cursor_steps))
+
+    # OFFSET要先扫描并丢弃前面所有的行，游标直接通过索引定位到上一页的最后一行
+    assert not any('SEARCH' in line for line in offset_plan)
+    assert any('SEARCH' in line for line in cursor_plan)
+    assert cursor_steps * 50 < offset_steps
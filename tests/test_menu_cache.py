@@ -0,0 +1,30 @@
+# 菜单缓存测试：权限版本号变化后，菜单缓存不再命中
+from flask import g
+
+from myapp import app, appbuilder
+from myapp.security import MyappSecurityManager
+from myapp.utils.cache import memoize_metrics
+from myapp.views import home
+
+
+def test_menu_cache_key_changes_with_permission_version(admin_client):
+    with app.test_request_context('/myapp/menu'):
+        g.user = appbuilder.sm.find_user('admin')
+        key = home.menu_cache_key()
+        assert home.menu_cache_key() == key
+        MyappSecurityManager.bump_permission_version()
+        assert home.menu_cache_key() != key
+
+
+def test_menu_rebuilt_after_permission_change(admin_client):
+    assert admin_client.get('/myapp/menu').status_code == 200
+    # 第二次请求命中缓存
+    hit = memoize_metrics['hit']
+    response = admin_client.get('/myapp/menu')
+    assert response.status_code == 200
+    assert memoize_metrics['hit'] == hit + 1
+    # 权限变化后重新生成菜单
+    MyappSecurityManager.bump_permission_version()
+    miss = memoize_metrics['miss']
+    assert admin_client.get('/myapp/menu').json == response.json
+    assert memoize_metrics['miss'] == miss + 1
@@ -0,0 +1,252 @@
+# 资源额度校验使用的PodResourceIndex与原来基于get_all_resource列表过滤的计算结果对比测试
+# 构造5万个pod的多集群快照，apiserver的list接口替换为返回快照，不需要k8s集群
+import datetime
+import random
+import pytest
+
+pytest.importorskip('kubernetes')
+from kubernetes import client
+
+from myapp import conf
+from myapp.utils import core
+from myapp.utils.py import py_k8s
+
+POD_NUM = 50000
+CLUSTER_NAMES = ['dev', 'prod']
+ORGS = ['public', 'train', 'inference']
+USERS = ['user%s' % index for index in range(200)]
+PROJECTS = ['project%s' % index for index in range(20)]
+RESOURCES = ['cpu', 'memory', 'gpu']
+
+KUBECONFIG = '''apiVersion: v1
+kind: Config
+clusters:
+- cluster:
+    server: https://%s.cluster.local:6443
+  name: %s
+contexts:
+- context:
+    cluster: %s
+    user: %s
+  name: %s
+current-context: %s
+users:
+- name: %s
+  user:
+    token: test
+'''
+
+# 模型对象共用一个Configuration，避免每个对象都创建一次
+model_config = client.Configuration()
+
+
+def make_pod(random_state, namespace, name):
+    model = dict(local_vars_configuration=model_config)
+    labels = {'pod-type': random_state.choice(['task', 'notebook', 'service'])}
+    # 用户标签的各种写法，没有时为admin
+    user_label = random_state.choice(['user', 'username', 'run-rtx', 'rtx-user', None])
+    if user_label:
+        labels[user_label] = random_state.choice(USERS)
+    if random_state.random() < 0.1:
+        labels['pipeline-id'] = str(random_state.randint(1, 50))
+    annotations = {'project': random_state.choice(PROJECTS)} if random_state.random() < 0.9 else {}
+
+    requests = {
+        'cpu': random_state.choice(['100m', '500m', '1', '2', '4']),
+        'memory': random_state.choice(['512Mi', '1G', '2Gi', '4G']),
+    }
+    gpu_type = random_state.choice(['none', 'none', 'gpu', 'vgpu'])
+    if gpu_type == 'gpu':
+        requests['nvidia.com/gpu'] = str(random_state.randint(1, 2))
+    if gpu_type == 'vgpu':
+        requests['tencent.com/vcuda-core'] = '50'
+    containers = [client.V1Container(name='main', resources=client.V1ResourceRequirements(requests=requests, **model), **model)]
+    # 部分pod有sidecar容器
+    if random_state.random() < 0.2:
+        containers.append(client.V1Container(name='sidecar', resources=client.V1ResourceRequirements(requests={'cpu': '100m', 'memory': '128Mi'}, **model), **model))
+
+    # 资源组可能在nodeSelector或者节点亲和性中，都没有时为public
+    org = random_state.choice(ORGS + [None])
+    node_selector, affinity = None, None
+    if org and random_state.random() < 0.5:
+        node_selector = {'org': org}
+    elif org:
+        match_expression = client.V1NodeSelectorRequirement(key='org', operator='In', values=[org], **model)
+        node_selector_term = client.V1NodeSelectorTerm(match_expressions=[match_expression], **model)
+        affinity = client.V1Affinity(node_affinity=client.V1NodeAffinity(required_during_scheduling_ignored_during_execution=client.V1NodeSelector(node_selector_terms=[node_selector_term], **model), **model), **model)
+
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, namespace=namespace, labels=labels, annotations=annotations, creation_timestamp=datetime.datetime(2024, 1, 1), **model),
+        spec=client.V1PodSpec(containers=containers, node_selector=node_selector, affinity=affinity, **model),
+        status=client.V1PodStatus(phase='Running', conditions=[client.V1PodCondition(type='Ready', status='True', **model)], **model),
+        **model
+    )
+
+
+@pytest.fixture(scope='module')
+def snapshot():
+    random_state = random.Random(7)
+    namespaces = conf.get('HUBSECRET_NAMESPACE')
+    pods = dict(((cluster_name, namespace), []) for cluster_name in CLUSTER_NAMES for namespace in namespaces)
+    for index in range(POD_NUM):
+        cluster_name = random_state.choice(CLUSTER_NAMES)
+        namespace = random_state.choice(namespaces)
+        pods[(cluster_name, namespace)].append(make_pod(random_state, namespace, 'pod-%s' % index))
+    return pods
+
+
+@pytest.fixture()
+def clusters(snapshot, tmp_path, monkeypatch):
+    clusters = {}
+    for cluster_name in CLUSTER_NAMES:
+        kubeconfig = tmp_path / ('%s-kubeconfig' % cluster_name)
+        kubeconfig.write_text(KUBECONFIG % ((cluster_name,) * 7))
+        clusters[cluster_name] = {'NAME': cluster_name, 'KUBECONFIG': str(kubeconfig)}
+    monkeypatch.setitem(conf, 'CLUSTERS', clusters)
+    monkeypatch.setitem(conf, 'K8S_INFORMER_ENABLE', False)
+    monkeypatch.setitem(conf, 'K8S_FANOUT_TIMEOUT', 300)
+
+    # 按api client的地址区分集群，返回快照中的pod
+    def list_namespaced_pod(self, namespace, **kwargs):
+        cluster_name = self.api_client.configuration.host.split('//')[1].split('.')[0]
+        return client.V1PodList(items=snapshot[(cluster_name, namespace)], local_vars_configuration=model_config)
+
+    monkeypatch.setattr(client.CoreV1Api, 'list_namespaced_pod', list_namespaced_pod)
+    return clusters
+
+
+def build_indexes(clusters, snapshot):
+    resource_indexes = {}
+    for cluster_name in clusters:
+        resource_index = py_k8s.PodResourceIndex(py_k8s.K8s(clusters[cluster_name]['KUBECONFIG']), cluster_name, conf.get('HUBSECRET_NAMESPACE'))
+        resource_index.on_replace([pod for (name, namespace), pods in snapshot.items() if name == cluster_name for pod in pods])
+        resource_indexes[cluster_name] = resource_index
+    return resource_indexes
+
+
+# 原来meet_quota中对get_all_resource结果的过滤和求和
+def old_user_exist(all_resources, username, cluster, namespace, org, resource=None):
+    exist_pod = [pod for pod in all_resources if pod['user'] == username]
+    if cluster != 'all':
+        exist_pod = [pod for pod in exist_pod if pod['cluster'] == cluster]
+    if namespace != 'all':
+        exist_pod = [pod for pod in exist_pod if pod['namespace'] == namespace]
+    if org != 'all':
+        exist_pod = [pod for pod in exist_pod if pod['org'] == org]
+    if resource:
+        exist_pod = [pod for pod in exist_pod if pod['resource'] == resource]
+    return sum([float(str(pod.get('value', '0')).replace('G', '')) for pod in exist_pod])
+
+
+def old_project_exist(all_resources, project, namespace, resource):
+    exist_pod = [pod for pod in all_resources if pod['project'] == project]
+    if namespace != 'all':
+        exist_pod = [pod for pod in exist_pod if pod['namespace'] == namespace]
+    exist_pod = [pod for pod in exist_pod if pod['resource'] == resource]
+    return sum([float(str(pod.get('value', '0')).replace('G', '')) for pod in exist_pod])
+
+
+def quota_cases():
+    random_state = random.Random(11)
+    namespaces = conf.get('HUBSECRET_NAMESPACE')
+    user_cases = [('admin', 'all', 'all', 'all')]
+    for index in range(40):
+        user_cases.append((random_state.choice(USERS), random_state.choice(CLUSTER_NAMES + ['all']), random_state.choice(namespaces + ['all']), random_state.choice(ORGS + ['all'])))
+    project_cases = [(random_state.choice(PROJECTS + ['public']), random_state.choice(namespaces + ['all'])) for index in range(20)]
+    return user_cases, project_cases
+
+
+@pytest.mark.parametrize('exclude_pod', [[], 'pod-3', ['pod-1', 'pod-2', 'pod-missing'], {'pod-type': 'notebook', 'pipeline-id': '3'}])
+def test_index_matches_all_resource(clusters, snapshot, monkeypatch, exclude_pod):
+    all_resources = core.get_all_resource(exclude_pod=exclude_pod)
+    if exclude_pod:
+        assert len(all_resources) < POD_NUM * len(RESOURCES)
+    else:
+        assert len(all_resources) == POD_NUM * len(RESOURCES)
+
+    resource_indexes = build_indexes(clusters, snapshot)
+    monkeypatch.setattr(core, 'get_resource_indexes', lambda: resource_indexes)
+    exist = core.ExistResource(exclude_pod=exclude_pod)
+    assert exist.resource_indexes is resource_indexes
+
+    user_cases, project_cases = quota_cases()
+    for resource in RESOURCES:
+        for username, cluster, namespace, org in user_cases:
+            expect = old_user_exist(all_resources, username, cluster, namespace, org, resource)
+            assert exist.get_value(resource, user=username, cluster=cluster, namespace=namespace, org=org) == pytest.approx(expect, abs=1e-2)
+        for project, namespace in project_cases:
+            expect = old_project_exist(all_resources, project, namespace, resource)
+            assert exist.get_value(resource, project=project, namespace=namespace) == pytest.approx(expect, abs=1e-2)
+
+
+def test_fallback_matches_all_resource(clusters, snapshot, monkeypatch):
+    monkeypatch.setattr(core, 'get_resource_indexes', lambda: None)
+    exist = core.ExistResource(exclude_pod={'pod-type': 'service'})
+    assert exist.resource_indexes is None
+    all_resources = core.get_all_resource(exclude_pod={'pod-type': 'service'})
+
+    user_cases, project_cases = quota_cases()
+    for resource in RESOURCES:
+        for username, cluster, namespace, org in user_cases:
+            expect = old_user_exist(all_resources, username, cluster, namespace, org, resource)
+            assert exist.get_value(resource, user=username, cluster=cluster, namespace=namespace, org=org) == pytest.approx(expect, abs=1e-6)
+        for project, namespace in project_cases:
+            expect = old_project_exist(all_resources, project, namespace, resource)
+            assert exist.get_value(resource, project=project, namespace=namespace) == pytest.approx(expect, abs=1e-6)
+
+
+# 原来用户的concurrent额度没有按resource过滤，cpu，内存和gpu的值加在了一起，现在只统计额度配置的资源
+def test_user_quota_filters_by_resource(clusters, snapshot, monkeypatch):
+    all_resources = core.get_all_resource()
+    resource_indexes = build_indexes(clusters, snapshot)
+    monkeypatch.setattr(core, 'get_resource_indexes', lambda: resource_indexes)
+    exist = core.ExistResource()
+
+    user_cases, project_cases = quota_cases()
+    for username, cluster, namespace, org in user_cases:
+        old_value = old_user_exist(all_resources, username, cluster, namespace, org)
+        values = [exist.get_value(resource, user=username, cluster=cluster, namespace=namespace, org=org) for resource in RESOURCES]
+        assert sum(values) == pytest.approx(old_value, abs=1e-2)
+        if old_value:
+            assert values[0] < old_value
+
+
+def test_index_events_match_relist(clusters, snapshot, monkeypatch):
+    resource_indexes = build_indexes(clusters, snapshot)
+    random_state = random.Random(13)
+    namespaces = conf.get('HUBSECRET_NAMESPACE')
+    resource_index = resource_indexes['dev']
+
+    # 增量事件：删除，修改(换用户和资源)，新增
+    changed = {}
+    for index in range(300):
+        namespace = random_state.choice(namespaces)
+        pods = changed.setdefault(namespace, list(snapshot[('dev', namespace)]))
+        action = random_state.choice(['DELETED', 'MODIFIED', 'ADDED'])
+        if action == 'DELETED' and pods:
+            pod = pods.pop(random_state.randrange(len(pods)))
+            resource_index.on_event('DELETED', pod, pod)
+        elif action == 'MODIFIED' and pods:
+            position = random_state.randrange(len(pods))
+            pod = make_pod(random_state, namespace, pods[position].metadata.name)
+            resource_index.on_event('MODIFIED', pods[position], pod)
+            pods[position] = pod
+        else:
+            pod = make_pod(random_state, namespace, 'new-pod-%s' % index)
+            pods.append(pod)
+            resource_index.on_event('ADDED', None, pod)
+    # 变更后的pod重新list，和增量维护的索引对比
+    for namespace in changed:
+        monkeypatch.setitem(snapshot, ('dev', namespace), changed[namespace])
+
+    all_resources = core.get_all_resource(cluster='dev')
+    monkeypatch.setattr(core, 'get_resource_indexes', lambda: {'dev': resource_index})
+    exist = core.ExistResource()
+    user_cases, project_cases = quota_cases()
+    for resource in RESOURCES:
+        for username, cluster, namespace, org in user_cases:
+            expect = old_user_exist(all_resources, username, 'dev', namespace, org, resource)
+            assert exist.get_value(resource, user=username, cluster='dev', namespace=namespace, org=org) == pytest.approx(expect, abs=1e-2)
+        for project, namespace in project_cases:
+            expect = old_project_exist(all_resources, project, namespace, resource)
+            assert exist.get_value(resource, project=project, namespace=namespace) == pytest.approx(expect, abs=1e-2)
@@ -0,0 +1,188 @@
+# ResumableWatch 的断线重连、410重新list、重启恢复测试，使用内存中的假apiserver，不需要k8s集群
+import os
+import importlib.util
+import pytest
+
+pytest.importorskip('kubernetes')
+
+# 直接按文件加载，避免导入myapp时初始化flask应用
+spec = importlib.util.spec_from_file_location('py_k8s_informer', os.path.join(os.path.dirname(__file__), '..', 'myapp', 'utils', 'py', 'py_k8s_informer.py'))
+py_k8s_informer = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(py_k8s_informer)
+ResumableWatch = py_k8s_informer.ResumableWatch
+
+
+class FakeStore():
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+
+class FakeApiServer():
+    """内存中的apiserver，resourceVersion为递增整数，compacted之前的版本watch时返回410
+
+    script 为每次watch连接的行为：('events', n) 推送n个事件后正常结束，('disconnect', n) 推送n个事件后断开连接
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.objects = {}
+        self.history = []   # (resourceVersion, type, object)
+        self.compacted = 0
+        self.script = []
+        self.watch = None
+
+    def apply(self, name, event_type='MODIFIED'):
+        self.version += 1
+        obj = {"metadata": {"namespace": "pipeline", "name": name, "resourceVersion": str(self.version)}}
+        if event_type == 'DELETED':
+            self.objects.pop(name, None)
+        else:
+            event_type = 'MODIFIED' if name in self.objects else 'ADDED'
+            self.objects[name] = obj
+        self.history.append((self.version, event_type, obj))
+
+    def compact(self):
+        self.compacted = self.version
+
+    # 模拟list_namespaced_custom_object，watch=True时返回事件列表
+    def list_func(self, watch=False, resource_version=None, **kwargs):
+        if not watch:
+            return {"items": list(self.objects.values()), "metadata": {"resourceVersion": str(self.version)}}
+        if not self.script:
+            self.watch.stop()
+            return []
+        action, count = self.script.pop(0)
+        if int(resource_version) < self.compacted:
+            return [{"type": "ERROR", "object": {}, "raw_object": {"code": 410, "message": "too old resource version"}}]
+        events = [{"type": event_type, "object": obj} for version, event_type, obj in self.history if version > int(resource_version)][:count]
+        if action == 'disconnect':
+            return events + [ConnectionError('connection reset')]
+        return events
+
+
+class FakeWatch():
+
+    def __init__(self, server):
+        self.server = server
+
+    def stop(self):
+        pass
+
+    def stream(self, func, **kwargs):
+        kwargs.pop('allow_watch_bookmarks', None)
+        kwargs.pop('timeout_seconds', None)
+        for event in func(watch=True, **kwargs):
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeApiServer()
+    monkeypatch.setattr(py_k8s_informer.watch, 'Watch', lambda: FakeWatch(server))
+    monkeypatch.setattr(py_k8s_informer.time, 'sleep', lambda seconds: None)
+    return server
+
+
+def new_watch(server, store, manual_commit=True):
+    resumable_watch = ResumableWatch(server.list_func, name='test/workflow', store=store, persist_interval=0, manual_commit=manual_commit, namespace='pipeline')
+    server.watch = resumable_watch
+    return resumable_watch
+
+
+def persisted(store):
+    return store.get('watch_resource_version/test/workflow')
+
+
+def test_disconnect_resume(server):
+    store = FakeStore()
+    for name in ['a', 'b', 'c']:
+        server.apply(name)
+    resumable_watch = new_watch(server, store, manual_commit=False)
+    server.script = [('events', 0), ('disconnect', 1), ('events', 10)]
+    received = []
+    resumable_watch.run(lambda event: received.append(event['object']['metadata']['name']))
+    assert sorted(received) == ['a', 'b', 'c']
+
+    server.apply('a')
+    server.apply('d')
+    server.script = [('disconnect', 1), ('events', 10)]
+    resumable_watch.stopped.clear()
+    received.clear()
+    resumable_watch.run(lambda event: received.append(event['object']['metadata']['name']))
+    # 断线后从上次的位置继续，不重复也不丢失
+    assert received == ['a', 'd']
+    assert persisted(store) == str(server.version)
+
+
+def test_gone_relist(server):
+    store = FakeStore()
+    for name in ['a', 'b']:
+        server.apply(name)
+    store.set('watch_resource_version/test/workflow', '1')
+    server.apply('c')
+    server.apply('b', 'DELETED')
+    server.compact()
+    resumable_watch = new_watch(server, store, manual_commit=False)
+    server.script = [('events', 10), ('events', 10)]
+    received = []
+    resumable_watch.run(lambda event: received.append(event['object']['metadata']['name']))
+    # 410后重新list，拿到当前还存在的对象
+    assert sorted(received) == ['a', 'c']
+    assert persisted(store) == str(server.version)
+
+
+def test_restart_replays_uncommitted(server):
+    store = FakeStore()
+    for name in ['a', 'b', 'c', 'd']:
+        server.apply(name)
+    resumable_watch = new_watch(server, store)
+    server.script = [('events', 10)]
+    received = []
+    resumable_watch.run(received.append)
+    resumable_watch.commit([event['resource_version'] for event in received])
+    assert persisted(store) == '4'
+
+    for name in ['e', 'f', 'g']:
+        server.apply(name)
+    resumable_watch.stopped.clear()
+    server.script = [('events', 10)]
+    received.clear()
+    resumable_watch.run(received.append)
+    assert [event['object']['metadata']['name'] for event in received] == ['e', 'f', 'g']
+    # 只确认了f，e没有确认，持久化的版本不能越过e
+    resumable_watch.commit([received[1]['resource_version']])
+    assert persisted(store) == '4'
+    resumable_watch.commit([received[0]['resource_version']])
+    assert persisted(store) == '6'
+
+    # 进程重启，内存中的去重记录丢失，从持久化的版本继续，g会重新收到
+    restarted = new_watch(server, store)
+    server.script = [('events', 10)]
+    received.clear()
+    restarted.run(received.append)
+    assert [event['object']['metadata']['name'] for event in received] == ['g']
+    restarted.commit([received[0]['resource_version']])
+    assert persisted(store) == '7'
+
+
+def test_relist_commit_after_all_objects(server):
+    store = FakeStore()
+    for name in ['a', 'b']:
+        server.apply(name)
+    resumable_watch = new_watch(server, store)
+    server.script = []
+    received = []
+    resumable_watch.run(received.append)
+    # 第一次启动list得到的对象还没有确认，不能持久化list的版本
+    assert persisted(store) is None
+    resumable_watch.commit([event['resource_version'] for event in received])
+    assert persisted(store) == '2'
@@ -0,0 +1,16 @@
+# 单元测试使用的配置，在docker部署配置的基础上把数据库换成内存sqlite，缓存换成进程内缓存，不需要mysql和redis
+import os
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# 部署时docker配置挂载为myapp/config.py，按同样的路径执行，保证BASE_DIR等路径一致
+config_path = os.path.join(ROOT_DIR, 'install', 'docker', 'config.py')
+config = {'__file__': os.path.join(ROOT_DIR, 'myapp', 'config.py'), '__name__': 'myapp.config'}
+with open(config_path, encoding='utf-8') as f:
+    exec(compile(f.read(), config_path, 'exec'), config)
+globals().update((key, value) for key, value in config.items() if key.isupper())
+
+SQLALCHEMY_DATABASE_URI = 'sqlite://'
+# sqlite使用StaticPool，不支持连接池大小的配置
+SQLALCHEMY_POOL_SIZE = None
+SQLALCHEMY_MAX_OVERFLOW = None
+CACHE_CONFIG = {'CACHE_TYPE': 'SimpleCache'}